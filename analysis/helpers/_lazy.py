@@ -0,0 +1,47 @@
+import sys
+import types
+import importlib
+
+# Deferred imports for the heavy dependencies of the helpers (pandas, scipy, nltk, langchain, firestore, ...).
+# `pd = lazy_import('pandas')` binds a placeholder module; the real import happens on first attribute
+# access (e.g., pd.DataFrame), so `import helpers.utils` stays fast for callers that only need a few
+# functions. Modules using it have `from __future__ import annotations`, so annotations like
+# pd.DataFrame in signatures don't trigger the import.
+
+class _LazyModule(types.ModuleType):
+    def __init__(self, name: str):
+        super().__init__(name)
+        object.__setattr__(self, '_lazy_module', None)
+
+    def _load(self) -> types.ModuleType:
+        module = object.__getattribute__(self, '_lazy_module')
+        if module is None:
+            # import_module is thread-safe and always returns the same module object
+            module = importlib.import_module(self.__name__)
+            object.__setattr__(self, '_lazy_module', module)
+        return module
+
+    def __getattr__(self, attr):
+        # Only called for attributes the placeholder itself doesn't have
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        # Monkeypatching the placeholder patches the real module
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if object.__getattribute__(self, '_lazy_module') is not None else 'not loaded'
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Returns a placeholder for module `name` that imports it on first attribute access.
+    If the module has already been imported, it is returned directly.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return _LazyModule(name)
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Benchmarks for the helpers. Run from the analysis directory:
+#   python -m helpers.benchmark imports
+#   python -m helpers.benchmark pipeline
+# Import times are measured in fresh interpreters, so nothing is cached from earlier imports. A module
+# fails the check if its median import time exceeds its budget, or if importing it loads one of the
+# heavy dependencies that should only be loaded on first use (see helpers._lazy).
+# The pipeline benchmark runs the stages of utils.final_data_prep on synthetic studies (see helpers.synthetic)
+# of increasing size, each in a fresh interpreter, and reports time, throughput and peak memory per stage.
+# Its ttr stage tokenizes with nltk, which needs the punkt_tab model (`python -m nltk.downloader punkt_tab`);
+# the benchmark checks for it before generating or processing any study.
+
+ANALYSIS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold-start budgets in seconds. With lazy imports, importing these modules only loads numpy.
+IMPORT_TIME_BUDGETS = {
+    'helpers.utils': 0.5,
+    'helpers.structured': 0.5,
+    'helpers.db': 0.3,
+    'helpers.cleaning': 0.5,
+    'helpers.metrics': 0.5,
+    'helpers.tokens': 0.3,
+    'helpers.ngrams': 0.5,
+    'helpers.stagecache': 0.3,
+    'helpers.eventjson': 0.3,
+    'helpers.tracing': 0.3,
+    'helpers.timeline': 0.3,
+}
+
+HEAVY_MODULES = ('pandas', 'scipy', 'nltk', 'bs4', 'pyarrow', 'progressbar', 'tqdm', 'openai', 'langchain_core', 'langchain_openai', 'google.cloud.firestore')
+
+def measure_import(module: str) -> tuple:
+    # Imports module in a fresh interpreter. Returns the import time and the heavy modules it loaded.
+    code = (
+        "import sys, time, json\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - t\n"
+        f"print(json.dumps([elapsed, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))"
+    )
+    out = subprocess.run([sys.executable, '-c', code], cwd=ANALYSIS_DIR, capture_output=True, text=True, check=True)
+    elapsed, loaded = json.loads(out.stdout.strip().splitlines()[-1])
+    return elapsed, loaded
+
+def check_import_times(budgets: dict = None, repeats: int = 5) -> list[dict]:
+    """
+    Measures the cold import time of each module (median of repeats fresh interpreters) and compares it to its budget.
+
+    Args:
+        budgets (dict, optional): Module name -> budget in seconds. Defaults to IMPORT_TIME_BUDGETS.
+        repeats (int, optional): Number of fresh interpreters per module. Defaults to 5.
+
+    Returns:
+        list[dict]: One result per module with the median time, the budget, the heavy modules loaded and whether it passed.
+    """
+    budgets = budgets if budgets is not None else IMPORT_TIME_BUDGETS
+    results = []
+    for module, budget in budgets.items():
+        measurements = [measure_import(module) for _ in range(repeats)]
+        seconds = statistics.median(elapsed for elapsed, _ in measurements)
+        loaded = sorted(set(m for _, heavy in measurements for m in heavy))
+        results.append({'module': module, 'seconds': seconds, 'budget': budget, 'heavy_modules_loaded': loaded, 'ok': seconds <= budget and len(loaded) == 0})
+    return results
+
+# Cohort sizes of the pipeline benchmark, as multiples of BASE_COHORT_USERS users
+PIPELINE_SCALES = (10, 100, 1000)
+BASE_COHORT_USERS = 10
+PIPELINE_STAGES = ('load_users', 'clean_users', 'construct_dfs', 'prepare_tasks', 'ttr', 'acceptance_rate', 'embeddings')
+
+def time_pipeline_stages(data_dir: str, n_workers: int = 1, compact: bool = False, cohort: bool = False, embeddings: bool = False, trace_memory: bool = False, chrome_trace: str = None) -> list[dict]:
+    """
+    Runs the stages of utils.final_data_prep on the study in data_dir (with the layout of data/) and measures
+    each with a tracing.Tracer. Stops at the first stage that fails and records its error.
+
+    Args:
+        data_dir (str): The study, e.g., written by synthetic.generate_study.
+        n_workers, compact, cohort: Passed to construct_dfs_for_analysis.
+        embeddings (bool, optional): Whether to run the embeddings stage, which calls the embeddings API for
+            essays that aren't cached. Defaults to False.
+        trace_memory (bool, optional): Whether to also measure the peak Python heap of each stage with
+            tracemalloc (slows the stages down). Defaults to False.
+        chrome_trace (str, optional): Where to write the trace of all stages, users and steps in Chrome trace format.
+
+    Returns:
+        list[dict]: Per stage: wall and CPU seconds, the peak RSS of the process after the stage, and the error if it failed.
+
+    Raises:
+        LookupError: If nltk's tokenizer model (punkt_tab) isn't installed and can't be downloaded.
+    """
+    import helpers.utils as utils
+    import helpers.cleaning as cleaning
+    import helpers.tokens as tokens
+    import helpers.tracing as tracing
+    import helpers.structured as structured
+    from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+
+    tokens.check_tokenizer_resources() # for the ttr stage, which would otherwise fail after the slow stages
+
+    tracer = tracing.Tracer(trace_memory=trace_memory)
+    state = {}
+    def load_users():
+        state['users_df'] = cleaning.load_qualtrics_csv(f'{data_dir}/qualtrics.csv')
+    def clean_users():
+        users_df = cleaning.clean_users_df(state['users_df'], keep_only_prolific_for_india=True, keep_only_prolific_for_us=True, remove_born_outside=True, remove_pilot=True)
+        users_df['group'] = None
+        state['users_df'] = users_df
+    def construct_dfs():
+        state['events_df'], state['tasks_df'], state['suggestions_df'] = utils.construct_dfs_for_analysis(
+            state['users_df'], f'{data_dir}/events', TREATMENT_LABEL, CONTROL_LABEL, n_workers=n_workers, compact=compact, cohort=cohort, tracer=tracer)
+    def prepare_tasks():
+        state['dfp'] = state['tasks_df'].drop(columns=['prompt', 'minWords', 'finalHtml']).reset_index()
+    def ttr():
+        state['dfp']['ttr'] = tokens.ttr_batch(state['dfp']['finalHtml_stripped'])
+    def acceptance_rate():
+        state['dfp']['acceptance_rate'] = state['dfp']['accepted'] / state['dfp']['shown']
+    def essay_embeddings():
+        state['dfp'] = structured.get_essay_embeddings_for_all_essays(state['dfp'], f'{data_dir}/embeddings/study.pkl')
+
+    stages = [load_users, clean_users, construct_dfs, prepare_tasks, ttr, acceptance_rate] + ([essay_embeddings] if embeddings else [])
+    results = []
+    for name, stage in zip(PIPELINE_STAGES, stages):
+        error = None
+        try:
+            with tracer.span(name):
+                stage()
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        record = tracer.records[-1] # the stage's span closes after the spans nested in it
+        result = {'stage': name, 'seconds': record['seconds'], 'cpu_seconds': record['cpu_seconds'], 'max_rss_mb': record['max_rss_mb']}
+        if trace_memory:
+            result['peak_memory_mb'] = record['peak_memory_mb']
+        if error is not None:
+            result['error'] = error
+        results.append(result)
+        if error is not None:
+            break
+
+    if chrome_trace is not None:
+        tracer.to_chrome_trace(chrome_trace)
+    return results
+
+def measure_pipeline(data_dir: str, n_workers: int = 1, compact: bool = False, cohort: bool = False, embeddings: bool = False, trace_memory: bool = False, chrome_trace: str = None) -> list[dict]:
+    # time_pipeline_stages in a fresh interpreter, so caches, imports and peak memory start from scratch
+    args = [sys.executable, '-m', 'helpers.benchmark', 'pipeline-run', data_dir, '--n-workers', str(n_workers)]
+    args += [flag for flag, on in [('--compact', compact), ('--cohort', cohort), ('--embeddings', embeddings), ('--trace-memory', trace_memory)] if on]
+    if chrome_trace is not None:
+        args += ['--chrome-trace', os.path.abspath(chrome_trace)]
+    out = subprocess.run(args, cwd=ANALYSIS_DIR, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def run_pipeline_benchmark(scales=PIPELINE_SCALES, base_users: int = BASE_COHORT_USERS, work_dir: str = None, seed: int = 0, trace_dir: str = None, **options) -> list[dict]:
+    """
+    Benchmarks the final_data_prep stages on synthetic studies of base_users * scale users. The studies are
+    generated in work_dir (and reused by later runs with the same size and seed).
+
+    Args:
+        scales (tuple, optional): The cohort sizes as multiples of base_users. Defaults to PIPELINE_SCALES.
+        base_users (int, optional): The number of users at scale 1. Defaults to BASE_COHORT_USERS.
+        work_dir (str, optional): Where the studies are generated. Defaults to a directory in the system's temp dir.
+        seed (int, optional): The seed of the synthetic studies. Defaults to 0.
+        trace_dir (str, optional): If given, the Chrome trace of each scale is written to {trace_dir}/users-{n}.trace.json.
+        **options: Passed to time_pipeline_stages (n_workers, compact, cohort, embeddings, trace_memory).
+
+    Returns:
+        list[dict]: One result per scale and stage, with throughput in users and events per second.
+    """
+    import helpers.synthetic as synthetic
+
+    work_dir = work_dir or os.path.join(tempfile.gettempdir(), 'helpers-benchmark')
+    results = []
+    for scale in scales:
+        n_users = base_users * scale
+        data_dir = f'{work_dir}/users-{n_users}-seed-{seed}'
+        manifest = f'{data_dir}/synthetic.json'
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                study = json.load(f)
+        else:
+            study = synthetic.generate_study(data_dir, n_users=n_users, seed=seed)
+
+        chrome_trace = None
+        if trace_dir is not None:
+            os.makedirs(trace_dir, exist_ok=True)
+            chrome_trace = f'{trace_dir}/users-{n_users}.trace.json'
+        for stage in measure_pipeline(data_dir, chrome_trace=chrome_trace, **options):
+            seconds = stage['seconds']
+            results.append({
+                'scale': scale, 'users': n_users, 'events': study['events'], **stage,
+                'users_per_second': n_users / seconds if seconds > 0 else None,
+                'events_per_second': study['events'] / seconds if seconds > 0 else None,
+            })
+    return results
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float = 1.5, min_seconds: float = 0.05) -> list[dict]:
+    # The (scale, stage) pairs that got slower than tolerance times their time in baseline (an earlier --json output).
+    # Slowdowns of less than min_seconds are timer noise and ignored.
+    baseline_seconds = {(r['scale'], r['stage']): r['seconds'] for r in baseline if 'error' not in r}
+    regressions = []
+    for r in results:
+        before = baseline_seconds.get((r['scale'], r['stage']))
+        if before is not None and r['seconds'] > tolerance * before and r['seconds'] - before > min_seconds:
+            regressions.append({'scale': r['scale'], 'stage': r['stage'], 'seconds': r['seconds'], 'baseline_seconds': before})
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for the analysis helpers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    imports = subparsers.add_parser('imports', help="Check cold import times against their budgets")
+    imports.add_argument('modules', nargs='*', help="Modules to check (defaults to all modules with a budget)")
+    imports.add_argument('--repeats', type=int, default=5)
+    imports.add_argument('--scale', type=float, default=1.0, help="Multiply all budgets, e.g., on slow machines")
+    imports.add_argument('--json', action='store_true', help="Print the results as JSON")
+
+    pipeline_options = argparse.ArgumentParser(add_help=False)
+    pipeline_options.add_argument('--n-workers', type=int, default=1)
+    pipeline_options.add_argument('--compact', action='store_true')
+    pipeline_options.add_argument('--cohort', action='store_true')
+    pipeline_options.add_argument('--embeddings', action='store_true', help="Include the embeddings stage (calls the embeddings API for uncached essays)")
+    pipeline_options.add_argument('--trace-memory', action='store_true', help="Also measure the peak Python heap per stage (slower)")
+    pipeline = subparsers.add_parser('pipeline', parents=[pipeline_options], help="Time the final_data_prep stages on synthetic studies")
+    pipeline.add_argument('--scales', type=int, nargs='+', default=list(PIPELINE_SCALES))
+    pipeline.add_argument('--base-users', type=int, default=BASE_COHORT_USERS, help="Users at scale 1")
+    pipeline.add_argument('--work-dir', help="Where to generate the studies (reused across runs)")
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--trace-dir', help="Write a Chrome trace (stages, users and steps) per scale to this directory")
+    pipeline.add_argument('--baseline', help="Results of an earlier run (--json) to check for regressions")
+    pipeline.add_argument('--tolerance', type=float, default=1.5, help="Allowed slowdown relative to the baseline")
+    pipeline.add_argument('--json', action='store_true', help="Print the results as JSON")
+    pipeline_run = subparsers.add_parser('pipeline-run', parents=[pipeline_options], help="Time the stages on one study (used by pipeline)")
+    pipeline_run.add_argument('data_dir')
+    pipeline_run.add_argument('--chrome-trace')
+    args = parser.parse_args(argv)
+
+    if args.command == 'imports':
+        modules = args.modules or list(IMPORT_TIME_BUDGETS)
+        budgets = {module: IMPORT_TIME_BUDGETS.get(module, 0.5) * args.scale for module in modules}
+        results = check_import_times(budgets, args.repeats)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for r in results:
+                heavy = f" (loaded {', '.join(r['heavy_modules_loaded'])})" if r['heavy_modules_loaded'] else ''
+                print(f"{'OK  ' if r['ok'] else 'FAIL'} {r['module']:<22} {r['seconds'] * 1000:7.1f} ms / {r['budget'] * 1000:.0f} ms{heavy}")
+        return 0 if all(r['ok'] for r in results) else 1
+
+    options = {'n_workers': args.n_workers, 'compact': args.compact, 'cohort': args.cohort, 'embeddings': args.embeddings, 'trace_memory': args.trace_memory}
+    if args.command == 'pipeline-run':
+        print(json.dumps(time_pipeline_stages(args.data_dir, chrome_trace=args.chrome_trace, **options)))
+        return 0
+
+    import helpers.tokens as tokens
+    try:
+        tokens.check_tokenizer_resources()
+    except LookupError as e:
+        print(f"The ttr stage needs nltk's tokenizer data: {e}", file=sys.stderr)
+        return 1
+    results = run_pipeline_benchmark(args.scales, args.base_users, args.work_dir, args.seed, args.trace_dir, **options)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'users':>8} {'stage':<16} {'seconds':>9} {'users/s':>10} {'events/s':>11} {'max RSS':>9}")
+        for r in results:
+            line = f"{r['users']:>8} {r['stage']:<16} {r['seconds']:>9.3f} {r['users_per_second'] or 0:>10.0f} {r['events_per_second'] or 0:>11.0f} {r['max_rss_mb']:>6.0f} MB"
+            if 'peak_memory_mb' in r:
+                line += f" (heap peak {r['peak_memory_mb']:.0f} MB)"
+            print(line + (f"  FAILED: {' '.join(r['error'].split())[:200]}" if 'error' in r else ''))
+        for r in regressions:
+            print(f"REGRESSION {r['stage']} at scale {r['scale']}: {r['seconds']:.3f} s vs {r['baseline_seconds']:.3f} s")
+    failed = any('error' in r for r in results)
+    return 1 if regressions or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
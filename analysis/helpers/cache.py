@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+from concurrent.futures import Future
+
+# Content-addressed cache for LLM and embedding responses, stored in a single SQLite file.
+# Entries are keyed by a hash of (model, prompt/schema, input text), so the same request is only
+# ever sent once, no matter which user, task or notebook asks for it.
+
+DEFAULT_CACHE_PATH = 'data/cache/responses.sqlite'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+ACCESS_FLUSH_SIZE = 1000
+
+def make_cache_key(model: str, prompt: str, text: str) -> str:
+    """
+    Builds the cache key of a request.
+
+    Args:
+        model (str): The model or deployment name.
+        prompt (str): Everything besides the input that determines the response (prompt template, schema, parameters).
+        text (str): The input text.
+
+    Returns:
+        str: A hex SHA-256 digest.
+    """
+    return hashlib.sha256(json.dumps([model, prompt, text]).encode('utf-8', 'surrogatepass')).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite-backed response cache. Values are stored as JSON. Safe to share between threads:
+    concurrent get_or_compute calls for the same key run the computation only once.
+    With max_bytes set, the least recently used entries are evicted when the cache grows larger. Entries
+    written or read since the cache was opened are never evicted, so max_bytes can be exceeded by a
+    single run that needs more. Access times are kept in memory and written in batches of ACCESS_FLUSH_SIZE
+    (and on eviction and close), so lookups don't write to the database.
+    """
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.accessed = {} # key -> last access time not written to the database yet
+        self.opened_at = time.time()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self.conn.commit()
+        self.total_size = self._stored_size()
+
+    def _stored_size(self) -> int:
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _flush_access_times(self):
+        # Writes the buffered access times (caller holds the lock)
+        if self.accessed:
+            self.conn.executemany('UPDATE responses SET last_access = ? WHERE key = ?', [(t, key) for key, t in self.accessed.items()])
+            self.conn.commit()
+            self.accessed.clear()
+
+    def get(self, key: str):
+        # Returns the cached value, or None if the key is not cached
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict:
+        # Bulk lookup. Returns a dict with the keys that are cached.
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500): # stay below SQLite's limit on query parameters
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f'SELECT key, value FROM responses WHERE key IN ({placeholders})', chunk).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            now = time.time()
+            self.accessed.update((key, now) for key in found)
+            if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_access_times()
+        return found
+
+    def contains_many(self, keys: list[str]) -> set:
+        # The keys that are cached (without reading their values)
+        keys = list(dict.fromkeys(keys))
+        found = set()
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(key for (key,) in self.conn.execute(f'SELECT key FROM responses WHERE key IN ({placeholders})', chunk))
+            now = time.time()
+            self.accessed.update((key, now) for key in found)
+            if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_access_times()
+        return found
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def set_many(self, items: dict):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        with self.lock:
+            # Sizes of the entries that are replaced, to keep the running total
+            replaced = 0
+            for i in range(0, len(rows), 500):
+                chunk = [row[0] for row in rows[i:i + 500]]
+                placeholders = ','.join('?' * len(chunk))
+                replaced += self.conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM responses WHERE key IN ({placeholders})', chunk).fetchone()[0]
+            self.conn.executemany('INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)', rows)
+            self.conn.commit()
+            self.total_size += sum(row[2] for row in rows) - replaced
+            if self.max_bytes is not None and self.total_size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Deletes least recently used entries until the cache is at 90% of max_bytes (caller holds the lock).
+        Entries accessed since the cache was opened are kept.
+        """
+        self._flush_access_times()
+        self.total_size = self._stored_size() # other processes may have written to the file
+        if self.total_size <= self.max_bytes:
+            return
+        target = self.total_size - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM responses WHERE last_access < ? ORDER BY last_access', (self.opened_at,)):
+            keys.append(key)
+            freed += size
+            if freed >= target:
+                break
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', [(key,) for key in keys])
+        self.conn.commit()
+        self.total_size -= freed
+
+    def get_or_compute(self, key: str, compute):
+        """
+        Returns the cached value for key, or calls compute(), caches and returns its result. If another
+        thread is already computing the same key, waits for its result instead of computing it again.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            # Another owner may have stored the value between the lookup above and registering
+            value = self.get(key)
+            if value is None:
+                value = compute()
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self._flush_access_times()
+        self.conn.close()
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache(path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES) -> ResponseCache:
+    # The cache shared by all helpers (one connection per path and process)
+    return ResponseCache(path, max_bytes)
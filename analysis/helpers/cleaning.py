@@ -1,10 +1,67 @@
-import pandas as pd
-from bs4 import BeautifulSoup
+from __future__ import annotations
+import re
+import json
+import hashlib
+import numpy as np
+from helpers._lazy import lazy_import
 import helpers.constants as constants
 
+pd = lazy_import('pandas')
+bs4 = lazy_import('bs4')
+
+# Well-formed start/end tags with (optionally quoted) attributes, as produced by the contentEditable editor
+_TAG_RE = re.compile(r'''</?[a-zA-Z][a-zA-Z0-9]*(?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*\s*/?>''')
+_ENTITY_RE = re.compile(r'&(?:nbsp|amp|lt|gt|quot|#39|#160);')
+_ENTITIES = {'&nbsp;': '\xa0', '&amp;': '&', '&lt;': '<', '&gt;': '>', '&quot;': '"', '&#39;': "'", '&#160;': '\xa0'}
+# Markup whose text handling in html.parser/BeautifulSoup is not reproduced by the fast path
+_UNSUPPORTED_MARKUP = ('<!', '<?', '<script', '<style', '<template', '<pre', '<textarea', '<plaintext', '<xmp', '<listing')
+_ASCII_SPACES = str.maketrans('', '', '\x20\x0a\x09\x0c\x0d')
+
+_html_text_cache = {}
+HTML_TEXT_CACHE_SIZE = 100_000
+
+def _extract_text_from_html_bs4(html_str: str) -> str:
+    soup = bs4.BeautifulSoup(html_str, features="html.parser")
+    text = soup.get_text(separator=' ')
+    text = text.replace('\xa0', ' ')
+    
+    return text
+
+def _extract_text_from_html_fast(html_str: str):
+    # Single regex pass over the tags. Returns None if the HTML contains anything that the fast path
+    # does not handle exactly like BeautifulSoup (comments, raw-text elements, unknown entities, stray '<').
+    lowered = html_str.lower()
+    if any(markup in lowered for markup in _UNSUPPORTED_MARKUP):
+        return None
+
+    strings = []
+    pos = 0
+    for match in _TAG_RE.finditer(html_str):
+        if match.start() > pos:
+            strings.append(html_str[pos:match.start()])
+        pos = match.end()
+    if pos < len(html_str):
+        strings.append(html_str[pos:])
+
+    for i, string in enumerate(strings):
+        if '<' in string:
+            return None
+        if '&' in string:
+            if '&' in _ENTITY_RE.sub('', string):
+                return None
+            string = _ENTITY_RE.sub(lambda m: _ENTITIES[m.group(0)], string)
+        # BeautifulSoup collapses whitespace-only strings to a single newline or space
+        if string.translate(_ASCII_SPACES) == '':
+            string = '\n' if '\n' in string else ' '
+        strings[i] = string
+
+    return ' '.join(strings).replace('\xa0', ' ')
+
 def extract_text_from_html(html_str: str) -> str:
     """
     Removes HTML tags from the given HTML string and returns the cleaned text.
+    Identical to BeautifulSoup's get_text(separator=' ') (with non-breaking spaces replaced), but uses
+    a regex tag-stripper for editor HTML and memoizes results by content hash.
 
     Args:
         html_str (str): The HTML string to remove tags from.
@@ -12,12 +69,28 @@ def extract_text_from_html(html_str: str) -> str:
     Returns:
         str: The cleaned text without HTML tags.
     """
-    soup = BeautifulSoup(html_str, features="html.parser")
-    text = soup.get_text(separator=' ')
-    text = text.replace('\xa0', ' ')
+    key = hashlib.blake2b(html_str.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    text = _html_text_cache.get(key)
+    if text is not None:
+        return text
+
+    text = _extract_text_from_html_fast(html_str)
+    if text is None:
+        text = _extract_text_from_html_bs4(html_str)
+
+    if len(_html_text_cache) >= HTML_TEXT_CACHE_SIZE:
+        _html_text_cache.clear()
+    _html_text_cache[key] = text
     
     return text
 
+def extract_text_from_html_batch(html_strs) -> list[str]:
+    """
+    Batch version of extract_text_from_html for a column of HTML strings. Repeated HTML (e.g., double-clicked
+    task_completed events) is only processed once.
+    """
+    return [extract_text_from_html(html_str) for html_str in html_strs]
+
 def create_events_df(events: list[dict]):
     """
     Creates a pandas DataFrame from a list of event dictionaries.
@@ -29,17 +102,117 @@ def create_events_df(events: list[dict]):
         pandas.DataFrame: A DataFrame containing the event data.
     """
     df = pd.DataFrame(events)
-    del df['timestampStr']
+    df = df.drop(columns=['timestampStr'], errors='ignore') # projected events (see eventjson.project_events) don't have it
     df = df.sort_values('timestamp')
 
     return df
 
-def create_task_df_for_user(events_df: pd.DataFrame):
+def find_double_click_violations(events_df: pd.DataFrame, by: str = 'user_id') -> pd.DataFrame:
+    """
+    Validates the double-clicked task_completed events of one or many users at once, with the check of the
+    original per-user loop: the duplicated task_completed events (identical details to an earlier one of
+    the same user) are taken in time order, and no other event of that user may fall strictly between two
+    consecutive duplicates of the same task. The events between each pair are counted with searchsorted
+    over the timestamps, sorted per user.
+
+    Args:
+        events_df (pd.DataFrame): Events with eventName, timestamp and eventDetails (e.g., the concatenated events_df).
+        by (str, optional): The column identifying the user. Defaults to 'user_id'; if the column
+            doesn't exist, all events are treated as one user.
+
+    Returns:
+        pd.DataFrame: One row per violating pair: the user (if by exists), taskId, the timestamps of the
+        two duplicates, and the number of events between them. Empty if all double clicks are clean.
+    """
+    has_users = by is not None and by in events_df.columns
+    codes, users = pd.factorize(events_df[by]) if has_users else (np.zeros(len(events_df), dtype=np.int64), np.array([None]))
+    codes = codes.astype(np.int64)
+    timestamps = events_df['timestamp'].to_numpy(dtype=np.int64)
+    columns = ([by] if has_users else []) + ['taskId', 'time_first', 'time_duplicate', 'n_events_between']
+    if len(events_df) == 0:
+        return pd.DataFrame(columns=columns)
+
+    completed = (events_df['eventName'] == 'task_completed').to_numpy()
+    details = events_df['eventDetails'].to_numpy()[completed]
+    dftt = pd.DataFrame({
+        'code': codes[completed],
+        'timestamp': timestamps[completed],
+        'taskId': [d.get('taskId') for d in details],
+        'details': [json.dumps(d, sort_keys=True) for d in details],
+    }).sort_values(['code', 'timestamp'], kind='stable')
+
+    # Pair each duplicate with the next duplicate of the same user, if it is of the same task
+    duplicates = dftt[dftt.duplicated(['code', 'details'])]
+    dup_codes, dup_tasks = duplicates['code'].to_numpy(), duplicates['taskId'].to_numpy()
+    consecutive = (dup_codes[1:] == dup_codes[:-1]) & (dup_tasks[1:] == dup_tasks[:-1])
+    pairs = duplicates.iloc[1:][consecutive].copy()
+    pairs['time_first'] = duplicates['timestamp'].to_numpy()[:-1][consecutive]
+
+    # Events sorted by (user, timestamp) as a single int64 key, so all pairs are counted with two searchsorted calls
+    t_min = timestamps.min()
+    span = int(timestamps.max() - t_min) + 1
+    if len(users) * span >= 2 ** 62:
+        raise ValueError("Timestamp range too large to validate all users at once")
+    keys = np.sort(codes * span + (timestamps - t_min))
+    pair_codes = pairs['code'].to_numpy()
+    lo = np.searchsorted(keys, pair_codes * span + (pairs['time_first'].to_numpy(dtype=np.int64) - t_min), side='right')
+    hi = np.searchsorted(keys, pair_codes * span + (pairs['timestamp'].to_numpy() - t_min), side='left')
+
+    report = pd.DataFrame({
+        'taskId': pairs['taskId'].to_numpy(),
+        'time_first': pairs['time_first'].to_numpy(dtype=np.int64),
+        'time_duplicate': pairs['timestamp'].to_numpy(),
+        'n_events_between': np.maximum(hi - lo, 0),
+    }, columns=columns[-4:])
+    if has_users:
+        report.insert(0, by, users[pair_codes])
+    return report[report['n_events_between'] > 0].reset_index(drop=True)
+
+def check_double_clicks(events_df: pd.DataFrame, by: str = 'user_id', raise_error: bool = False) -> pd.DataFrame:
+    # Prints a warning listing the violations found by find_double_click_violations and returns them, or
+    # raises a ValueError with raise_error=True
+    violations = find_double_click_violations(events_df, by)
+    if len(violations) > 0:
+        message = f"Found events between double-clicked task_completed events:\n{violations.to_string()}"
+        if raise_error:
+            raise ValueError(message)
+        print(f"Warning: {message}")
+    return violations
+
+# Column order of tasks_df and suggestions_df, the same for every user and for the per-user and cohort
+# builders. Columns not listed (the task metrics, and any other event fields) follow in the order they were
+# added, and the user comes last, as in the per-user frames of treatment users.
+TASK_COLUMNS = ['time_started', 'prompt', 'minWords', 'time_completed', 'finalHtml', 'finalHtml_stripped', 'duration_s', 'charLength']
+SUGGESTION_COLUMNS = ['suggestionText', 'leadingText', 'currentHtml', 'time_shown', 'time_acc/rej', 'is_accepted', 'rejection_reason', 'task_id']
+
+def order_columns(df: pd.DataFrame, columns: list, last: list = ()) -> pd.DataFrame:
+    # The listed columns that exist first, then the others in their current order, then the last ones
+    first = [c for c in columns if c in df.columns and c not in last]
+    rest = [c for c in df.columns if c not in first and c not in last]
+    return df[first + rest + [c for c in last if c in df.columns]]
+
+def drop_non_writing_tasks(tasks_df: pd.DataFrame, user_ids, by: str = 'user_id') -> pd.DataFrame:
+    """
+    Drops the attention check and the tutorial (treatment users only) from tasks_df.
+
+    Raises:
+        KeyError: If a user in user_ids has no attention check (e.g., their events are incomplete).
+    """
+    checked = set(tasks_df.loc[tasks_df.index == 'attention_check', by])
+    missing = [user_id for user_id in user_ids if user_id not in checked]
+    if len(missing) > 0:
+        raise KeyError(f"No attention_check task for users {missing}")
+    return tasks_df[~tasks_df.index.isin(['attention_check', 'tutorial'])]
+
+def create_task_df_for_user(events_df: pd.DataFrame, validate: bool = True):
     """
     Create a task DataFrame for a user based on event data.
 
     Args:
         event_df (pd.DataFrame): The DataFrame containing event data.
+        validate (bool, optional): Whether to check that no events happened between double-clicked
+            task_completed events (see find_double_click_violations). Violations are printed (see
+            check_double_clicks). Defaults to True.
 
     Returns:
         pd.DataFrame: The task DataFrame for the user.
@@ -61,15 +234,8 @@ def create_task_df_for_user(events_df: pd.DataFrame):
     dftt = pd.concat([dftt.drop(columns=['eventDetails']), pd.json_normalize(dftt['eventDetails'])], axis=1)
 
     # Ensure that there is no other event happened between the duplicated clicks – crazy sanity check to confirm that this was indeed just a double click when the user was waiting
-    duplicated_rows = dftt[dftt.duplicated(subset=dftt.drop(columns=['timestamp']).columns)].reset_index(drop=True)
-    for i, row in duplicated_rows.iterrows():
-        if row['taskId'] != duplicated_rows.loc[i+1, 'taskId']:
-            continue
-        timestamp1 = row['timestamp']
-        timestamp2 = duplicated_rows.loc[i+1, 'timestamp']
-        assert len(events_df[ (events_df['timestamp'] > timestamp1) & (events_df['timestamp'] < timestamp2)]) == 0
-        if i == len(duplicated_rows) - 2:
-            break
+    if validate:
+        check_double_clicks(events_df, by=None)
     # Drop the duplicates due to double-clicking
     dftt = dftt.drop_duplicates(subset=dftt.drop(columns=['timestamp']).columns, keep='first').reset_index(drop=True)
     dftt = dftt.rename(columns={'timestamp': 'time_completed'}).set_index('taskId')
@@ -77,7 +243,7 @@ def create_task_df_for_user(events_df: pd.DataFrame):
     dft = dft.join(dftt)
 
     # Just some minor post-processing to calculate the task duration and the character length of the final HTML
-    dft['finalHtml_stripped'] = dft['finalHtml'].apply(lambda x: extract_text_from_html(x))
+    dft['finalHtml_stripped'] = extract_text_from_html_batch(dft['finalHtml'])
     dft['duration_s'] = (dft['time_completed'] - dft['time_started'])/1000
     dft['charLength'] = dft['finalHtml_stripped'].apply(lambda x: len(x))
     
@@ -141,11 +307,11 @@ def create_suggestions_df_for_user(events_df: pd.DataFrame, tasks_df: pd.DataFra
     df_shown = df_shown.join(df_accepted_rejected)
 
     # For each suggestion, compute which task it was for
-    df_shown['task_id'] = df_shown['time_shown'].apply(lambda x: find_task_id_for_suggestion(x, tasks_df))
+    df_shown['task_id'] = find_task_ids_for_suggestions(df_shown, tasks_df)
     print(f"Removing erroneous suggestions: {len(df_shown[df_shown.isnull().any(axis=1)])}/{len(df_shown)}")
     df_shown = df_shown.dropna()
 
-    return df_shown
+    return order_columns(df_shown, SUGGESTION_COLUMNS)
 
 def find_task_id_for_suggestion(suggestion_time, tasks_df):
     """
@@ -164,6 +330,235 @@ def find_task_id_for_suggestion(suggestion_time, tasks_df):
         return task.index[0]
     return None
 
+def _find_interval_positions(times: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # For each time, returns the position of the first interval [start, end] containing it (-1 if none).
+    # Requires the intervals to be sorted by start. The intervals with start <= t form a prefix of
+    # length k; the first interval with end >= t is where the running maximum of the ends first
+    # reaches t. That interval contains t if it lies within the prefix.
+    if len(starts) == 0:
+        return np.full(len(times), -1)
+
+    ends = np.where(np.isnan(ends), -np.inf, ends) # unfinished tasks never match
+    running_max_end = np.maximum.accumulate(ends)
+    k = np.searchsorted(starts, times, side='right')
+    first = np.searchsorted(running_max_end, times, side='left')
+
+    return np.where(first < k, first, -1)
+
+def find_task_ids_for_suggestions(suggestions_df: pd.DataFrame, tasks_df: pd.DataFrame, time_col: str = 'time_shown', by: str = None) -> pd.Series:
+    """
+    Vectorized version of find_task_id_for_suggestion for all suggestions at once. Each suggestion
+    is assigned to the first task (in tasks_df order) whose [time_started, time_completed] interval
+    contains its time.
+
+    Parameters:
+    - suggestions_df (DataFrame): The suggestions, with the time in time_col.
+    - tasks_df (DataFrame): The tasks (indexed by task id) with time_started and time_completed.
+    - time_col (str): The column of suggestions_df to match against the task intervals.
+    - by (str): Optional column present in both frames (e.g., 'user_id') to match within,
+      so suggestions of all users can be assigned in one call.
+
+    Returns:
+    - Series: The task ID for each suggestion (None if not found), aligned with suggestions_df.
+    """
+    task_ids = np.full(len(suggestions_df), None, dtype=object)
+    times = suggestions_df[time_col].to_numpy(dtype=float)
+    starts = tasks_df['time_started'].to_numpy(dtype=float)
+    ends = tasks_df['time_completed'].to_numpy(dtype=float)
+    labels = tasks_df.index.to_numpy()
+
+    if by is None:
+        groups = [(np.arange(len(suggestions_df)), np.arange(len(tasks_df)))]
+    else:
+        task_groups = tasks_df.groupby(by, sort=False).indices
+        groups = [
+            (suggestion_positions, task_groups[key])
+            for key, suggestion_positions in suggestions_df.groupby(by, sort=False).indices.items()
+            if key in task_groups
+        ]
+
+    for suggestion_positions, task_positions in groups:
+        group_starts = starts[task_positions]
+        if np.any(np.diff(group_starts) < 0):
+            # Tasks are not in start order: fall back to the row-wise lookup to keep "first task in order" semantics
+            group_tasks = tasks_df.iloc[task_positions]
+            task_ids[suggestion_positions] = [find_task_id_for_suggestion(t, group_tasks) for t in times[suggestion_positions]]
+            continue
+
+        positions = _find_interval_positions(times[suggestion_positions], group_starts, ends[task_positions])
+        found = positions >= 0
+        task_ids[suggestion_positions[found]] = labels[task_positions[positions[found]]]
+
+    return pd.Series(task_ids, index=suggestions_df.index, dtype=object)
+
+# Cohort-level builders (construct_dfs_for_analysis(cohort=True)): the same tables as create_task_df_for_user
+# and create_suggestions_df_for_user, built from the concatenated events of all users with a handful of
+# vectorized operations instead of a few dozen small ones per user.
+
+def _events_of_type_by_user(events_df: pd.DataFrame, event_name: str, by: str, user_codes: np.ndarray, sort_by_time: bool) -> pd.DataFrame:
+    # The events of one type, grouped by user (in order of first appearance) and optionally sorted by time within each user
+    mask = (events_df['eventName'] == event_name).to_numpy()
+    codes = user_codes[mask]
+    df = events_df[mask]
+    order = np.lexsort((df['timestamp'].to_numpy(), codes)) if sort_by_time else np.argsort(codes, kind='stable')
+    return df.iloc[order].reset_index(drop=True)
+
+def _normalize_event_details(df: pd.DataFrame, details: list) -> pd.DataFrame:
+    # The events without eventDetails, with the fields of the given details dicts as columns
+    return pd.concat([df.drop(columns=['eventDetails']), pd.json_normalize(details)], axis=1)
+
+def create_task_df_for_cohort(events_df: pd.DataFrame, by: str = 'user_id', validate: bool = True) -> pd.DataFrame:
+    """
+    Cohort-level create_task_df_for_user: creates the task DataFrame of all users at once.
+
+    Args:
+        events_df (pd.DataFrame): The concatenated events of all users, with the user in column by.
+        by (str, optional): The column identifying the user. Defaults to 'user_id'.
+        validate (bool, optional): Whether to check the double-clicked task_completed events of all users
+            (see find_double_click_violations). Violations are printed (see
+            check_double_clicks). Defaults to True.
+
+    Returns:
+        pd.DataFrame: The task DataFrame (indexed by task id), with the rows of each user in the same order as
+        create_task_df_for_user and the user in column by.
+    """
+    user_codes = pd.factorize(events_df[by])[0]
+
+    # Task details from the "task_started" events; duplicates are dropped per (user, task details)
+    dft = _events_of_type_by_user(events_df, 'task_started', by, user_codes, sort_by_time=True)
+    dft = _normalize_event_details(dft, [details['task'] for details in dft['eventDetails']])
+    dft = dft.drop_duplicates(subset=dft.drop(columns=['timestamp']).columns, keep='first')
+    dft = dft.drop(columns=['completed', 'eventName']).rename(columns={'timestamp': 'time_started'})
+
+    # Final task details from the "task_completed" events, without the double clicks
+    dftt = _events_of_type_by_user(events_df, 'task_completed', by, user_codes, sort_by_time=True).drop(columns=['eventName'])
+    dftt = _normalize_event_details(dftt, list(dftt['eventDetails']))
+    if validate:
+        check_double_clicks(events_df, by)
+    dftt = dftt.drop_duplicates(subset=dftt.drop(columns=['timestamp']).columns, keep='first')
+    dftt = dftt.rename(columns={'timestamp': 'time_completed', 'taskId': 'id'})
+
+    # One join for all users (a left merge keeps the order of dft, like the per-user index join)
+    dft = dft.merge(dftt, on=[by, 'id'], how='left', sort=False).set_index('id')
+
+    dft['finalHtml_stripped'] = extract_text_from_html_batch(dft['finalHtml'])
+    dft['duration_s'] = (dft['time_completed'] - dft['time_started'])/1000
+    dft['charLength'] = dft['finalHtml_stripped'].str.len()
+    dft[by] = dft.pop(by)
+
+    return dft
+
+def _unravel_suggestion_events(events_df: pd.DataFrame, event_name: str, by: str, user_codes: np.ndarray, ts_col: str) -> pd.DataFrame:
+    # Cohort-level unravel_suggestion_details_from_json: the event timestamp is kept as ts_col
+    df = _events_of_type_by_user(events_df, event_name, by, user_codes, sort_by_time=False)
+    details = pd.json_normalize(list(df['eventDetails']))
+    details = details.drop(columns=['timestamp'], errors='ignore')
+    details[ts_col] = df['timestamp'].to_numpy()
+    details[by] = df[by].to_numpy()
+    return details
+
+def create_suggestions_df_for_cohort(events_df: pd.DataFrame, tasks_df: pd.DataFrame, by: str = 'user_id') -> pd.DataFrame:
+    """
+    Cohort-level create_suggestions_df_for_user: creates the suggestions DataFrame of all users at once.
+
+    Args:
+        events_df (pd.DataFrame): The concatenated events of the users with suggestions, with the user in column by.
+        tasks_df (pd.DataFrame): The tasks of these users (see create_task_df_for_cohort).
+        by (str, optional): The column identifying the user. Defaults to 'user_id'.
+
+    Returns:
+        pd.DataFrame: The suggestions (indexed by suggestionId) of all users, with the task_id and the user in column by.
+    """
+    user_codes = pd.factorize(events_df[by])[0]
+    if not (events_df['eventName'] == 'suggestion_shown').any():
+        return pd.DataFrame()
+
+    df_shown = _unravel_suggestion_events(events_df, 'suggestion_shown', by, user_codes, 'time_shown')
+
+    df_accepted = _unravel_suggestion_events(events_df, 'suggestion_accepted', by, user_codes, 'time_acc/rej')
+    df_accepted['is_accepted'] = True
+    df_rejected = _unravel_suggestion_events(events_df, 'suggestion_rejected', by, user_codes, 'time_acc/rej')
+    df_rejected = df_rejected.rename(columns={'reason': 'rejection_reason'})
+    df_rejected['is_accepted'] = False
+
+    df_accepted_rejected = pd.concat([df_accepted, df_rejected], ignore_index=True)
+    df_accepted_rejected['is_accepted'] = df_accepted_rejected['is_accepted'].astype('boolean').fillna(False)
+    df_accepted_rejected['rejection_reason'] = df_accepted_rejected['rejection_reason'].fillna('')
+
+    # One join for all users; suggestion ids are matched within each user
+    df_shown = df_shown.merge(df_accepted_rejected, on=[by, 'suggestionId'], how='left', sort=False).set_index('suggestionId')
+
+    df_shown['task_id'] = find_task_ids_for_suggestions(df_shown, tasks_df, by=by)
+    print(f"Removing erroneous suggestions: {df_shown.isnull().any(axis=1).sum()}/{len(df_shown)}")
+    df_shown = df_shown.dropna()
+
+    return order_columns(df_shown, SUGGESTION_COLUMNS, last=[by])
+
+# Compact schema (construct_dfs_for_analysis(compact=True)): repeated strings become categoricals, free text
+# becomes Arrow-backed strings, and the eventDetails dicts of events_df are replaced by the few fields the
+# analysis needs (the same fields the event store keeps as columns, see helpers.eventstore).
+SUGGESTION_CATEGORICAL_COLUMNS = ['task_id', 'user_id', 'rejection_reason']
+SUGGESTION_TEXT_COLUMNS = ['suggestionText', 'leadingText', 'currentHtml']
+
+def compact_events_df(events_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compact version of an events DataFrame: categorical eventName and user_id, int64 millisecond timestamps,
+    and the eventDetails fields flattened into typed columns (task_id, suggestionId, rejection_reason,
+    showSuggestions). The raw eventDetails dicts (including the HTML snapshots) are dropped.
+    """
+    task_ids, suggestion_ids, reasons, show_suggestions = [], [], [], []
+    for details in events_df['eventDetails']:
+        details = details if isinstance(details, dict) else {}
+        task = details.get('task') or {}
+        user = details.get('user') or {}
+        task_ids.append(details.get('taskId', task.get('id')))
+        suggestion_ids.append(details.get('suggestionId'))
+        reasons.append(details.get('reason'))
+        show_suggestions.append(user.get('showSuggestions'))
+
+    df = pd.DataFrame({
+        'eventName': pd.Categorical(events_df['eventName']),
+        'timestamp': events_df['timestamp'].to_numpy(dtype=np.int64),
+        'task_id': pd.Categorical(task_ids),
+        'suggestionId': pd.array(suggestion_ids, dtype='string[pyarrow]'),
+        'rejection_reason': pd.Categorical(reasons),
+        'showSuggestions': pd.array(show_suggestions, dtype='boolean'),
+    }, index=events_df.index)
+    if 'user_id' in events_df.columns:
+        df['user_id'] = pd.Categorical(events_df['user_id'])
+
+    return df
+
+def compact_suggestions_df(suggestions_df: pd.DataFrame) -> pd.DataFrame:
+    # Compact version of a suggestions DataFrame: categorical ids/reasons, Arrow-backed text, int64 times
+    df = suggestions_df.copy()
+    for col in SUGGESTION_CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in SUGGESTION_TEXT_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('string[pyarrow]')
+    for col in ['time_shown', 'time_acc/rej']:
+        if col in df.columns:
+            df[col] = df[col].astype(np.int64)
+    df.index = df.index.astype('string[pyarrow]')
+
+    return df
+
+def concat_compact(dfs: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    pd.concat for compact frames. pd.concat turns categoricals with different categories into object
+    columns, so the categorical columns are combined with union_categoricals instead.
+    """
+    columns = list(dict.fromkeys(col for d in dfs for col in d.columns))
+    categorical = [col for col in columns if all(col in d.columns and isinstance(d[col].dtype, pd.CategoricalDtype) for d in dfs)]
+    df = pd.concat([d.drop(columns=categorical) for d in dfs])
+    for col in categorical:
+        # Columns without any value have empty float categories, so align the category dtypes first
+        parts = [d[col].cat.set_categories(d[col].cat.categories.astype(object)) for d in dfs]
+        df[col] = pd.api.types.union_categoricals(parts)
+    return df[columns]
+
 def load_qualtrics_csv(filepath: str) -> pd.DataFrame:
     users_df = pd.read_csv(filepath, index_col='completionCode', header=0)
     users_df = users_df[['StartDate', 'Duration (in seconds)'] + users_df.columns[users_df.columns.str.startswith('Q')].tolist()]
@@ -1,8 +1,16 @@
+from __future__ import annotations
 import os
 import json
-from progressbar import progressbar
-from google.cloud import firestore
-import helpers.constants
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from helpers._lazy import lazy_import
+import helpers.constants as constants
+import helpers.eventjson as eventjson
+
+progressbar = lazy_import('progressbar')
+firestore = lazy_import('google.cloud.firestore')
+
+SYNC_STATE_FILE = '.sync_state'
 
 def hi():
     print("what")
@@ -45,46 +53,159 @@ def get_all_document_ids_in_collection(db: firestore.Client, collection: str):
 
     return doc_ids
 
-def get_events_for_userid(db: firestore.Client, userid: str):
+def get_events_for_userid(db: firestore.Client, userid: str, since: int = None):
     """
     Retrieves a list of events for a given user ID from the Firestore database.
 
     Args:
         db (firestore.Client): The Firestore client instance.
         userid (str): The user ID for which to retrieve the events.
+        since (int, optional): Only retrieve events whose timestamp is >= since (in ms). Defaults to all events.
 
     Returns:
         list: A list of event documents as dictionaries.
     """
-    coll = db.collection(f'users/{userid}/events')
-    docs = coll.list_documents()
-    docs = [doc.get().to_dict() for doc in docs]
+    # Stream the whole collection in a single query instead of fetching each document separately
+    query = db.collection(f'users/{userid}/events')
+    if since is not None:
+        query = query.where(filter=firestore.FieldFilter('timestamp', '>=', since))
+    docs = [doc.to_dict() for doc in query.stream()]
 
     return docs
 
+def write_json_atomic(path: str, obj):
+    """
+    Writes obj as JSON to path. The data is first written to a temporary file in the same directory
+    and then moved into place, so an interrupted download never leaves a truncated file behind.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_firestore_user_id(user_id: str) -> str:
+    # Some Prolific user refreshed the page and started the study again, which gave them a u- code instead of a p- code.
+    # To keep things consistent, we mapped them to their prolific ID.
+    # But the db only knows their original u-code. Here, we map their p-code to their u-code so we can download their data.
+    p2u_mapping = {v: k for k, v in constants.u2p_mapping.items()}
+    return p2u_mapping.get(user_id, user_id)
+
 def download_events_data_for_user(user_id: str, db: firestore.Client, dir: str):
 
     # If data/events/{user_id}.json doesn't exist, create it
     if not os.path.exists(f'{dir}/{user_id}.json'):
+        firestore_user_id = get_firestore_user_id(user_id)
+        events = get_events_for_userid(db, firestore_user_id)
+
+        # Return the user id back to their Prolific one
+        user_id = constants.u2p_mapping.get(firestore_user_id, firestore_user_id)
+        write_json_atomic(f'{dir}/{user_id}.json', events)
+
+def load_sync_state(dir: str) -> dict:
+    # Per-user high-water marks (largest event timestamp already stored locally)
+    path = f'{dir}/{SYNC_STATE_FILE}'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def get_event_key(event: dict) -> str:
+    # Events have no id of their own in the exported files, so the full content identifies them
+    return json.dumps(event, sort_keys=True)
+
+def sync_events_data_for_user(user_id: str, db: firestore.Client, dir: str, watermark: int = None) -> tuple:
+    """
+    Incrementally syncs the events of a user into data/events/{user_id}.json. Only events with a
+    timestamp >= watermark are queried; they are merged into the existing file without duplicates.
+    The watermark itself is re-queried (>=) so events logged within the same millisecond are not lost.
 
-        # Some Prolific user refreshed the page and started the study again, which gave them a u- code instead of a p- code.
-        # To keep things consistent, we mapped them to their prolific ID.
-        # But the db only knows their original u-code. Here, we map their p-code to their u-code so we can download their data.
-        p2u_mapping = {v: k for k, v in constants.u2p_mapping.items()}
-        if user_id in p2u_mapping:
-            user_id = p2u_mapping[user_id]
+    Args:
+        user_id (str): The (Prolific-mapped) user ID.
+        db (firestore.Client): The Firestore client instance.
+        dir (str): The directory with the {user_id}.json files.
+        watermark (int, optional): The user's high-water mark. Defaults to the largest timestamp in the existing file.
+
+    Returns:
+        tuple: The new watermark and the number of events added.
+    """
+    path = f'{dir}/{user_id}.json'
+    if os.path.exists(path):
+        events = load_events_for_user(user_id, dir)
+        if watermark is None and len(events) > 0:
+            watermark = max(event['timestamp'] for event in events)
+    else:
+        events = []
+        watermark = None
 
-        events = get_events_for_userid(db, user_id)
+    new_events = get_events_for_userid(db, get_firestore_user_id(user_id), since=watermark)
 
-        # Return the user id back to their Prolific one
-        if user_id in constants.u2p_mapping:
-            user_id = constants.u2p_mapping[user_id]
-        
-        with open(f'{dir}/{user_id}.json', 'w') as f:
-            json.dump(events, f)
-
-def load_events_for_user(user_id: str, dir: str):
-    with open(f'{dir}/{user_id}.json', 'r') as f:
-        events = json.load(f)
-    return events
+    seen = set(get_event_key(event) for event in events)
+    added = []
+    for event in new_events:
+        key = get_event_key(event)
+        if key not in seen:
+            seen.add(key)
+            added.append(event)
+
+    if len(added) > 0 or not os.path.exists(path):
+        events = events + added
+        write_json_atomic(path, events)
+
+    if len(events) > 0:
+        watermark = max(event['timestamp'] for event in events)
+
+    return watermark, len(added)
+
+def download_events_data_for_users(user_ids: list[str], db: firestore.Client, dir: str, max_workers: int = 16, incremental: bool = False):
+    """
+    Downloads the events of many users concurrently. Each user's collection is streamed in a single
+    query, and up to max_workers users are fetched at the same time. Usage:
+    `dbutils.download_events_data_for_users(user_ids, init_firestore_client(emulator=True), 'data/events')`
+
+    By default, users whose file already exists are skipped, as in download_events_data_for_user.
+    With incremental=True, every user is synced with sync_events_data_for_user instead, starting
+    from the high-water marks stored in {dir}/.sync_state.
+
+    Args:
+        user_ids (list[str]): The (Prolific-mapped) user IDs to download.
+        db (firestore.Client): The Firestore client instance (shared across threads).
+        dir (str): The directory to write the {user_id}.json files to.
+        max_workers (int, optional): Maximum number of concurrent downloads. Defaults to 16.
+        incremental (bool, optional): Whether to sync new events of existing users. Defaults to False.
+
+    Returns:
+        list: With incremental=True, the users that received new events (e.g., to rewrite their partitions
+        with eventstore.write_events_to_store). Otherwise None.
+    """
+    if incremental:
+        state = load_sync_state(dir)
+        task = lambda user_id: sync_events_data_for_user(user_id, db, dir, state.get(user_id))
+    else:
+        task = lambda user_id: download_events_data_for_user(user_id, db, dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(task, user_id): user_id for user_id in user_ids}
+        results = {}
+        for future in progressbar.progressbar(as_completed(futures), max_value=len(futures)):
+            results[futures[future]] = future.result()
+
+    if not incremental:
+        return None
+
+    updated_users = [user_id for user_id in user_ids if results[user_id][1] > 0]
+    for user_id, (watermark, _) in results.items():
+        if watermark is not None:
+            state[user_id] = watermark
+    write_json_atomic(f'{dir}/{SYNC_STATE_FILE}', state)
+
+    return updated_users
+
+def load_events_for_user(user_id: str, dir: str, fields: dict = None, stream: bool = False):
+    # With fields (e.g., eventjson.ANALYSIS_EVENT_FIELDS), only those eventDetails fields are kept per eventName.
+    # With stream=True, the file is parsed incrementally (see eventjson.load_events).
+    return eventjson.load_events(f'{dir}/{user_id}.json', fields=fields, stream=stream)
     
\ No newline at end of file
@@ -0,0 +1,201 @@
+from __future__ import annotations
+import json
+import functools
+import numpy as np
+
+# Fast loading of the event files (data/events/{user_id}.json, a JSON array of events). Files are parsed
+# with orjson if it is installed and the standard library otherwise. With stream=True, a file is read in
+# chunks and decoded one event at a time, so only the current chunk and the projected events are in memory.
+# Projection keeps only the given eventDetails fields per eventName (see ANALYSIS_EVENT_FIELDS) and drops
+# everything else, e.g. timestampStr and the details of events the analysis doesn't look at.
+
+STREAM_CHUNK_SIZE = 1 << 20
+
+# The eventDetails fields used by the analysis (cleaning, metrics and the compact schema). Nested fields
+# are given as dotted paths, e.g., 'user.showSuggestions'.
+ANALYSIS_EVENT_FIELDS = {
+    'task_started': ('task',),
+    'task_completed': ('taskId', 'finalHtml'),
+    'suggestion_shown': ('suggestionId', 'timestamp', 'suggestionText', 'leadingText', 'currentHtml'),
+    'suggestion_accepted': ('suggestionId', 'timestamp'),
+    'suggestion_rejected': ('suggestionId', 'timestamp', 'reason'),
+    'study_started': ('user.showSuggestions',),
+    'study_finished': ('user.showSuggestions',),
+}
+
+_WHITESPACE = ' \t\n\r'
+
+@functools.lru_cache(maxsize=None)
+def get_json_loads():
+    # orjson.loads if orjson is installed (several times faster on large files), otherwise json.loads
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+def iter_json_array(path: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Incrementally parses a file containing a JSON array and yields its elements one at a time.
+    The file is read in chunks of chunk_size characters; an element that spans chunks is decoded
+    once enough of the file has been read.
+
+    Args:
+        path (str): The path of the JSON file.
+        chunk_size (int, optional): The number of characters to read at once. Defaults to STREAM_CHUNK_SIZE.
+
+    Yields:
+        The elements of the array.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf, pos, eof = '', 0, False
+        expect = '[' # '[', then 'first' (an element or ']'), then 'separator' (',' or ']') and 'element' in turns
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {path}")
+                buf, pos = f.read(chunk_size), 0
+                eof = buf == ''
+                continue
+
+            char = buf[pos]
+            if expect == '[':
+                if char != '[':
+                    raise ValueError(f"Expected a JSON array in {path}")
+                pos += 1
+                expect = 'first'
+            elif expect in ('first', 'separator') and char == ']':
+                return
+            elif expect == 'separator':
+                if char != ',':
+                    raise ValueError(f"Expected ',' or ']' between the elements of {path}")
+                pos += 1
+                expect = 'element'
+            else:
+                # An element is only complete once the separator after it has been read: a prefix of a
+                # number (e.g., '12.' of '12.5') also decodes
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    following = end
+                    while following < len(buf) and buf[following] in _WHITESPACE:
+                        following += 1
+                    complete = eof or (following < len(buf) and buf[following] in ',]')
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    complete = False
+                if not complete:
+                    chunk = f.read(max(chunk_size, len(buf) - pos)) # grow geometrically for elements larger than a chunk
+                    eof = chunk == ''
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+                yield value
+                pos = end
+                expect = 'separator'
+
+def _compile_fields(fields: dict) -> dict:
+    # eventName -> list of field paths as tuples
+    return {name: [tuple(field.split('.')) for field in event_fields] for name, event_fields in fields.items()}
+
+def _project_details(details, paths: list[tuple]) -> dict:
+    # Copy of details with only the given (possibly nested) fields; fields that don't exist are left out
+    projected = {}
+    if not isinstance(details, dict):
+        return projected
+    for path in paths:
+        value = details
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    return projected
+
+def project_events(events, fields: dict) -> list[dict]:
+    """
+    Keeps only eventName, timestamp and the given eventDetails fields of each event.
+
+    Args:
+        events (iterable[dict]): The events, e.g., as returned by db.load_events_for_user.
+        fields (dict): eventName -> eventDetails fields to keep (dotted paths for nested fields).
+            Events whose eventName isn't listed keep empty eventDetails.
+
+    Returns:
+        list[dict]: The projected events, in the same order.
+    """
+    paths = _compile_fields(fields)
+    return [
+        {'eventName': event['eventName'], 'timestamp': event['timestamp'], 'eventDetails': _project_details(event.get('eventDetails'), paths.get(event['eventName'], []))}
+        for event in events
+    ]
+
+def load_events(path: str, fields: dict = None, stream: bool = False) -> list[dict]:
+    """
+    Loads an event file.
+
+    Args:
+        path (str): The path of the JSON file.
+        fields (dict, optional): eventName -> eventDetails fields to keep (see project_events). Defaults to
+            None, which returns the events as stored.
+        stream (bool, optional): Whether to parse the file incrementally (see iter_json_array) instead of
+            loading it at once with the fast JSON backend. Defaults to False.
+
+    Returns:
+        list[dict]: The events.
+    """
+    if stream:
+        events = iter_json_array(path)
+    else:
+        with open(path, 'rb') as f:
+            events = get_json_loads()(f.read())
+    if fields is None:
+        return list(events)
+    return project_events(events, fields)
+
+def load_event_columns(path: str, fields: dict = ANALYSIS_EVENT_FIELDS, stream: bool = False) -> dict:
+    """
+    Loads an event file straight into column arrays per eventName, without building projected events or a DataFrame.
+
+    Args:
+        path (str): The path of the JSON file.
+        fields (dict, optional): eventName -> eventDetails fields to load (dotted paths for nested fields).
+            Defaults to ANALYSIS_EVENT_FIELDS.
+        stream (bool, optional): Whether to parse the file incrementally. Defaults to False.
+
+    Returns:
+        dict: eventName -> {'timestamp': int64 array, 'eventDetails.<field>': object array, ...}, with the
+        events in file order. Missing fields are None. Events whose eventName isn't in fields only get timestamps.
+    """
+    paths = _compile_fields(fields)
+    events = iter_json_array(path) if stream else load_events(path)
+
+    columns = {}
+    for event in events:
+        name = event['eventName']
+        event_columns = columns.get(name)
+        if event_columns is None:
+            event_columns = columns[name] = {'timestamp': [], **{'eventDetails.' + '.'.join(p): [] for p in paths.get(name, [])}}
+        event_columns['timestamp'].append(event['timestamp'])
+        details = event.get('eventDetails')
+        for path in paths.get(name, []):
+            value = details
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            event_columns['eventDetails.' + '.'.join(path)].append(value)
+
+    arrays = {}
+    for name, event_columns in columns.items():
+        arrays[name] = {}
+        for column, values in event_columns.items():
+            if column == 'timestamp':
+                arrays[name][column] = np.array(values, dtype=np.int64)
+            else:
+                arrays[name][column] = np.fromiter(values, dtype=object, count=len(values))
+    return arrays
@@ -0,0 +1,208 @@
+import os
+import json
+import shutil
+import fnmatch
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from progressbar import progressbar
+import helpers.eventjson as eventjson
+
+# Partitioned Parquet store for the raw Firestore events. The layout is
+#   {store_dir}/user_id={user_id}/eventName={eventName}/part-0.parquet
+# The common eventDetails fields are kept as typed columns (so they can be projected and filtered
+# without touching the JSON), and the full eventDetails payload is kept as a JSON string so that
+# the original event dicts can be reconstructed exactly.
+
+PARTITION_COLUMNS = ['user_id', 'eventName']
+
+SCHEMA = pa.schema([
+    ('seq', pa.int32()),            # position of the event in the original JSON file
+    ('timestamp', pa.int64()),
+    ('timestampStr', pa.string()),
+    ('taskId', pa.string()),        # eventDetails.taskId, or eventDetails.task.id for task_started
+    ('suggestionId', pa.string()),
+    ('suggestionText', pa.string()),
+    ('reason', pa.string()),
+    ('showSuggestions', pa.bool_()),
+    ('eventDetails', pa.string()),  # full eventDetails as JSON
+    ('keyOrder', pa.string()),      # top-level keys of the event, to rebuild the dicts in their original order
+    ('user_id', pa.string()),
+    ('eventName', pa.string()),
+])
+
+def _event_to_row(seq: int, event: dict, user_id: str) -> dict:
+    details = event.get('eventDetails') or {}
+    task = details.get('task') or {}
+    user = details.get('user') or {}
+
+    return {
+        'seq': seq,
+        'timestamp': event.get('timestamp'),
+        'timestampStr': event.get('timestampStr'),
+        'taskId': details.get('taskId', task.get('id')),
+        'suggestionId': details.get('suggestionId'),
+        'suggestionText': details.get('suggestionText'),
+        'reason': details.get('reason'),
+        'showSuggestions': user.get('showSuggestions'),
+        'eventDetails': json.dumps(details),
+        'keyOrder': ','.join(event.keys()),
+        'user_id': user_id,
+        'eventName': event.get('eventName'),
+    }
+
+def events_to_table(events: list[dict], user_id: str) -> pa.Table:
+    """
+    Converts a list of event dictionaries (as stored in data/events/{user_id}.json) to an Arrow table
+    with the event store schema.
+
+    Args:
+        events (list[dict]): A list of event dictionaries.
+        user_id (str): The user the events belong to.
+
+    Returns:
+        pa.Table: The events as an Arrow table.
+    """
+    rows = [_event_to_row(seq, event, user_id) for seq, event in enumerate(events)]
+    return pa.Table.from_pylist(rows, schema=SCHEMA)
+
+def write_events_to_store(events_dir: str, store_dir: str, user_ids: list[str] = None, batch_size: int = 200):
+    """
+    Converts the per-user JSON files in events_dir into the partitioned Parquet store in store_dir.
+    All partitions of the given users are replaced (including those of event types that are no longer
+    in their JSON file); the partitions of other users are left untouched.
+
+    Args:
+        events_dir (str): Directory with the {user_id}.json files.
+        store_dir (str): Root directory of the Parquet store.
+        user_ids (list[str], optional): Users to (re)write. Defaults to all JSON files in events_dir.
+        batch_size (int, optional): Number of users written per dataset write.
+    """
+    if user_ids is None:
+        user_ids = sorted(f[:-len('.json')] for f in os.listdir(events_dir) if f.endswith('.json'))
+
+    tables = []
+    batch_user_ids = []
+    for i, user_id in enumerate(progressbar(user_ids)):
+        with open(f'{events_dir}/{user_id}.json', 'r') as f:
+            events = json.load(f)
+        tables.append(events_to_table(events, user_id))
+        batch_user_ids.append(user_id)
+
+        if len(tables) == batch_size or i == len(user_ids) - 1:
+            # delete_matching only replaces the eventName partitions in the new data, so remove the users' directories first
+            for batch_user_id in batch_user_ids:
+                shutil.rmtree(f'{store_dir}/user_id={batch_user_id}', ignore_errors=True)
+            ds.write_dataset(
+                pa.concat_tables(tables),
+                store_dir,
+                format='parquet',
+                partitioning=PARTITION_COLUMNS,
+                partitioning_flavor='hive',
+                existing_data_behavior='delete_matching',
+                basename_template='part-{i}.parquet'
+            )
+            tables = []
+            batch_user_ids = []
+
+def get_event_names_in_store(store_dir: str, user_id: str = None) -> list[str]:
+    # Lists the eventName partitions, either for one user or across the whole store
+    user_dirs = [f'user_id={user_id}'] if user_id is not None else [d for d in os.listdir(store_dir) if d.startswith('user_id=')]
+    event_names = set()
+    for user_dir in user_dirs:
+        path = f'{store_dir}/{user_dir}'
+        if os.path.isdir(path):
+            event_names.update(d.split('=', 1)[1] for d in os.listdir(path) if d.startswith('eventName='))
+    return sorted(event_names)
+
+def _expand_event_names(patterns: list[str], available: list[str]) -> list[str]:
+    # Expands glob patterns such as "suggestion_*" against the event names that exist in the store
+    return [name for name in available if any(fnmatch.fnmatchcase(name, p) for p in patterns)]
+
+def load_events_from_store(store_dir: str, user_ids: list[str] = None, event_names: list[str] = None, columns: list[str] = None) -> pd.DataFrame:
+    """
+    Loads events from the Parquet store with predicate and column pushdown. Usage:
+    `load_events_from_store(store_dir, user_ids=['p-...'], event_names=['suggestion_*'], columns=['timestamp', 'suggestionId'])`
+
+    Args:
+        store_dir (str): Root directory of the Parquet store.
+        user_ids (list[str], optional): Only load events of these users.
+        event_names (list[str], optional): Only load these event names. Glob patterns are allowed.
+        columns (list[str], optional): Only load these columns. user_id and eventName are always included.
+
+    Returns:
+        pd.DataFrame: The matching events, ordered by user and original position in the JSON file.
+    """
+    single_user = user_ids is not None and len(user_ids) == 1
+    if single_user:
+        # Open the user's partition directly instead of discovering the whole store
+        partitioning = ds.partitioning(pa.schema([('eventName', pa.string())]), flavor='hive')
+        dataset = ds.dataset(f'{store_dir}/user_id={user_ids[0]}', format='parquet', partitioning=partitioning)
+        user_filter = None
+    else:
+        partitioning = ds.partitioning(pa.schema([('user_id', pa.string()), ('eventName', pa.string())]), flavor='hive')
+        dataset = ds.dataset(store_dir, format='parquet', partitioning=partitioning)
+        user_filter = ds.field('user_id').isin(user_ids) if user_ids is not None else None
+
+    expr = user_filter
+    if event_names is not None:
+        user_id = user_ids[0] if single_user else None
+        event_names = _expand_event_names(event_names, get_event_names_in_store(store_dir, user_id))
+        event_filter = ds.field('eventName').isin(pa.array(event_names, pa.string()))  # typed, as the list can be empty
+        expr = event_filter if expr is None else expr & event_filter
+
+    if columns is not None:
+        partition_columns = ['eventName'] if single_user else PARTITION_COLUMNS
+        columns = list(dict.fromkeys(['seq'] + list(columns) + partition_columns))
+
+    table = dataset.to_table(columns=columns, filter=expr)
+    df = table.to_pandas()
+    if single_user:
+        df['user_id'] = user_ids[0]
+    df = df.sort_values(['user_id', 'seq'], kind='stable').reset_index(drop=True)
+
+    return df
+
+def load_events_for_user_from_store(user_id: str, store_dir: str) -> list[dict]:
+    """
+    Drop-in replacement for db.load_events_for_user that reads from the Parquet store.
+    Returns the events in the same order and with the same structure as the original JSON file.
+    """
+    df = load_events_from_store(store_dir, user_ids=[user_id], columns=['timestamp', 'timestampStr', 'eventDetails', 'keyOrder'])
+
+    events = []
+    for name, ts, ts_str, details, key_order in zip(df['eventName'], df['timestamp'].tolist(), df['timestampStr'], df['eventDetails'], df['keyOrder']):
+        values = {'eventName': name, 'timestamp': ts, 'timestampStr': ts_str, 'eventDetails': json.loads(details)}
+        events.append({key: values[key] for key in key_order.split(',')})
+
+    return events
+
+def load_events_df_for_user_from_store(user_id: str, store_dir: str, fields: dict = None) -> pd.DataFrame:
+    """
+    Loads a user's events from the Parquet store as a frame for cleaning.create_events_df, without
+    rebuilding the event dicts. Only the eventDetails of the event names in fields are read and decoded.
+
+    Args:
+        user_id (str): The user.
+        store_dir (str): Root directory of the Parquet store.
+        fields (dict, optional): eventName -> eventDetails fields to keep (see eventjson.project_events).
+            Events whose eventName isn't listed get empty eventDetails. Defaults to None, which decodes
+            the eventDetails of all events.
+
+    Returns:
+        pd.DataFrame: eventName, timestamp and eventDetails of the events, in the order of the JSON file.
+    """
+    df = load_events_from_store(store_dir, user_ids=[user_id], columns=['timestamp'] if fields is not None else ['timestamp', 'eventDetails'])
+    loads = eventjson.get_json_loads()
+    if fields is None:
+        details = [loads(d) for d in df['eventDetails']]
+    else:
+        # The unlisted event names keep empty eventDetails, so their partitions' JSON isn't even read
+        listed = load_events_from_store(store_dir, user_ids=[user_id], event_names=list(fields), columns=['eventDetails'])
+        projected = eventjson.project_events(({'eventName': name, 'timestamp': None, 'eventDetails': loads(d)} for name, d in zip(listed['eventName'], listed['eventDetails'])), fields)
+        details = [{} for _ in range(len(df))]
+        for seq, event in zip(listed['seq'].tolist(), projected):
+            details[seq] = event['eventDetails']
+
+    # seq is the position in the JSON file and df is sorted by it, so the index matches that of create_events_df(events)
+    return pd.DataFrame({'eventName': df['eventName'].to_numpy(), 'timestamp': df['timestamp'].to_numpy(), 'eventDetails': details})
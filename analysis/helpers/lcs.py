@@ -0,0 +1,62 @@
+import pylcs
+
+# Note: pylcs.lcs_string_idx computes the longest common *substring* (a contiguous match), which is
+# what the metrics in helpers.metrics have always used. The functions below return exactly the same
+# results as pylcs, but avoid the O(len(text) * len(part)) dynamic program whenever the answer is
+# known up front, which covers most accepted suggestions (they usually survive in the essay as-is).
+#
+# Two tiers are exposed:
+# - *_length: only the length of the match (pylcs.lcs_string_length, no index array is built)
+# - longest_common_substring(s): the matched characters, recovered from the alignment only when needed
+
+def _known_match(text: str, part: str):
+    # Returns the matched characters if they follow from a containment check, otherwise None
+    if part in text:
+        return part
+    if text in part:
+        return text
+    return None
+
+def longest_common_substring_length(text: str, part: str) -> int:
+    """
+    Length of the longest common substring of text and part.
+    """
+    match = _known_match(text, part)
+    if match is not None:
+        return len(match)
+    return pylcs.lcs_string_length(text, part)
+
+def longest_common_substring(text: str, part: str) -> str:
+    """
+    The characters of part that form its longest common substring with text. Identical to
+    ''.join([part[i] for i in pylcs.lcs_string_idx(text, part) if i != -1]).
+    Parts with no common character are resolved by the length-only tier and never aligned.
+    """
+    match = _known_match(text, part)
+    if match is not None:
+        return match
+    if pylcs.lcs_string_length(text, part) == 0:
+        return ''
+
+    idx = [i for i in pylcs.lcs_string_idx(text, part) if i != -1]
+    # The match is contiguous, so it can be sliced instead of joined character by character
+    return part[idx[0]:idx[-1] + 1]
+
+def longest_common_substring_lengths(text: str, parts: list[str]) -> list[int]:
+    """
+    Batch version of longest_common_substring_length for many parts (e.g., suggestions) against one text (e.g., an essay).
+    """
+    return [longest_common_substring_length(text, part) for part in parts]
+
+def longest_common_substrings(text: str, parts: list[str]) -> list[str]:
+    """
+    Batch version of longest_common_substring for many parts against one text.
+    """
+    return [longest_common_substring(text, part) for part in parts]
+
+def find_removed_parts_of_suggestions(suggestions: list[str], essays: list[str]) -> list[str]:
+    """
+    For each (suggestion, essay) pair, the part of the suggestion that did not make it into the essay.
+    Same as the notebook helper `suggestion.replace(get_longest_part_of_suggestion_in_final_essay(suggestion, essay), '')`.
+    """
+    return [suggestion.replace(longest_common_substring(suggestion, essay), '') for suggestion, essay in zip(suggestions, essays)]
@@ -1,6 +1,10 @@
-import pylcs
+from __future__ import annotations
 import numpy as np
-import pandas as pd
+from helpers._lazy import lazy_import
+import helpers.lcs as lcs
+
+pd = lazy_import('pandas')
+tokens = lazy_import('helpers.tokens')
 
 def get_longest_part_of_suggestion_in_final_essay(final_essay: str, suggestion: str) -> str:
     # Compute the longest common subsequence between the final essay and the suggestion.
@@ -10,8 +14,8 @@ def get_longest_part_of_suggestion_in_final_essay(final_essay: str, suggestion:
     # Note: By using LCS, we are making an implicit assumption that modifying the suggestion
     # somewhere in the middle means a modification from there until the beginning or end
     # (whichever is closer). This is a simplification, but it should be good enough for our purposes.
-    res = pylcs.lcs_string_idx(final_essay, suggestion)
-    suggestion_in_final_essay = ''.join([suggestion[i] for i in res if i != -1])
+    # See helpers.lcs: identical to ''.join([suggestion[i] for i in pylcs.lcs_string_idx(final_essay, suggestion) if i != -1])
+    suggestion_in_final_essay = lcs.longest_common_substring(final_essay, suggestion)
     return suggestion_in_final_essay
 
 def compute_ai_reliance_for_essay(final_essay: str, dfs: pd.DataFrame) -> float:
@@ -108,44 +112,104 @@ def compute_percentage_edited_suggestions(final_essay: str, dfs: pd.DataFrame) -
     
     return 1 - (num_existing_as_is/num_accepted)
 
+def compute_suggestion_metrics_for_essay(final_essay: str, accepted_suggestions: list[str]) -> tuple:
+    """
+    Computes ai_reliance, suggestion_edit_rate and percentage_edited_suggestions for one essay in a
+    single pass. The LCS alignment of each accepted suggestion is computed once and shared by the
+    first two metrics, which walk the suggestions (and remove them from the essay) in the same way.
+
+    Args:
+        final_essay (str): The final essay text.
+        accepted_suggestions (list[str]): The texts of the accepted suggestions, in DataFrame order.
+
+    Returns:
+        tuple: (ai_reliance, suggestion_edit_rate, percentage_edited_suggestions), identical to the
+        values returned by the three compute_* functions above.
+    """
+    if len(accepted_suggestions) == 0:
+        return 0 / len(final_essay), np.nan, np.nan
+
+    num_existing_as_is = sum(suggestion in final_essay for suggestion in accepted_suggestions)
+
+    total_chars = len(final_essay)
+    suggestion_chars_in_final_essay = 0
+    perc_suggestions_edited = []
+    for suggestion in accepted_suggestions:
+        suggestion_in_final_essay = get_longest_part_of_suggestion_in_final_essay(final_essay, suggestion)
+        suggestion_chars_in_final_essay += len(suggestion_in_final_essay)
+        perc_suggestions_edited.append(1 - len(suggestion_in_final_essay) / len(suggestion))
+
+        final_essay = final_essay.replace(suggestion_in_final_essay, '')
+
+    ai_reliance = suggestion_chars_in_final_essay / total_chars
+    suggestion_edit_rate = np.mean(perc_suggestions_edited)
+    percentage_edited_suggestions = 1 - (num_existing_as_is / len(accepted_suggestions))
+
+    return ai_reliance, suggestion_edit_rate, percentage_edited_suggestions
+
 def compute_metrics_for_tasks(tasks_df: pd.DataFrame, suggestions_df: pd.DataFrame):
     # Compute metrics for each task based on the suggestions seen in that task
+    # The suggestions are grouped by task once, and AI reliance, suggestion edit rate and percentage edited
+    # suggestions are derived from a single alignment pass per task (see compute_suggestion_metrics_for_essay)
+    accepted = suggestions_df[suggestions_df['is_accepted'] == True]
+    accepted_by_task = accepted.groupby('task_id', sort=False)['suggestionText'].agg(list).to_dict()
+
+    task_metrics = [
+        compute_suggestion_metrics_for_essay(final_essay, accepted_by_task.get(task_id, []))
+        for task_id, final_essay in zip(tasks_df.index, tasks_df['finalHtml_stripped'])
+    ]
+    task_metrics = pd.DataFrame(task_metrics, columns=['ai_reliance', 'suggestion_edit_rate', 'percentage_edited_suggestions'], dtype=float)
+
     # AI reliance
-    tasks_df['ai_reliance'] = tasks_df.apply(lambda x: compute_ai_reliance_for_essay(x['finalHtml_stripped'], suggestions_df[suggestions_df['task_id'] == x.name]), axis=1)
+    tasks_df['ai_reliance'] = task_metrics['ai_reliance'].to_numpy()
 
     # Suggestion edit rate
-    tasks_df['suggestion_edit_rate'] = tasks_df.apply(lambda x: compute_suggestion_edit_rate(x['finalHtml_stripped'], suggestions_df[suggestions_df['task_id'] == x.name]), axis=1)
+    tasks_df['suggestion_edit_rate'] = task_metrics['suggestion_edit_rate'].to_numpy()
 
     # Percentage edited suggestions
-    tasks_df['percentage_edited_suggestions'] = tasks_df.apply(lambda x: compute_percentage_edited_suggestions(x['finalHtml_stripped'], suggestions_df[suggestions_df['task_id'] == x.name]), axis=1)
+    tasks_df['percentage_edited_suggestions'] = task_metrics['percentage_edited_suggestions'].to_numpy()
 
     # Number of suggestions shown, accepted, and rejected
     suggestions_numbers = suggestions_df.groupby('task_id').agg(
         shown=('time_shown', 'count'),
         accepted=('is_accepted', 'sum'),
-        ignored=('rejection_reason', lambda x: x.tolist().count('implicit')),
-        rejected=('rejection_reason', lambda x: x.tolist().count('pressed_escape')))
+        ignored=('rejection_reason', lambda x: (x == 'implicit').sum()),
+        rejected=('rejection_reason', lambda x: (x == 'pressed_escape').sum()))
     
     tasks_df = tasks_df.join(suggestions_numbers)
 
     return tasks_df
 
-def calculate_ttr(text):
-    import nltk
-    from nltk.tokenize import word_tokenize
+def compute_metrics_for_cohort(tasks_df: pd.DataFrame, suggestions_df: pd.DataFrame, by: str = 'user_id'):
+    # compute_metrics_for_tasks for the tasks of many users at once (see cleaning.create_task_df_for_cohort):
+    # suggestions are matched to tasks by (user, task id) and counted with a single groupby
+    accepted = suggestions_df[suggestions_df['is_accepted'] == True]
+    accepted_by_task = accepted.groupby([by, 'task_id'], sort=False)['suggestionText'].agg(list).to_dict()
+
+    task_keys = pd.MultiIndex.from_arrays([tasks_df[by], tasks_df.index])
+    task_metrics = [
+        compute_suggestion_metrics_for_essay(final_essay, accepted_by_task.get(key, []))
+        for key, final_essay in zip(task_keys, tasks_df['finalHtml_stripped'])
+    ]
+    task_metrics = pd.DataFrame(task_metrics, columns=['ai_reliance', 'suggestion_edit_rate', 'percentage_edited_suggestions'], dtype=float)
+    for column in task_metrics.columns:
+        tasks_df[column] = task_metrics[column].to_numpy()
+
+    # Number of suggestions shown, accepted, and rejected (tasks without suggestions get NaN, as with the per-task join)
+    suggestions_numbers = suggestions_df.assign(
+        _ignored=suggestions_df['rejection_reason'] == 'implicit',
+        _rejected=suggestions_df['rejection_reason'] == 'pressed_escape',
+    ).groupby([by, 'task_id']).agg(
+        shown=('time_shown', 'count'),
+        accepted=('is_accepted', 'sum'),
+        ignored=('_ignored', 'sum'),
+        rejected=('_rejected', 'sum')).reindex(task_keys)
+    for column in suggestions_numbers.columns:
+        tasks_df[column] = suggestions_numbers[column].array
 
-    # Download the punkt tokenizer model
-    nltk.download('punkt', quiet=True)
+    return tasks_df
 
+def calculate_ttr(text):
     """Function to calculate TTR (Type-Token Ratio) for a given text."""
-    # Tokenize the text
-    tokens = word_tokenize(text.lower())
-    
-    # Get the set of unique tokens
-    types = set(tokens)
-    num_tokens = len(tokens)
-    
-    # Calculate the TTR
-    ttr = len(types) / num_tokens if num_tokens > 0 else 0
-        
-    return ttr
\ No newline at end of file
+    # Tokenization (and the punkt download) is shared and cached in helpers.tokens
+    return tokens.ttr(text)
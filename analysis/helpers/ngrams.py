@@ -0,0 +1,115 @@
+from __future__ import annotations
+from collections import Counter, defaultdict
+import numpy as np
+from helpers._lazy import lazy_import
+import helpers.tokens as tokens
+
+pd = lazy_import('pandas')
+
+# Streaming n-gram counter. Texts are tokenized once (via helpers.tokens), tokens are mapped to
+# integer ids, and every n-gram is packed into a single int64 key (21 bits per token), so the counters
+# hold small integers instead of one Python string per n-gram occurrence. Several orders are counted in
+# the same pass, per group, and only the top-k n-grams are decoded back to strings.
+
+BITS_PER_TOKEN = 21
+MAX_PACKED_ORDER = 63 // BITS_PER_TOKEN
+
+def _pack_ngrams(ids: np.ndarray, n: int) -> np.ndarray:
+    # Packs every n-gram of the id sequence into one int64 key
+    if len(ids) < n:
+        return np.empty(0, dtype=np.int64)
+    keys = np.zeros(len(ids) - n + 1, dtype=np.int64)
+    for i in range(n):
+        keys = (keys << BITS_PER_TOKEN) | ids[i:len(ids) - n + 1 + i]
+    return keys
+
+def _unpack_ngram(key: int, n: int, vocab: list[str]) -> str:
+    mask = (1 << BITS_PER_TOKEN) - 1
+    ids = [(key >> (BITS_PER_TOKEN * (n - 1 - i))) & mask for i in range(n)]
+    return ' '.join(vocab[i] for i in ids)
+
+def _prune(counter: Counter, capacity: int):
+    # Keeps the capacity // 2 most frequent keys (lossy counting, bounds memory for huge logs)
+    for key, _ in counter.most_common()[capacity // 2:]:
+        del counter[key]
+
+def count_top_ngrams(texts, groups=None, orders=(1, 2, 3), k: int = 5, lower: bool = True, remove_stopwords: bool = False, exclude=(), capacity: int = None) -> pd.DataFrame:
+    """
+    Counts n-grams of several orders in one pass over the texts and returns the top-k per group.
+    Usage (top uni/bi/trigrams of the suggestions of each task):
+    `ngrams.count_top_ngrams(dft['suggestionText'], dft['task_id'])`
+
+    Args:
+        texts (iterable): The texts (e.g., a column of essays or suggestions).
+        groups (Series or DataFrame, optional): Group key(s) for each text, e.g., dft['task_id'] or dft[['country', 'group']].
+            Defaults to a single group.
+        orders (tuple, optional): The n-gram orders to count. Defaults to (1, 2, 3).
+        k (int, optional): Number of n-grams to return per group and order. Defaults to 5.
+        lower (bool, optional): Whether to lower-case the texts before tokenizing. Defaults to True.
+        remove_stopwords (bool, optional): Whether to drop stopwords and punctuation before building n-grams.
+        exclude (iterable, optional): N-grams (as space-joined strings) to leave out of the results.
+        capacity (int, optional): Maximum number of distinct n-grams kept per group and order. When exceeded,
+            the less frequent half is discarded, which makes the counts approximate. Defaults to exact counting.
+
+    Returns:
+        pd.DataFrame: One row per (group, n, rank) with the n-gram and its count. Ties are broken by first occurrence.
+    """
+    if max(orders) > MAX_PACKED_ORDER:
+        raise ValueError(f"Only n-grams up to order {MAX_PACKED_ORDER} can be packed into integer keys")
+
+    if groups is None:
+        group_names = ['group']
+        group_keys = [None] * len(texts)
+    elif isinstance(groups, pd.DataFrame):
+        group_names = list(groups.columns)
+        group_keys = list(groups.itertuples(index=False, name=None))
+    else:
+        group_names = [groups.name if getattr(groups, 'name', None) is not None else 'group']
+        group_keys = list(groups)
+
+    vocab_index = {}
+    vocab = []
+    stop_words = tokens.get_stop_words() if remove_stopwords else None
+    counters = defaultdict(Counter)
+
+    for text, group_key in zip(texts, group_keys):
+        words = tokens.tokenize(text, lower=lower, cache=False) # one pass: don't keep the tokens of every text
+        if remove_stopwords:
+            words = [word for word in words if word.lower() not in stop_words]
+
+        ids = np.empty(len(words), dtype=np.int64)
+        for i, word in enumerate(words):
+            word_id = vocab_index.get(word)
+            if word_id is None:
+                word_id = vocab_index[word] = len(vocab)
+                vocab.append(word)
+            ids[i] = word_id
+        if len(vocab) > (1 << BITS_PER_TOKEN): # ids 0 .. 2**BITS_PER_TOKEN - 1 fit
+            raise ValueError("Vocabulary too large to pack n-grams into integer keys")
+
+        for n in orders:
+            counter = counters[(group_key, n)]
+            counter.update(_pack_ngrams(ids, n).tolist())
+            if capacity is not None and len(counter) > capacity:
+                _prune(counter, capacity)
+
+    # Translate the excluded n-grams into keys (n-grams with unseen tokens can't occur anyway)
+    excluded_keys = set()
+    for ngram in exclude:
+        words = ngram.split(' ')
+        if all(word in vocab_index for word in words) and len(words) <= MAX_PACKED_ORDER:
+            excluded_keys.add((len(words), int(_pack_ngrams(np.array([vocab_index[w] for w in words], dtype=np.int64), len(words))[0])))
+
+    rows = []
+    for (group_key, n), counter in counters.items():
+        top = [(key, count) for key, count in counter.most_common() if (n, key) not in excluded_keys][:k] if excluded_keys else counter.most_common(k)
+        key_values = list(group_key) if isinstance(group_key, tuple) else [group_key]
+        for rank, (key, count) in enumerate(top, start=1):
+            rows.append([*key_values, n, rank, _unpack_ngram(key, n, vocab), count])
+
+    df = pd.DataFrame(rows, columns=[*group_names, 'n', 'rank', 'ngram', 'count'])
+    df = df.sort_values([*group_names, 'n', 'rank'], kind='stable').reset_index(drop=True)
+    if groups is None:
+        df = df.drop(columns=['group'])
+
+    return df
@@ -0,0 +1,125 @@
+import os
+import sys
+import ast
+import pickle
+import hashlib
+import inspect
+import importlib
+import tempfile
+import warnings
+from helpers._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# Memoization of per-user pipeline stages on disk. Every artifact is stored as
+# {cache_dir}/{stage}/{item}.pkl together with the key it was computed for. The key combines the hash
+# of the stage's inputs (e.g., the user's events file) with the hash of the code of the stage, so
+# editing the data of one user or the code of a stage only recomputes what is affected.
+
+def _hash_bytes(hasher, data: bytes):
+    # Length-prefixed, so concatenated inputs can't collide
+    hasher.update(len(data).to_bytes(8, 'little'))
+    hasher.update(data)
+
+def hash_files(paths: list[str]) -> str:
+    # Content hash of the given files (missing files hash as absent)
+    hasher = hashlib.blake2b(digest_size=16)
+    for path in sorted(paths):
+        _hash_bytes(hasher, path.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                _hash_bytes(hasher, f.read())
+        else:
+            _hash_bytes(hasher, b'<missing>')
+    return hasher.hexdigest()
+
+def hash_directory(dir: str) -> str:
+    # Content hash of all files below dir (e.g., a user's partition of the event store)
+    paths = []
+    for root, _, files in os.walk(dir):
+        paths.extend(os.path.join(root, name) for name in files)
+    return hash_files(paths)
+
+def hash_texts(texts) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        _hash_bytes(hasher, text.encode('utf-8', 'surrogatepass'))
+    return hasher.hexdigest()
+
+def hash_code(*objects) -> str:
+    """
+    Version of a stage: the hash of the source of the given modules and functions, plus the Python and
+    pandas versions (the artifacts are pickled DataFrames).
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    _hash_bytes(hasher, f'{sys.version_info[:2]}/{pd.__version__}'.encode())
+    for obj in objects:
+        _hash_bytes(hasher, inspect.getsource(obj).encode())
+    return hasher.hexdigest()
+
+def find_helper_modules(*modules, package: str = 'helpers') -> list:
+    """
+    The given modules and all modules of package they import, directly or through each other:
+    `import helpers.x`, `from helpers.x import ...` and `lazy_import('helpers.x')`, also inside functions.
+    Usage (the code of a stage for hash_code): `stagecache.hash_code(*stagecache.find_helper_modules(metrics))`
+
+    Returns:
+        list: The modules, sorted by name.
+    """
+    found = {}
+    pending = list(modules)
+    while len(pending) > 0:
+        module = pending.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # e.g., invalid escape sequences, which the import statements don't depend on
+            tree = ast.parse(inspect.getsource(module))
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [f'{node.module}.{alias.name}' if node.module == package else node.module for alias in node.names]
+            elif isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'lazy_import' and len(node.args) > 0 and isinstance(node.args[0], ast.Constant):
+                names = [node.args[0].value]
+            else:
+                continue
+            pending.extend(importlib.import_module(name) for name in names if name.startswith(f'{package}.'))
+    return [found[name] for name in sorted(found)]
+
+def memoize_stage(cache_dir: str, stage: str, item: str, key: str, compute):
+    """
+    Returns the artifact of stage for item if it was stored with the same key, otherwise calls compute()
+    and stores its result. Writes are atomic, so concurrent workers and interrupted runs are safe.
+
+    Args:
+        cache_dir (str): The root directory of the cache, e.g., 'data/cache/stages'.
+        stage (str): The name of the stage, e.g., 'user'.
+        item (str): The unit of work within the stage, e.g., a user ID.
+        key (str): The hash of the inputs and code of the stage (see hash_files and hash_code).
+        compute (callable): Computes the artifact.
+    """
+    path = f'{cache_dir}/{stage}/{item}.pkl'
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                stored_key, value = pickle.load(f)
+            if stored_key == key:
+                return value
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            pass # Corrupt or incompatible file, recompute
+
+    value = compute()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return value
@@ -1,15 +1,72 @@
-from langchain_openai import AzureChatOpenAI
-from openai import AzureOpenAI
-from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_core.prompts import ChatPromptTemplate
-import pandas as pd
-from tqdm import tqdm
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import numpy as np
 import pickle
-from dotenv import load_dotenv
 import json
 import os
+import time
+import random
+import functools
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from helpers.cache import ResponseCache, get_response_cache, make_cache_key
+from helpers._lazy import lazy_import
 
-def extract_structured_data_from_tasks(task_id: str, df_tasks: pd.DataFrame, model: AzureChatOpenAI, DIR = "data/structured_data", quiet=False) -> dict:
+if TYPE_CHECKING:
+    from langchain_openai import AzureChatOpenAI
+    from openai import AzureOpenAI
+
+# The API clients are only imported on first use (see helpers._lazy)
+openai = lazy_import('openai')
+dotenv = lazy_import('dotenv')
+tqdm = lazy_import('tqdm')
+pd = lazy_import('pandas')
+
+EMBEDDING_MODEL = "embedding-for-culture"
+EMBEDDING_MAX_ITEMS_PER_REQUEST = 256
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 100_000
+
+@functools.lru_cache(maxsize=None)
+def get_retryable_errors() -> tuple:
+    # Transient API errors worth retrying (a function, so openai is only imported when it's needed)
+    return (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows bursts of up to `capacity` calls and `rate_per_minute` calls
+    per minute on average. acquire() blocks until a token is available.
+    """
+    def __init__(self, rate_per_minute: float, capacity: int = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else max(1, int(self.rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def extract_structured_data_from_tasks(task_id: str, df_tasks: pd.DataFrame, model: AzureChatOpenAI, DIR = "data/structured_data", quiet=False, max_concurrency=1, requests_per_minute=None, max_retries=5, cache: ResponseCache = None) -> dict:
+    """
+    Extracts the artifact (name, country, ...) mentioned in each essay of a task. Results are stored in the
+    response cache, keyed by the model, prompt/schema and essay text; results of earlier runs stored as
+    {DIR}/{user_id}_{task_id}.json are imported into the cache. Missing essays are sent through the chain's
+    batch interface with up to max_concurrency requests in flight, an optional requests_per_minute
+    token-bucket limit, and retries (with exponential backoff) on transient API errors.
+    """
+    from langchain_core.pydantic_v1 import BaseModel, Field
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnableLambda
     
     class Movie(BaseModel):
         name: str = Field(description="Name of the movie (corrected for spelling, if necessary)")
@@ -35,39 +92,71 @@ def extract_structured_data_from_tasks(task_id: str, df_tasks: pd.DataFrame, mod
         "festival": Festival
     }
 
-    tagging_prompt = ChatPromptTemplate.from_template(
-    """
+    template = """
     Extract the desired information from the following passage. Only extract the properties mentioned in the provided function.
 
     Passage:
     {input}
     """
-    )
+    tagging_prompt = ChatPromptTemplate.from_template(template)
 
-    tagging_chain = tagging_prompt | model.with_structured_output(task_structure_mapping[task_id])
-    
-    structured_data_for_task = {}
+    schema = task_structure_mapping[task_id]
+    tagging_chain = tagging_prompt | model.with_structured_output(schema)
+    if requests_per_minute is not None:
+        bucket = TokenBucket(requests_per_minute)
+        tagging_chain = RunnableLambda(lambda x: bucket.acquire() or x) | tagging_chain
+    tagging_chain = tagging_chain.with_retry(retry_if_exception_type=get_retryable_errors(), stop_after_attempt=max_retries + 1)
     
-    iterator = df_tasks.iterrows() if quiet else tqdm(df_tasks.iterrows())
-    for index, row in iterator:
-        user_id = row['user_id']
-        filename = f"{DIR}/{user_id}_{task_id}.json"
-
-        # If filename already exists, don't fetch again
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                structured_data_for_task[user_id] = json.load(f)
-            continue
-        
-        essay = row['finalHtml_stripped']
-        res = tagging_chain.invoke({"input": essay})
-        res_dict = res.dict()
-        
-        structured_data_for_task[user_id] = res_dict
+    cache = cache if cache is not None else get_response_cache()
+    model_name = get_model_name(model)
+    prompt = json.dumps([template, schema.schema()], sort_keys=True)
+    keys, essays = {}, {}
+    for user_id, essay in zip(df_tasks['user_id'], df_tasks['finalHtml_stripped']):
+        if user_id not in keys:
+            keys[user_id] = make_cache_key(model_name, prompt, essay)
+            essays[user_id] = essay
+    cached = cache.contains_many(keys.values())
+
+    # Import results of earlier runs ({DIR}/{user_id}_{task_id}.json) that are not in the cache yet
+    existing_files = set(os.listdir(DIR)) if os.path.isdir(DIR) else set()
+    imported = {}
+    for user_id, key in keys.items():
+        if key not in cached and key not in imported and f"{user_id}_{task_id}.json" in existing_files:
+            with open(f"{DIR}/{user_id}_{task_id}.json", "r") as f:
+                imported[key] = json.load(f)
+    cache.set_many(imported)
+    cached.update(imported)
+
+    def fetch(essays_to_fetch: dict) -> dict:
+        # Fetches the essays in chunks, so progress can be reported and results are stored as they come in
+        keys_to_fetch = list(essays_to_fetch)
+        chunk_size = max(1, max_concurrency) * 4
+        fetched = {}
+        progress = None if quiet else tqdm.tqdm(total=len(keys_to_fetch))
+        for i in range(0, len(keys_to_fetch), chunk_size):
+            chunk = keys_to_fetch[i:i + chunk_size]
+            results = tagging_chain.batch([{"input": essays_to_fetch[key]} for key in chunk], config={"max_concurrency": max_concurrency})
+            results = {key: res.dict() for key, res in zip(chunk, results)}
+            cache.set_many(results)
+            fetched.update(results)
+            if progress is not None:
+                progress.update(len(chunk))
+        if progress is not None:
+            progress.close()
+        return fetched
+
+    # Identical essays are only sent once
+    essays_to_fetch = {}
+    for user_id, key in keys.items():
+        if key not in cached and key not in essays_to_fetch:
+            essays_to_fetch[key] = essays[user_id]
+    fetched = fetch(essays_to_fetch)
 
-        # Store as json file
-        with open(filename, "w") as f:
-            json.dump(res_dict, f)
+    # One bulk lookup instead of one file read per user. Entries can disappear from the cache in the
+    # meantime (e.g., evicted by another process); those essays are fetched again.
+    responses = {**cache.get_many(set(keys.values()) - fetched.keys()), **fetched}
+    responses.update(fetch({key: essays[user_id] for user_id, key in keys.items() if key not in responses}))
+    structured_data_for_task = {user_id: responses[key] for user_id, key in keys.items()}
     
     df_structured = pd.DataFrame(structured_data_for_task).T
     df_structured = df_structured.rename(columns={"country": "artifact_country"})
@@ -80,75 +169,419 @@ def extract_structured_data_from_tasks(task_id: str, df_tasks: pd.DataFrame, mod
         
     return df_structured
 
-def get_openai_embedding_for_string(text):
-    # Create client
-    load_dotenv()
-    client = AzureOpenAI(
+def get_model_name(model) -> str:
+    # Deployment/model name of a chat model, used in cache keys
+    return getattr(model, 'deployment_name', None) or getattr(model, 'model_name', None) or type(model).__name__
+
+@functools.lru_cache(maxsize=None)
+def get_azure_openai_client() -> AzureOpenAI:
+    # Create the client once and reuse it (and its connection pool) for all requests.
+    # Point AZURE_OPENAI_ENDPOINT at a local server to run against a fake embeddings API.
+    dotenv.load_dotenv()
+    client = openai.AzureOpenAI(
         api_key=os.getenv("AZURE_OPENAI_API_KEY"),  
         api_version="2024-02-01",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=0 # retries are handled by call_with_retries
     )
+    return client
+
+def call_with_retries(fn, max_retries=5, initial_backoff=1.0):
+    # Calls fn(), retrying transient API errors with exponential backoff and jitter
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except get_retryable_errors():
+            if attempt == max_retries:
+                raise
+            time.sleep(initial_backoff * (2 ** attempt) * (1 + random.random()))
+
+def estimate_num_tokens(text: str) -> int:
+    # Conservative estimate (English text averages ~4 characters per token)
+    return len(text) // 3 + 1
 
+def batch_texts_for_embedding(texts: list[str], max_items=EMBEDDING_MAX_ITEMS_PER_REQUEST, max_tokens=EMBEDDING_MAX_TOKENS_PER_REQUEST) -> list[list[int]]:
+    # Packs consecutive texts into requests of at most max_items texts and max_tokens (estimated) tokens.
+    # Returns the positions of the texts in each request.
+    batches = []
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        num_tokens = estimate_num_tokens(text)
+        if len(batch) > 0 and (len(batch) == max_items or batch_tokens + num_tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += num_tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def get_openai_embedding_for_string(text, client=None):
     # Get embeddings
-    response = client.embeddings.create(
+    client = client or get_azure_openai_client()
+    response = call_with_retries(lambda: client.embeddings.create(
         input = text,
-        model= "embedding-for-culture"
-    )
+        model= EMBEDDING_MODEL
+    ))
 
     return response.data[0].embedding
 
-def get_essay_embeddings_for_all_essays(df_tasks, outfile):
-    # Get embeddings for each essay
+def get_openai_embeddings_for_strings(texts: list[str], client=None, max_items=EMBEDDING_MAX_ITEMS_PER_REQUEST, max_tokens=EMBEDDING_MAX_TOKENS_PER_REQUEST, max_workers=4, max_retries=5, quiet=False, cache: ResponseCache = None) -> list[list[float]]:
+    """
+    Embeds many texts with as few requests as possible. Texts that are in the response cache are not
+    sent again; the others are deduplicated and packed into requests of up to max_items texts / max_tokens
+    tokens, with up to max_workers requests in flight at once. Transient errors (rate limits, timeouts, 5xx)
+    are retried with exponential backoff.
+
+    Args:
+        texts (list[str]): The texts to embed.
+        client (AzureOpenAI, optional): The client to use. Defaults to the shared client.
+        max_items (int, optional): Maximum number of texts per request.
+        max_tokens (int, optional): Maximum number of (estimated) tokens per request.
+        max_workers (int, optional): Maximum number of concurrent requests. Defaults to 4.
+        max_retries (int, optional): Maximum number of retries per request. Defaults to 5.
+        quiet (bool, optional): Whether to hide the progress bar. Defaults to False.
+        cache (ResponseCache, optional): The cache to use. Defaults to the shared cache.
+
+    Returns:
+        list[list[float]]: The embeddings, in the same order as texts.
+    """
+    client = client or get_azure_openai_client()
+    cache = cache if cache is not None else get_response_cache()
+    texts = list(texts)
+    keys = [make_cache_key(EMBEDDING_MODEL, '', text) for text in texts]
+    embeddings_by_key = cache.get_many(keys)
+
+    # Identical texts are only embedded once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in embeddings_by_key and key not in missing:
+            missing[key] = text
+    missing_keys = list(missing)
+    missing_texts = list(missing.values())
+
+    def embed_batch(batch):
+        response = call_with_retries(lambda: client.embeddings.create(
+            input = [missing_texts[i] for i in batch],
+            model= EMBEDDING_MODEL
+        ), max_retries=max_retries)
+        # The API returns one item per input, with the input position in .index
+        results = {missing_keys[batch[item.index]]: item.embedding for item in response.data}
+        cache.set_many(results)
+        return results
+
+    batches = batch_texts_for_embedding(missing_texts, max_items, max_tokens)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(embed_batch, batch) for batch in batches]
+        iterator = as_completed(futures) if quiet or len(futures) == 0 else tqdm.tqdm(as_completed(futures), total=len(futures))
+        for future in iterator:
+            embeddings_by_key.update(future.result())
+
+    return [embeddings_by_key[key] for key in keys]
+
+def _write_atomically(path: str, write):
+    # Calls write(f) on a temporary file next to path, then renames it to path (as in stagecache.memoize_stage)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_essay_embeddings_for_all_essays(df_tasks, outfile, update: bool = False, cache: ResponseCache = None):
+    """
+    Adds the embedding of each essay (column 'embedding') from outfile, a pickle of (user_id, id, embedding)
+    tuples. If outfile exists it is only read, unless update is True; essays that are not in it get no
+    embedding. If it doesn't exist, all essays are embedded and it is written.
+
+    With update=True, essays that are not in outfile are embedded (or taken from the response cache) and
+    appended, and outfile is rewritten atomically. The cache key of each embedded text is recorded in
+    {outfile}.keys.json, so the embeddings of the pickle are only put in the response cache under the text
+    they were computed for, and essays whose text changed since are embedded again.
+    """
+    embeddings = pickle.load(open(outfile, "rb")) if os.path.exists(outfile) else None
+    if embeddings is not None and not update:
+        df_embeddings = pd.DataFrame(embeddings, columns=['user_id', 'id', 'embedding'])
+        return df_tasks.join(df_embeddings.set_index(['user_id', 'id']), on=['user_id', 'id'])
+
+    cache = cache if cache is not None else get_response_cache()
+    embeddings = embeddings or []
+    keys_file = f'{outfile}.keys.json'
+    embedded_keys = json.load(open(keys_file)) if os.path.exists(keys_file) else {} # 'user_id/id' -> cache key of the embedded text
 
-    if os.path.exists(outfile):
-        embeddings = pickle.load(open(outfile, "rb"))
-    else:
-        embeddings = []
-        for i, row in tqdm(df_tasks.iterrows()):
-            embedding = get_openai_embedding_for_string(row['finalHtml_stripped'])
-            embeddings.append((row['user_id'], row['id'], embedding))
-            
-        pickle.dump(embeddings, open(outfile, "wb"))
+    # Seed the response cache with the embeddings whose text is known, so these texts are never embedded again
+    seed = {embedded_keys[f'{user_id}/{task_id}']: embedding for user_id, task_id, embedding in embeddings if f'{user_id}/{task_id}' in embedded_keys}
+    cached = cache.contains_many(seed.keys())
+    cache.set_many({key: embedding for key, embedding in seed.items() if key not in cached})
+
+    # Essays that are not in the pickle, or whose text changed since they were embedded
+    known = set((user_id, task_id) for user_id, task_id, _ in embeddings)
+    df_unique = df_tasks.drop_duplicates(['user_id', 'id'])
+    current_keys = [make_cache_key(EMBEDDING_MODEL, '', text) for text in df_unique['finalHtml_stripped']]
+    stale = [
+        (user_id, task_id) not in known or embedded_keys.get(f'{user_id}/{task_id}', key) != key
+        for user_id, task_id, key in zip(df_unique['user_id'], df_unique['id'], current_keys)
+    ]
+    new_rows = df_unique[stale]
+    if len(new_rows) > 0:
+        vectors = get_openai_embeddings_for_strings(new_rows['finalHtml_stripped'].tolist(), cache=cache)
+        replaced = set(zip(new_rows['user_id'], new_rows['id']))
+        embeddings = [row for row in embeddings if (row[0], row[1]) not in replaced] + list(zip(new_rows['user_id'], new_rows['id'], vectors))
+        for user_id, task_id, key in zip(new_rows['user_id'], new_rows['id'], np.array(current_keys, dtype=object)[stale]):
+            embedded_keys[f'{user_id}/{task_id}'] = key
+        _write_atomically(outfile, lambda f: pickle.dump(embeddings, f))
+        _write_atomically(keys_file, lambda f: f.write(json.dumps(embedded_keys).encode()))
 
     df_embeddings = pd.DataFrame(embeddings, columns=['user_id', 'id', 'embedding'])
-    df_tasks = df_tasks.join(df_embeddings.set_index(['user_id', 'id']), on=['user_id', 'id'])
-    
-    return df_tasks
+    return df_tasks.join(df_embeddings.set_index(['user_id', 'id']), on=['user_id', 'id'])
 
-def get_celebrity_info(client, final_essay, suggestions_shown):
+def save_embedding_store(path: str, keys: pd.DataFrame, vectors):
     """
-    Extracts the favorite celebrity mentioned in the user's final essay and the first celebrity suggested by the system.
+    Stores embeddings as a contiguous, L2-normalized float32 matrix ({path}.npy) with a separate key
+    index ({path}.keys.csv, one row per matrix row). Because the vectors are normalized, cosine
+    similarity is a plain dot product.
 
     Args:
-        final_essay (str): The final essay submitted by the user.
-        suggestions_shown (list): A list of suggestions that were offered to the user by the system.
+        path (str): Path prefix of the store, e.g., 'data/embeddings/study-120'.
+        keys (pd.DataFrame): The key of each vector, e.g., the user_id and id (task) columns.
+        vectors: The embeddings, as a list of lists or a 2D array (same order as keys).
+    """
+    matrix = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+
+    np.save(f"{path}.npy", matrix)
+    keys.reset_index(drop=True).to_csv(f"{path}.keys.csv", index=False)
+
+def save_embedding_store_from_pickle(outfile: str, path: str):
+    # Converts the (user_id, id, embedding) pickle written by get_essay_embeddings_for_all_essays into a store
+    embeddings = pickle.load(open(outfile, "rb"))
+    keys = pd.DataFrame([(user_id, task_id) for user_id, task_id, _ in embeddings], columns=['user_id', 'id'])
+    save_embedding_store(path, keys, [embedding for _, _, embedding in embeddings])
+
+def load_embedding_store(path: str) -> tuple:
+    """
+    Loads an embedding store. The matrix is memory-mapped, so only the rows that are used are read from disk.
 
     Returns:
-        str: A JSON string containing the favorite celebrity mentioned in the final essay and the first celebrity suggested by the system.
-        The JSON string has the following format:
-            "favorite_celebrity": "<name>",
-            "first_suggested": "<name>"
+        tuple: (keys DataFrame, float32 matrix of normalized embeddings)
+    """
+    keys = pd.read_csv(f"{path}.keys.csv")
+    matrix = np.load(f"{path}.npy", mmap_mode='r')
+    return keys, matrix
+
+def get_embedding_rows(keys: pd.DataFrame, df: pd.DataFrame, on=('user_id', 'id')) -> np.ndarray:
+    # Row of the store matrix for each row of df (-1 if df has no embedding in the store)
+    on = list(on)
+    positions = pd.Series(np.arange(len(keys)), index=pd.MultiIndex.from_frame(keys[on]))
+    rows = positions.reindex(pd.MultiIndex.from_frame(df[on])).fillna(-1).astype(int)
+    return rows.to_numpy()
+
+def iter_blocked_similarity(matrix: np.ndarray, rows_a, rows_b=None, block_size=1024):
+    """
+    Yields the cosine similarities between the rows_a and rows_b embeddings block by block, so the
+    full len(rows_a) x len(rows_b) matrix is never materialized. If rows_b is None, only the pairs
+    within rows_a above the diagonal are yielded (each unordered pair once, no self-pairs).
+
+    Yields:
+        np.ndarray: 1D arrays of similarity scores.
+    """
+    rows_a = np.asarray(rows_a)
+    within = rows_b is None
+    rows_b = rows_a if within else np.asarray(rows_b)
+
+    for i in range(0, len(rows_a), block_size):
+        block_a = np.asarray(matrix[rows_a[i:i + block_size]], dtype=np.float32)
+        start_j = i if within else 0
+        for j in range(start_j, len(rows_b), block_size):
+            sims = block_a @ np.asarray(matrix[rows_b[j:j + block_size]], dtype=np.float32).T
+            if within and i == j:
+                sims = sims[np.triu_indices(sims.shape[0], k=1, m=sims.shape[1])]
+            yield sims.ravel()
+
+def pairwise_similarity_scores(matrix: np.ndarray, rows_a, rows_b=None, block_size=1024) -> np.ndarray:
+    # All pairwise scores (upper triangle when rows_b is None), as in cosine_similarity(...)[np.triu_indices_from(..., k=1)]
+    blocks = list(iter_blocked_similarity(matrix, rows_a, rows_b, block_size))
+    return np.concatenate(blocks) if len(blocks) > 0 else np.empty(0, dtype=np.float32)
+
+def _accumulate_similarity(blocks, acc=(0, 0.0, 0.0)) -> tuple:
+    # Running (count, sum, sum of squares) over blocks of scores
+    n, total, total_sq = acc
+    for sims in blocks:
+        sims = sims.astype(np.float64)
+        n += len(sims)
+        total += sims.sum()
+        total_sq += (sims ** 2).sum()
+    return n, total, total_sq
+
+def _summarize_similarity(acc) -> dict:
+    n, total, total_sq = acc
+    mean = total / n if n > 0 else np.nan
+    std = np.sqrt(max(total_sq / n - mean ** 2, 0)) if n > 0 else np.nan
+    return {'mean': mean, 'std': std, 'n_pairs': n}
+
+def pairwise_similarity_stats(matrix: np.ndarray, rows_a, rows_b=None, block_size=1024) -> dict:
+    # Mean, standard deviation and number of pairs of the pairwise scores, accumulated block by block
+    return _summarize_similarity(_accumulate_similarity(iter_blocked_similarity(matrix, rows_a, rows_b, block_size)))
+
+def top_k_similar(matrix: np.ndarray, query_rows, k=10, exclude_self=True, block_size=1024) -> tuple:
+    """
+    Finds the k nearest neighbors (by cosine similarity) of each query row, scanning the store in blocks.
+
+    Returns:
+        tuple: (indices, scores), both of shape (len(query_rows), k), sorted by decreasing similarity.
+    """
+    query_rows = np.asarray(query_rows)
+    queries = np.asarray(matrix[query_rows], dtype=np.float32)
+    best_scores = np.full((len(query_rows), 0), -np.inf, dtype=np.float32)
+    best_indices = np.empty((len(query_rows), 0), dtype=np.int64)
+
+    for j in range(0, matrix.shape[0], block_size):
+        sims = queries @ np.asarray(matrix[j:j + block_size], dtype=np.float32).T
+        indices = np.broadcast_to(np.arange(j, j + sims.shape[1]), sims.shape)
+        if exclude_self:
+            sims = np.where(indices == query_rows[:, None], -np.inf, sims)
+
+        scores = np.concatenate([best_scores, sims], axis=1)
+        indices = np.concatenate([best_indices, indices], axis=1)
+        keep = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_indices = np.take_along_axis(indices, keep, axis=1)
+
+    return best_indices, best_scores
+
+def group_similarity(keys: pd.DataFrame, matrix: np.ndarray, df: pd.DataFrame, group_cols=('country', 'group'), within='id', block_size=1024) -> pd.DataFrame:
+    """
+    Mean cosine similarity within and between groups (e.g., country x AI/No AI), comparing only essays
+    written for the same task (within). Same-group pairs are each counted once and exclude self-pairs.
+
+    Args:
+        keys (pd.DataFrame): The store keys (from load_embedding_store).
+        matrix (np.ndarray): The store matrix (from load_embedding_store).
+        df (pd.DataFrame): One row per essay with user_id, id and the group columns (e.g., dfp).
+        group_cols (tuple, optional): Columns defining the groups. Defaults to ('country', 'group').
+        within (str, optional): Only essays with the same value in this column are compared. Defaults to 'id'.
+
+    Returns:
+        pd.DataFrame: One row per pair of groups with the mean and standard deviation of the similarity and the number of pairs.
     """
+    group_cols = list(group_cols)
+    df = df.assign(_row=get_embedding_rows(keys, df))
+    df = df[df['_row'] >= 0]
+
+    totals = {}
+    for _, dft in df.groupby(within):
+        groups = {key: g['_row'].to_numpy() for key, g in dft.groupby(group_cols)}
+        group_keys = sorted(groups)
+        for a_idx, a in enumerate(group_keys):
+            for b in group_keys[a_idx:]:
+                rows_b = None if a == b else groups[b]
+                blocks = iter_blocked_similarity(matrix, groups[a], rows_b, block_size)
+                totals[(a, b)] = _accumulate_similarity(blocks, totals.get((a, b), (0, 0.0, 0.0)))
+
+    rows = []
+    for (a, b), acc in totals.items():
+        a = a if isinstance(a, tuple) else (a,)
+        b = b if isinstance(b, tuple) else (b,)
+        summary = _summarize_similarity(acc)
+        rows.append([*a, *b, summary['mean'], summary['std'], summary['n_pairs']])
+
+    columns = [f"{col}_a" for col in group_cols] + [f"{col}_b" for col in group_cols] + ['mean_similarity', 'std_similarity', 'n_pairs']
+    return pd.DataFrame(rows, columns=columns)
+
+CELEBRITY_INFO_MODEL = "gpt-4o-mini"
+CELEBRITY_INFO_SYSTEM_PROMPT = "I have logs from a system that offers autocomplete suggestions to users when they're typing. I will give you the final essay submitted by the user, and a Python list of all the suggestions that were offered to them. I want you to tell me two things:\n1. Which celebrity did the user say was their favorite in their final essay?\n2. What celebrity was the first one suggested to them by the system? This is a bit tricky. For example, if the list of suggestions offered is: [' My favorite celebrity is', 'eyoncé because she is incredibly talented and inspiring.', 'y Eilish because of her unique style.', ' Eilish because of her unique style.', ' actor Shah Rukh Khan because', ...] you can kinds make out that the first suggestion was probably Beyoncé.\n\nOutput ONLY a JSON string:\n{\"favorite_celebrity\": \"<name>\", \"first_suggested\": \"<name>\"}"
+CELEBRITY_INFO_PARAMS = {
+    "response_format": {
+        "type": "json_object"
+    },
+    "temperature": 1,
+    "max_tokens": 2048,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0
+}
+
+def _celebrity_info_user_message(final_essay, suggestions_shown) -> str:
+    return f"<final_essay>\n{final_essay}\n</final_essay>\n\n<suggestions_shown>\n{json.dumps(suggestions_shown)}\n</suggestions_shown>"
+
+def get_celebrity_info_cache_key(final_essay, suggestions_shown) -> str:
+    prompt = json.dumps([CELEBRITY_INFO_SYSTEM_PROMPT, CELEBRITY_INFO_PARAMS], sort_keys=True)
+    return make_cache_key(CELEBRITY_INFO_MODEL, prompt, _celebrity_info_user_message(final_essay, suggestions_shown))
+
+def request_celebrity_info(client, final_essay, suggestions_shown) -> str:
+    # Uncached request (see get_celebrity_info)
     messages = [
         {
             "role": "system",
-            "content": "I have logs from a system that offers autocomplete suggestions to users when they're typing. I will give you the final essay submitted by the user, and a Python list of all the suggestions that were offered to them. I want you to tell me two things:\n1. Which celebrity did the user say was their favorite in their final essay?\n2. What celebrity was the first one suggested to them by the system? This is a bit tricky. For example, if the list of suggestions offered is: [' My favorite celebrity is', 'eyoncé because she is incredibly talented and inspiring.', 'y Eilish because of her unique style.', ' Eilish because of her unique style.', ' actor Shah Rukh Khan because', ...] you can kinds make out that the first suggestion was probably Beyoncé.\n\nOutput ONLY a JSON string:\n{\"favorite_celebrity\": \"<name>\", \"first_suggested\": \"<name>\"}"
+            "content": CELEBRITY_INFO_SYSTEM_PROMPT
         },
         {
             "role": "user",
-            "content": f"<final_essay>\n{final_essay}\n</final_essay>\n\n<suggestions_shown>\n{json.dumps(suggestions_shown)}\n</suggestions_shown>"
+            "content": _celebrity_info_user_message(final_essay, suggestions_shown)
         }
     ]
     response = client.chat.completions.create(
-        model="gpt-4o-mini",
+        model=CELEBRITY_INFO_MODEL,
         messages=messages,
-        response_format={
-            "type": "json_object"
-        },
-        temperature=1,
-        max_tokens=2048,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0
+        **CELEBRITY_INFO_PARAMS
     )
-    return response.choices[0].message.content
\ No newline at end of file
+    return response.choices[0].message.content
+
+def get_celebrity_info(client, final_essay, suggestions_shown, cache: ResponseCache = None):
+    """
+    Extracts the favorite celebrity mentioned in the user's final essay and the first celebrity suggested by the system.
+    Responses are stored in the response cache, so each (essay, suggestions) pair is only sent once.
+
+    Args:
+        final_essay (str): The final essay submitted by the user.
+        suggestions_shown (list): A list of suggestions that were offered to the user by the system.
+        cache (ResponseCache, optional): The cache to use. Defaults to the shared cache.
+
+    Returns:
+        str: A JSON string containing the favorite celebrity mentioned in the final essay and the first celebrity suggested by the system.
+        The JSON string has the following format:
+            "favorite_celebrity": "<name>",
+            "first_suggested": "<name>"
+    """
+    cache = cache if cache is not None else get_response_cache()
+    key = get_celebrity_info_cache_key(final_essay, suggestions_shown)
+    return cache.get_or_compute(key, lambda: request_celebrity_info(client, final_essay, suggestions_shown))
+
+def get_celebrity_info_for_many(client, essays_and_suggestions: list, max_concurrency=4, requests_per_minute=None, max_retries=5, quiet=False, cache: ResponseCache = None) -> list:
+    """
+    Calls get_celebrity_info for many (final_essay, suggestions_shown) pairs. Cached pairs are looked up
+    in bulk; the others are fetched concurrently (each distinct pair once), with up to max_concurrency
+    requests in flight, an optional requests_per_minute token-bucket limit, and retries on transient API errors.
+
+    Returns:
+        list: The JSON strings returned by get_celebrity_info, in the same order as the input.
+    """
+    cache = cache if cache is not None else get_response_cache()
+    bucket = TokenBucket(requests_per_minute) if requests_per_minute is not None else None
+
+    keys = [get_celebrity_info_cache_key(final_essay, suggestions_shown) for final_essay, suggestions_shown in essays_and_suggestions]
+    responses = cache.get_many(keys)
+
+    def fetch(final_essay, suggestions_shown):
+        if bucket is not None:
+            bucket.acquire()
+        return request_celebrity_info(client, final_essay, suggestions_shown)
+
+    to_fetch = {}
+    for key, pair in zip(keys, essays_and_suggestions):
+        if key not in responses and key not in to_fetch:
+            to_fetch[key] = pair
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(cache.get_or_compute, key, functools.partial(call_with_retries, functools.partial(fetch, *pair), max_retries)): key
+            for key, pair in to_fetch.items()
+        }
+        iterator = as_completed(futures) if quiet else tqdm.tqdm(as_completed(futures), total=len(futures))
+        for future in iterator:
+            responses[futures[future]] = future.result()
+
+    return [responses[key] for key in keys]
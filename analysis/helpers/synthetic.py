@@ -0,0 +1,291 @@
+import os
+import sys
+import csv
+import json
+import uuid
+import random
+import argparse
+import datetime
+
+# Synthetic studies for benchmarks and tests, without real participant data. generate_study writes
+# {data_dir}/events/{user_id}.json and {data_dir}/qualtrics.csv in the same formats as the real exports,
+# so everything that reads data/ (e.g., final_data_prep) runs on them unchanged. Run from the analysis directory:
+#   python -m helpers.synthetic data/synthetic --users 1000
+# The events follow app/_lib/logging.ts and the components that log them: study_started/study_finished
+# with the user (including showSuggestions), task_started/task_completed with the task and its finalHtml,
+# the suggestion events of treatment users (tutorial included), and the duplicated task events of double clicks.
+
+TUTORIAL_TASK = {'id': 'tutorial', 'prompt': "Write an essay on the importance of education.", 'minWords': -1, 'completed': False}
+ATTENTION_CHECK_TASK = {'id': 'attention_check', 'prompt': "Attention check: Leave this textbox empty.", 'minWords': 0, 'completed': False}
+WRITING_TASKS = [
+    {'id': 'food', 'prompt': "What is your favorite food and why?", 'minWords': 50, 'completed': False},
+    {'id': 'public_figure', 'prompt': "Who is your favorite celebrity or public figure, and why?", 'minWords': 50, 'completed': False},
+    {'id': 'festival', 'prompt': "Which is your favorite festival/holiday and how do you celebrate it?", 'minWords': 50, 'completed': False},
+    {'id': 'leave', 'prompt': "Write an email to your boss asking them for a two week leave with information about why you need to be away.", 'minWords': 50, 'completed': False},
+]
+
+WORDS = {
+    'tutorial': "education is important because it opens doors helps people grow learn think critically find good jobs and build a better society for everyone".split(),
+    'food': "my favorite food is biryani pizza pasta sushi dosa tacos because it tastes amazing spicy rich flavors reminds me of home family dinners with friends and mom".split(),
+    'public_figure': "my favorite public figure is an actor singer athlete leader who inspires me with hard work kindness talent and dedication to helping people".split(),
+    'festival': "my favorite festival is diwali christmas holi thanksgiving eid we celebrate with family lights sweets gifts food prayers music and dancing together".split(),
+    'leave': "dear manager i am writing to request a two week leave from work because of a family wedding medical reasons travel i will ensure my tasks are covered thank you regards".split(),
+}
+
+# Qualtrics export: header row with the column codes, a row with the question texts and a row with the import ids
+SSVS_VALUES = [
+    ('Power', 'social power, authority, wealth'),
+    ('Achievement', 'success, capability, ambition, influence on people and events'),
+    ('Hedonism', 'gratification of desires, enjoyment in life, self-indulgence'),
+    ('Stimulation', 'daring, a varied and challenging life, an exciting life'),
+    ('Self-direction', 'creativity, freedom, curiosity, independence, choosing one\'s own goals'),
+    ('Universalism', 'broad-mindedness, beauty of nature and arts, social justice, a world at peace, equality, wisdom, unity with nature, environmental protection'),
+    ('Benevolence', 'helpfulness, honesty, forgiveness, loyalty, responsibility'),
+    ('Tradition', 'respect for tradition, humbleness, accepting one\'s portion in life, devotion, modesty'),
+    ('Conformity', 'obedience, honoring parents and elders, self-discipline, politeness'),
+    ('Security', 'national security, family security, social order, cleanliness, reciprocation of favors'),
+]
+QUALTRICS_QUESTIONS = [
+    ('Q1', 'What is your age?'),
+    ('Q2', 'What is your gender?'),
+    ('Q3', 'List of Countries'),
+    ('Q4', 'In which country do you currently reside?'),
+    ('Q5', 'How long have you lived in this country? (in years)'),
+    ('Q6', 'In which city do you currently reside?'),
+    ('Q7', 'What is the highest level of education you have completed?'),
+    ('Q8', 'What is your occupation?'),
+    ('Q9', 'What languages do you speak?'),
+] + [
+    (f'Q10_{i + 1}', f'Please rate the importance of the following values as a life-guiding principle for you. - {i + 1}. {name}\n({description})')
+    for i, (name, description) in enumerate(SSVS_VALUES)
+]
+COUNTRIES = {
+    'IND': ('India', ['Mumbai', 'Delhi', 'Bangalore', 'Chennai', 'Kolkata', 'Hyderabad', 'Pune'], ['English, Hindi', 'English, Hindi, Marathi', 'Tamil, English', 'English, Malayalam, Hindi', 'English, Telugu, Hindi']),
+    'US': ('United States of America', ['New York', 'Chicago', 'Seattle', 'Austin', 'Boston', 'Denver', 'Atlanta'], ['English', 'English, Spanish', 'English, French']),
+}
+GENDERS = ['Male', 'Female', 'Non-binary', 'Prefer not to say']
+EDUCATION = ['Upto grade 12 (Inter)', 'Graduation', 'Post-graduation', 'Doctorate']
+OCCUPATIONS = ['Software engineer', 'Student', 'Teacher', 'Accountant', 'Nurse', 'Sales', 'Designer', 'Unemployed']
+
+STUDY_START = datetime.datetime(2024, 8, 5, 9, 0, tzinfo=datetime.timezone.utc)
+
+def _timestamp_str(ts: int) -> str:
+    # Date.toString() of the browser that logged the event
+    return datetime.datetime.fromtimestamp(ts / 1000, datetime.timezone.utc).strftime('%a %b %d %Y %H:%M:%S GMT+0000 (Coordinated Universal Time)')
+
+def _event(name: str, ts: int, details: dict) -> dict:
+    return {'eventName': name, 'timestamp': ts, 'timestampStr': _timestamp_str(ts), 'eventDetails': details}
+
+def _phrase(rng: random.Random, words: list, n: int) -> str:
+    return ' '.join(rng.choice(words) for _ in range(n))
+
+def _to_html(paragraphs: list) -> str:
+    # The editor wraps each line in a div and keeps repeated spaces as &nbsp;
+    return ''.join(f"<div>{p.replace('&', '&amp;').replace('  ', ' &nbsp;')}</div>" if p else '<div><br></div>' for p in paragraphs)
+
+def get_tasks(n_tasks: int) -> list[dict]:
+    # The writing tasks of the study (with the attention check after the second one), extended with generic tasks if n_tasks > 4
+    tasks = [dict(task) for task in WRITING_TASKS[:n_tasks]]
+    tasks += [{'id': f'task_{i + 1}', 'prompt': f"Writing task {i + 1}", 'minWords': 50, 'completed': False} for i in range(len(tasks), n_tasks)]
+    tasks.insert(min(2, len(tasks)), dict(ATTENTION_CHECK_TASK))
+    return tasks
+
+def generate_task_events(rng: random.Random, task: dict, t: int, show_suggestions: bool, n_suggestions: int, double_click_rate: float) -> tuple:
+    """
+    Events of one task: task_started, the suggestions shown while writing (with their outcome) and task_completed.
+    Returns the events and the time after the task.
+    """
+    events = []
+    words = WORDS.get(task['id'], WORDS['tutorial'])
+
+    events.append(_event('task_started', t, {'task': dict(task)}))
+    if rng.random() < double_click_rate:
+        t += rng.randint(20, 80)
+        events.append(_event('task_started', t, {'task': dict(task)})) # double click on "Next"
+
+    text = ''
+    if task['id'] != ATTENTION_CHECK_TASK['id']:
+        n_words = max(task['minWords'], 10) + rng.randint(0, 60)
+        for i in range(n_suggestions if show_suggestions else 0):
+            t += rng.randint(1_000, 20_000)
+            text = (text + ' ' + _phrase(rng, words, rng.randint(2, 12))).strip()
+            suggestion_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            suggestion_text = ' ' + _phrase(rng, words, rng.randint(2, 10))
+            events.append(_event('suggestion_shown', t, {
+                'suggestionId': suggestion_id,
+                'timestamp': t,
+                'suggestionText': suggestion_text,
+                'leadingText': text,
+                'currentHtml': f"<div>{text}<span class=\"suggestion\">{suggestion_text}</span></div>",
+            }))
+
+            outcome = rng.random()
+            if outcome < 0.03:
+                continue # no outcome logged (e.g., the task was submitted while it was shown)
+            t += rng.randint(200, 6_000)
+            if outcome < 0.45:
+                events.append(_event('suggestion_accepted', t, {'suggestionId': suggestion_id, 'timestamp': t}))
+                accepted = suggestion_text.split()
+                if rng.random() < 0.3: # edited after accepting
+                    accepted = accepted[:max(1, len(accepted) - rng.randint(1, 3))] + [rng.choice(words)]
+                text += ' ' + ' '.join(accepted)
+            else:
+                reason = 'pressed_escape' if outcome > 0.9 else 'implicit'
+                events.append(_event('suggestion_rejected', t, {'suggestionId': suggestion_id, 'timestamp': t, 'reason': reason}))
+        remaining = n_words - len(text.split())
+        if remaining > 0:
+            text = (text + ' ' + _phrase(rng, words, remaining)).strip()
+
+    t += rng.randint(5_000, 60_000)
+    sentences = text.split(' ')
+    paragraphs = [' '.join(sentences[i:i + 25]) for i in range(0, len(sentences), 25)] if text else []
+    final_html = _to_html([p for paragraph in paragraphs for p in (paragraph, '')][:-1]) if paragraphs else ''
+    completed = {'taskId': task['id'], 'finalHtml': final_html}
+    events.append(_event('task_completed', t, completed))
+    if rng.random() < double_click_rate:
+        for _ in range(rng.randint(1, 2)):
+            t += rng.randint(20, 80)
+            events.append(_event('task_completed', t, dict(completed))) # nothing happens in between
+
+    return events, t
+
+def generate_user_events(user_id: str, show_suggestions: bool, rng: random.Random, start_time: int, n_tasks: int = 4, suggestions_per_task: tuple = (5, 25), double_click_rate: float = 0.15) -> list[dict]:
+    """
+    Generates the events of one participant, in the arbitrary order of a Firestore export.
+
+    Args:
+        user_id (str): The user ID.
+        show_suggestions (bool): Whether the user is in the treatment group (gets the tutorial and suggestions).
+        rng (random.Random): The random generator.
+        start_time (int): The timestamp (ms) of study_started.
+        n_tasks (int, optional): Number of writing tasks (besides the attention check and the tutorial). Defaults to 4.
+        suggestions_per_task (tuple, optional): Min and max number of suggestions shown per task. Defaults to (5, 25).
+        double_click_rate (float, optional): Probability that a task event is logged twice. Defaults to 0.15.
+
+    Returns:
+        list[dict]: The events.
+    """
+    tasks = get_tasks(n_tasks)
+    user = {'userId': user_id, 'consentGiven': True, 'tasks': tasks, 'showSuggestions': show_suggestions}
+    events = [_event('study_started', start_time, {'user': user})]
+    t = start_time
+
+    if show_suggestions:
+        t += rng.randint(2_000, 10_000)
+        task_events, t = generate_task_events(rng, TUTORIAL_TASK, t, True, 3, double_click_rate)
+        events += task_events
+
+    for task in tasks:
+        t += rng.randint(2_000, 10_000)
+        n_suggestions = rng.randint(*suggestions_per_task)
+        task_events, t = generate_task_events(rng, task, t, show_suggestions, n_suggestions, double_click_rate)
+        events += task_events
+
+    t += rng.randint(2_000, 10_000)
+    events.append(_event('study_finished', t, {'user': {**user, 'tasks': [{**task, 'completed': True} for task in tasks]}}))
+
+    rng.shuffle(events)
+    return events
+
+def generate_qualtrics_row(rng: random.Random, user_id: str, start: datetime.datetime, born_outside_rate: float) -> dict:
+    # One survey response; country codes as in the study (India and the US)
+    country_code = rng.choice(list(COUNTRIES))
+    country, cities, languages = COUNTRIES[country_code]
+    birth = rng.choice(['Canada', 'United Kingdom', 'Nepal']) if rng.random() < born_outside_rate else country
+    duration = rng.randint(900, 3600)
+    row = {
+        'StartDate': start.strftime('%Y-%m-%d %H:%M:%S'),
+        'EndDate': (start + datetime.timedelta(seconds=duration)).strftime('%Y-%m-%d %H:%M:%S'),
+        'Status': 'IP Address',
+        'Progress': '100',
+        'Duration (in seconds)': str(duration),
+        'Finished': 'True',
+        'RecordedDate': (start + datetime.timedelta(seconds=duration)).strftime('%Y-%m-%d %H:%M:%S'),
+        'ResponseId': 'R_' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(15)),
+        'Q1': str(rng.randint(18, 70)),
+        'Q2': rng.choices(GENDERS, weights=[48, 48, 2, 2])[0],
+        'Q3': birth,
+        'Q4': country,
+        'Q5': str(rng.randint(1, 40)),
+        'Q6': rng.choice(cities),
+        'Q7': rng.choice(EDUCATION),
+        'Q8': rng.choice(OCCUPATIONS),
+        'Q9': rng.choice(languages),
+    }
+    for i in range(len(SSVS_VALUES)):
+        value = rng.randint(0, 8)
+        row[f'Q10_{i + 1}'] = {0: '0 (opposed to my principles)', 8: '8 (of supreme importance)'}.get(value, str(value))
+    row['completionCode'] = user_id
+    return row
+
+def write_qualtrics_csv(path: str, rows: list[dict]):
+    # Writes rows in the layout of a Qualtrics CSV export (see cleaning.load_qualtrics_csv)
+    columns = ['StartDate', 'EndDate', 'Status', 'Progress', 'Duration (in seconds)', 'Finished', 'RecordedDate', 'ResponseId'] + [code for code, _ in QUALTRICS_QUESTIONS] + ['completionCode']
+    labels = {'StartDate': 'Start Date', 'EndDate': 'End Date', 'Status': 'Response Type', 'RecordedDate': 'Recorded Date', 'ResponseId': 'Response ID', 'completionCode': 'completionCode', **dict(QUALTRICS_QUESTIONS)}
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerow([labels.get(column, column) for column in columns])
+        writer.writerow([json.dumps({'ImportId': labels.get(column, column)}) for column in columns])
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+
+def generate_study(data_dir: str, n_users: int = 120, n_tasks: int = 4, suggestions_per_task: tuple = (5, 25), treatment_fraction: float = 0.5, double_click_rate: float = 0.15, born_outside_rate: float = 0.03, seed: int = 0) -> dict:
+    """
+    Generates a synthetic study: {data_dir}/events/{user_id}.json for every participant and {data_dir}/qualtrics.csv.
+    Each user is generated from its own seed, so the first n users are the same for any n_users.
+
+    Args:
+        data_dir (str): The directory to write to (the equivalent of data/).
+        n_users (int, optional): Number of participants. Defaults to 120.
+        n_tasks (int, optional): Number of writing tasks per participant. Defaults to 4.
+        suggestions_per_task (tuple, optional): Min and max number of suggestions shown per task. Defaults to (5, 25).
+        treatment_fraction (float, optional): Fraction of users that get suggestions. Defaults to 0.5.
+        double_click_rate (float, optional): Probability that a task event is logged twice. Defaults to 0.15.
+        born_outside_rate (float, optional): Fraction of users born outside their country of residence. Defaults to 0.03.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        dict: The parameters and the number of users, events and suggestions shown.
+    """
+    os.makedirs(f'{data_dir}/events', exist_ok=True)
+    rows = []
+    n_events = n_suggestions = 0
+    for i in range(n_users):
+        rng = random.Random(f'{seed}-{i}')
+        user_id = 'p-' + '%024x' % rng.getrandbits(96)
+        start = STUDY_START + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 14))
+        events = generate_user_events(user_id, rng.random() < treatment_fraction, rng, int(start.timestamp() * 1000), n_tasks, suggestions_per_task, double_click_rate)
+        with open(f'{data_dir}/events/{user_id}.json', 'w') as f:
+            json.dump(events, f)
+        rows.append(generate_qualtrics_row(rng, user_id, start, born_outside_rate))
+        n_events += len(events)
+        n_suggestions += sum(event['eventName'] == 'suggestion_shown' for event in events)
+    write_qualtrics_csv(f'{data_dir}/qualtrics.csv', rows)
+
+    summary = {
+        'n_users': n_users, 'n_tasks': n_tasks, 'suggestions_per_task': list(suggestions_per_task), 'treatment_fraction': treatment_fraction,
+        'double_click_rate': double_click_rate, 'born_outside_rate': born_outside_rate, 'seed': seed,
+        'events': n_events, 'suggestions_shown': n_suggestions,
+    }
+    with open(f'{data_dir}/synthetic.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic study (events and Qualtrics CSV)")
+    parser.add_argument('data_dir', help="Output directory, with the layout of data/")
+    parser.add_argument('--users', type=int, default=120)
+    parser.add_argument('--tasks', type=int, default=4)
+    parser.add_argument('--suggestions', type=int, nargs=2, default=(5, 25), metavar=('MIN', 'MAX'), help="Suggestions shown per task")
+    parser.add_argument('--treatment-fraction', type=float, default=0.5)
+    parser.add_argument('--double-click-rate', type=float, default=0.15)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    summary = generate_study(args.data_dir, args.users, args.tasks, tuple(args.suggestions), args.treatment_fraction, args.double_click_rate, seed=args.seed)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
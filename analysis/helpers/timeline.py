@@ -0,0 +1,195 @@
+from __future__ import annotations
+import numpy as np
+from helpers._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# Timeline features of the suggestions within their writing task (see 4_suggestion_data.ipynb), computed
+# for all suggestions at once. Each suggestion is matched to the row of its task in tasks_df, so the task
+# columns are gathered by position instead of merged, and the orderings within tasks come from one
+# lexsort over all suggestions instead of a groupby per feature. Usage:
+#   dft = timeline.compute_timeline_features(suggestions_df, tasks_df)
+#   summaries = timeline.compute_timeline_summaries(dft)
+#   summaries['country_stage']
+
+# Cut points of the task stages in percent of the task duration (as in the notebook: < 33.33 is early,
+# < 66.66 is middle, the rest is late)
+STAGE_BINS = (33.33, 66.66)
+STAGE_LABELS = ('early', 'middle', 'late')
+
+LATENCY_QUANTILES = (0.25, 0.5, 0.75, 0.9)
+
+# Name -> columns of the summaries returned by compute_timeline_summaries
+SUMMARY_GROUPINGS = {
+    'overall': (),
+    'stage': ('task_stage',),
+    'country': ('country',),
+    'country_stage': ('country', 'task_stage'),
+    'country_group': ('country', 'group'),
+    'country_group_stage': ('country', 'group', 'task_stage'),
+}
+
+def _task_positions(suggestions_df: pd.DataFrame, tasks_df: pd.DataFrame, by: str) -> np.ndarray:
+    # Row of tasks_df (indexed by task ID) of each suggestion, -1 if the task isn't in tasks_df
+    task_keys = pd.MultiIndex.from_arrays([np.asarray(tasks_df[by], dtype=object), np.asarray(tasks_df.index, dtype=object)])
+    suggestion_keys = pd.MultiIndex.from_arrays([np.asarray(suggestions_df[by], dtype=object), np.asarray(suggestions_df['task_id'], dtype=object)])
+    return task_keys.get_indexer(suggestion_keys)
+
+def _gather(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    # values[positions] as floats, NaN where the position is -1
+    gathered = np.asarray(values, dtype=float)[positions]
+    gathered[positions < 0] = np.nan
+    return gathered
+
+def _order_within_groups(groups: np.ndarray, times: np.ndarray) -> tuple:
+    """
+    Orders rows by time within their group.
+
+    Returns:
+        tuple: The row order (by group, then time; ties keep row order), a mask over that order of the
+        first row of each group, the 1-based position of each row in its group and the size of its group.
+    """
+    n = len(groups)
+    order = np.lexsort((times, groups))
+    sorted_groups = groups[order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    starts = np.flatnonzero(first)
+    group_ids = np.cumsum(first) - 1
+
+    position = np.empty(n, dtype=np.int64)
+    position[order] = np.arange(n) - starts[group_ids] + 1
+    size = np.empty(n, dtype=np.int64)
+    size[order] = np.diff(np.append(starts, n))[group_ids]
+    return order, first, position, size
+
+def _positions_in_tasks(task_positions: np.ndarray, times: np.ndarray, rows: np.ndarray) -> tuple:
+    # Position, number and percentage position of the given rows within their task (NaN for the other rows)
+    n = len(task_positions)
+    position, size = np.full(n, np.nan), np.full(n, np.nan)
+    if len(rows) > 0:
+        _, _, position[rows], size[rows] = _order_within_groups(task_positions[rows], times[rows])
+    return position, size, position / size * 100
+
+def compute_timeline_features(suggestions_df: pd.DataFrame, tasks_df: pd.DataFrame, by: str = 'user_id', task_columns=('country', 'group'), stage_bins=STAGE_BINS, stage_labels=STAGE_LABELS) -> pd.DataFrame:
+    """
+    Computes when each suggestion happened within its task and how the user reacted to it.
+
+    Args:
+        suggestions_df (pd.DataFrame): The suggestions, as returned by construct_dfs_for_analysis (compact or not).
+        tasks_df (pd.DataFrame): The tasks, indexed by task ID, with the by column.
+        by (str, optional): The user column. Defaults to 'user_id'.
+        task_columns (iterable, optional): Columns of tasks_df to add to each suggestion. Defaults to
+            ('country', 'group'), which the summaries group by.
+        stage_bins (tuple, optional): Cut points of the task stages in percent of the task duration.
+            Defaults to STAGE_BINS.
+        stage_labels (tuple, optional): Names of the stages, one more than stage_bins. Defaults to STAGE_LABELS.
+
+    Returns:
+        pd.DataFrame: suggestions_df with task_columns and
+        - modified: whether an accepted suggestion is not in the final essay as is (NA if not accepted)
+        - duration_percentage: time of the decision (acceptance or rejection) in percent of the task duration
+        - task_stage: the stage of the decision. A decision without a duration_percentage is 'late', as in the notebook.
+        - duration_before_acc/rej: milliseconds from showing the suggestion to the decision
+        - time_since_previous: milliseconds from the decision on the previous suggestion of the task to
+          showing this one (NaN for the first suggestion)
+        - position_in_task, suggestions_in_task, position_percentage: order of the suggestion among all
+          suggestions of its task, by time shown
+        - accepted_number, accepted_in_task, accepted_percentage: order of an accepted suggestion among the
+          accepted suggestions of its task, by time accepted (NaN if not accepted)
+        - charsWritten, charsPercentage: length of the text before the suggestion, absolute and in percent
+          of the length of the final essay
+    """
+    if len(stage_labels) != len(stage_bins) + 1:
+        raise ValueError(f"Expected {len(stage_bins) + 1} stage labels for {len(stage_bins)} stage bins, got {len(stage_labels)}")
+
+    n = len(suggestions_df)
+    task_positions = _task_positions(suggestions_df, tasks_df, by)
+    has_task = task_positions >= 0
+    time_shown = suggestions_df['time_shown'].to_numpy(dtype=float)
+    time_decided = suggestions_df['time_acc/rej'].to_numpy(dtype=float)
+    accepted = suggestions_df['is_accepted'].fillna(False).to_numpy(dtype=bool)
+
+    features = {column: pd.Series(tasks_df[column].array.take(task_positions, allow_fill=True), index=suggestions_df.index) for column in task_columns}
+
+    # Modified: substring checks only for the accepted suggestions
+    essays = np.asarray(tasks_df['finalHtml_stripped'], dtype=object)
+    modified = np.zeros(n, dtype=bool)
+    checked = np.flatnonzero(accepted & has_task)
+    texts = suggestions_df['suggestionText'].to_numpy(dtype=object)
+    modified[checked] = [text not in essay for text, essay in zip(texts[checked], essays[task_positions[checked]])]
+    unchecked = np.ones(n, dtype=bool)
+    unchecked[checked] = False
+    features['modified'] = pd.arrays.BooleanArray(modified, unchecked)
+
+    time_started = _gather(tasks_df['time_started'].to_numpy(), task_positions)
+    time_completed = _gather(tasks_df['time_completed'].to_numpy(), task_positions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        duration_percentage = (time_decided - time_started) / (time_completed - time_started) * 100
+    features['duration_percentage'] = duration_percentage
+    # np.digitize puts NaN past the last bin, i.e., in the last stage
+    features['task_stage'] = pd.Categorical.from_codes(np.digitize(duration_percentage, stage_bins), categories=list(stage_labels), ordered=True)
+    features['duration_before_acc/rej'] = suggestions_df['time_acc/rej'] - suggestions_df['time_shown']
+
+    # Gaps and positions: all suggestions of a task by time shown, then the accepted ones by time accepted
+    time_since_previous = np.full(n, np.nan)
+    rows = np.flatnonzero(has_task)
+    if len(rows) > 0:
+        order, first, _, _ = _order_within_groups(task_positions[rows], time_shown[rows])
+        ordered_rows = rows[order]
+        gaps = np.empty(len(rows))
+        gaps[1:] = time_shown[ordered_rows[1:]] - time_decided[ordered_rows[:-1]]
+        gaps[first] = np.nan
+        time_since_previous[ordered_rows] = gaps
+    features['time_since_previous'] = time_since_previous
+    features['position_in_task'], features['suggestions_in_task'], features['position_percentage'] = _positions_in_tasks(task_positions, time_shown, rows)
+    features['accepted_number'], features['accepted_in_task'], features['accepted_percentage'] = _positions_in_tasks(task_positions, time_decided, checked)
+
+    chars_written = suggestions_df['leadingText'].str.len().to_numpy(dtype=float, na_value=np.nan)
+    features['charsWritten'] = chars_written
+    features['charsPercentage'] = chars_written / _gather(tasks_df['charLength'].to_numpy(), task_positions) * 100
+
+    return suggestions_df.assign(**features)
+
+def summarize_timeline(timeline_df: pd.DataFrame, by=('country', 'group', 'task_stage'), quantiles=LATENCY_QUANTILES) -> pd.DataFrame:
+    """
+    Acceptance and decision latency of the suggestions per group.
+
+    Args:
+        timeline_df (pd.DataFrame): As returned by compute_timeline_features.
+        by (str or iterable, optional): The column(s) to group by; empty for a single 'all' row.
+            Defaults to ('country', 'group', 'task_stage').
+        quantiles (tuple, optional): Quantiles of the latencies. Defaults to LATENCY_QUANTILES.
+
+    Returns:
+        pd.DataFrame: One row per group with the number of suggestions shown, accepted and modified, the
+        acceptance_rate, the modified_rate (of the accepted suggestions), and the quantiles of the seconds
+        before accepting (accept_latency_p50, ...) and before rejecting (reject_latency_p50, ...).
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    accepted = timeline_df['is_accepted'].fillna(False).to_numpy(dtype=bool)
+    latency = timeline_df['duration_before_acc/rej'].to_numpy(dtype=float) / 1000
+    values = pd.DataFrame({
+        'shown': np.ones(len(timeline_df), dtype=np.int64),
+        'accepted': accepted.astype(np.int64),
+        'modified': timeline_df['modified'].fillna(False).to_numpy(dtype=np.int64),
+        'accept_latency': np.where(accepted, latency, np.nan),
+        'reject_latency': np.where(accepted, np.nan, latency),
+    }, index=timeline_df.index)
+    keys = [timeline_df[column] for column in by] if by else [pd.Series('all', index=timeline_df.index, name='group_key')]
+
+    grouped = values.groupby(keys, observed=True, sort=True)
+    summary = grouped[['shown', 'accepted', 'modified']].sum()
+    summary['acceptance_rate'] = summary['accepted'] / summary['shown']
+    summary['modified_rate'] = summary['modified'] / summary['accepted'].where(summary['accepted'] > 0)
+    for column in ('accept_latency', 'reject_latency'):
+        latencies = grouped[column].quantile(list(quantiles)).unstack()
+        latencies.columns = [f'{column}_p{round(q * 100)}' for q in latencies.columns]
+        summary = summary.join(latencies)
+    if not by:
+        summary.index.name = None
+    return summary
+
+def compute_timeline_summaries(timeline_df: pd.DataFrame, groupings: dict = SUMMARY_GROUPINGS, quantiles=LATENCY_QUANTILES) -> dict:
+    # summarize_timeline for each grouping (name -> columns), by default overall and by country, group and stage
+    return {name: summarize_timeline(timeline_df, by, quantiles) for name, by in groupings.items()}
@@ -0,0 +1,100 @@
+import string
+import hashlib
+from helpers._lazy import lazy_import
+
+nltk = lazy_import('nltk')
+
+# Shared tokenization for the text metrics (TTR, n-grams). Tokenizer resources are resolved once per
+# process, and token tuples are cached per (content hash, case-folding mode) so the same essay or
+# suggestion is only tokenized once no matter how many metrics are computed on it.
+
+_resources_ready = False
+_stop_words = None
+
+_token_cache = {}
+TOKEN_CACHE_SIZE = 200_000
+
+# The models of word_tokenize: punkt_tab for nltk >= 3.8.2, punkt for older versions
+TOKENIZER_RESOURCES = ('punkt_tab', 'punkt')
+
+def ensure_tokenizer_resources():
+    # Download the punkt tokenizer models that aren't installed (only once per process)
+    global _resources_ready
+    if not _resources_ready:
+        for name in TOKENIZER_RESOURCES:
+            try:
+                nltk.data.find(f'tokenizers/{name}')
+            except LookupError:
+                nltk.download(name, quiet=True)
+        _resources_ready = True
+
+def check_tokenizer_resources():
+    # Raises nltk's LookupError (with the download instructions) if word_tokenize can't load its model,
+    # e.g., offline without punkt_tab, so long runs can fail before their first step instead of midway
+    ensure_tokenizer_resources()
+    nltk.tokenize.word_tokenize('A test.')
+
+def get_stop_words() -> frozenset:
+    # English stopwords and punctuation, as used by find_ngrams(remove_stopwords=True)
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = frozenset(nltk.corpus.stopwords.words('english')) | frozenset(string.punctuation)
+    return _stop_words
+
+def tokenize(text: str, lower: bool = False, cache: bool = True) -> tuple:
+    """
+    Tokenizes text with nltk's word_tokenize, lower-casing it first if lower is True.
+    Results are cached by the hash of the text and the case-folding mode.
+
+    Args:
+        text (str): The text to tokenize.
+        lower (bool, optional): Whether to lower-case the text before tokenizing. Defaults to False.
+        cache (bool, optional): Whether to store the tokens in the cache. With False, cached tokens are still
+            used, but nothing is added, e.g., for one pass over a large log. Defaults to True.
+
+    Returns:
+        tuple: The tokens.
+    """
+    key = (hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), lower)
+    tokens = _token_cache.get(key)
+    if tokens is not None:
+        return tokens
+
+    ensure_tokenizer_resources()
+    tokens = tuple(nltk.tokenize.word_tokenize(text.lower() if lower else text))
+    if not cache:
+        return tokens
+
+    if len(_token_cache) >= TOKEN_CACHE_SIZE:
+        _token_cache.clear()
+    _token_cache[key] = tokens
+
+    return tokens
+
+def ttr(text: str) -> float:
+    """Function to calculate TTR (Type-Token Ratio) for a given text."""
+    tokens = tokenize(text, lower=True)
+    num_tokens = len(tokens)
+    return len(set(tokens)) / num_tokens if num_tokens > 0 else 0
+
+def ttr_batch(texts) -> list[float]:
+    # TTR for a whole column of texts
+    return [ttr(text) for text in texts]
+
+def ngrams_from_tokens(words, n: int, remove_stopwords: bool = False) -> list[str]:
+    # All n-grams (joined with spaces) in a sequence of tokens
+    if remove_stopwords:
+        stop_words = get_stop_words()
+        words = [word for word in words if word.lower() not in stop_words]
+
+    ngrams = list(zip(*[words[i:] for i in range(n)]))
+    ngrams = [' '.join(ngram) for ngram in ngrams]
+    return ngrams
+
+def find_ngrams(text: str, n: int, remove_stopwords: bool = False) -> list[str]:
+    # Function to find all ngrams in a string
+    return ngrams_from_tokens(tokenize(text), n, remove_stopwords)
+
+def find_ngrams_batch(texts, n: int, remove_stopwords: bool = False) -> list[list[str]]:
+    # find_ngrams for a whole column of texts
+    return [find_ngrams(text, n, remove_stopwords) for text in texts]
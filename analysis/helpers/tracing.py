@@ -0,0 +1,241 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+import tracemalloc
+from helpers._lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# Stage-level instrumentation for the data preparation (see utils.final_data_prep(tracer=...)). Usage:
+#   tracer = tracing.Tracer(trace_memory=True, sample_interval=0.005)
+#   utils.final_data_prep(tracer=tracer)
+#   tracer.summary(); tracer.slowest('user'); tracer.to_chrome_trace('trace.json')
+# Spans nest: a span opened inside another one gets the path 'outer/inner'. Spans of work done in worker
+# processes are recorded by a Tracer in the worker and merged with add_records. Code that is instrumented
+# takes tracer=None and calls get_tracer(tracer), which returns NULL_TRACER when tracing is off: its span()
+# returns a shared no-op context manager, so disabled tracing costs a method call per span.
+
+def max_rss_mb() -> float:
+    # Peak resident memory of this process so far (None where the resource module is not available)
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024 # bytes on macOS, KiB on Linux
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval seconds from a background thread. Samples are counted
+    per (span path, stack), so they can be shown per stage as a flame graph (see Tracer.to_collapsed_stacks).
+    The sampler needs the GIL, so code that holds it for long (e.g., a single large pandas operation) is
+    sampled when it releases it; the sample is then attributed to the Python frame that called it.
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, thread_id: int, get_path):
+        # get_path returns the current span path of the sampled thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(thread_id, get_path), name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, thread_id: int, get_path):
+        while not self._stop.wait(self.interval):
+            path = get_path()
+            if not path:
+                continue # between spans
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.counts[(path, tuple(reversed(stack)))] += 1
+
+class _NullTracer:
+    enabled = False
+    trace_memory = False
+    _span = contextlib.nullcontext()
+
+    def span(self, name: str, **attrs):
+        return self._span
+
+    def add_records(self, records: list[dict]):
+        pass
+
+NULL_TRACER = _NullTracer()
+
+def get_tracer(tracer) -> Tracer:
+    # The tracer to instrument with: tracer itself, or NULL_TRACER if it is None
+    return NULL_TRACER if tracer is None else tracer
+
+class Tracer:
+    """
+    Records the wall time, CPU time and memory of nested stages (spans).
+
+    Args:
+        trace_memory (bool, optional): Whether to measure the peak Python heap (including numpy and pandas
+            buffers) of each span with tracemalloc. Slows down allocation-heavy code. Defaults to False.
+        sample_interval (float, optional): If given, a SamplingProfiler samples the stack of the thread that
+            opened the outermost span every sample_interval seconds while it is open. Worker processes are
+            not sampled. Defaults to None.
+    """
+    enabled = True
+
+    def __init__(self, trace_memory: bool = False, sample_interval: float = None):
+        self.trace_memory = trace_memory
+        self.profiler = SamplingProfiler(sample_interval) if sample_interval else None
+        self.records = []
+        self._stack = [] # open spans: [path, peak traced memory of the span so far]
+        self._started_tracemalloc = False
+
+    def _path(self) -> str:
+        return self._stack[-1][0] if self._stack else ''
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Measures the enclosed block as a span called name. attrs (e.g., user_id) are stored with the span.
+        The span is recorded even if the block raises.
+        """
+        outermost = not self._stack
+        if outermost:
+            if self.trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            if self.profiler is not None:
+                self.profiler.start(threading.get_ident(), self._path)
+
+        path = f'{self._path()}/{name}' if self._stack else name
+        if self.trace_memory:
+            # The peak of the parent so far is kept before the peak is reset for this span
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            start_memory = current
+        self._stack.append([path, 0])
+
+        start_time, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            record = {
+                'name': name,
+                'path': path,
+                'start': start_time,
+                'seconds': time.perf_counter() - wall,
+                'cpu_seconds': time.process_time() - cpu,
+                'max_rss_mb': max_rss_mb(),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'attrs': attrs,
+            }
+            _, peak = self._stack.pop()
+            if self.trace_memory:
+                current, traced_peak = tracemalloc.get_traced_memory()
+                peak = max(peak, traced_peak)
+                record['peak_memory_mb'] = peak / 1024 ** 2
+                record['memory_delta_mb'] = (current - start_memory) / 1024 ** 2
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+            self.records.append(record)
+
+            if outermost:
+                if self.profiler is not None:
+                    self.profiler.stop()
+                if self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+
+    def add_records(self, records: list[dict]):
+        # Adds the records of another tracer (e.g., of a worker process) as children of the current span
+        prefix = self._path()
+        for record in records:
+            self.records.append({**record, 'path': f"{prefix}/{record['path']}" if prefix else record['path']})
+
+    def frame(self) -> pd.DataFrame:
+        # The records as a DataFrame, one row per span, with the attrs as columns and start relative to the first span
+        df = pd.DataFrame([{k: v for k, v in r.items() if k != 'attrs'} | r['attrs'] for r in self.records])
+        if len(df) > 0:
+            df['start'] = df['start'] - df['start'].min()
+            df = df.sort_values('start', kind='stable').reset_index(drop=True)
+        return df
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Totals per span path: number of spans, total and max wall seconds, total CPU seconds and, with
+        trace_memory, the highest peak memory. Sorted by path, so stages appear in their nesting order.
+        """
+        df = self.frame()
+        aggregations = {'count': ('seconds', 'size'), 'seconds': ('seconds', 'sum'), 'max_seconds': ('seconds', 'max'), 'cpu_seconds': ('cpu_seconds', 'sum'), 'max_rss_mb': ('max_rss_mb', 'max')}
+        if 'peak_memory_mb' in df.columns:
+            aggregations['peak_memory_mb'] = ('peak_memory_mb', 'max')
+        return df.groupby('path', sort=True).agg(**aggregations)
+
+    def slowest(self, name: str = 'user', n: int = 10) -> pd.DataFrame:
+        """
+        The n slowest spans called name (e.g., the per-user spans of construct_dfs_for_analysis), with their
+        time relative to the median of all spans with that name, so outliers stand out.
+        """
+        df = self.frame()
+        df = df[df['name'] == name].copy()
+        df['ratio_to_median'] = df['seconds'] / df['seconds'].median()
+        return df.sort_values('seconds', ascending=False).head(n).dropna(axis=1, how='all')
+
+    def to_json(self, path: str = None) -> dict:
+        # The spans (and the profiler samples) as a JSON-serializable dict, optionally written to path
+        data = {'spans': self.records}
+        if self.profiler is not None:
+            data['samples'] = [{'path': span_path, 'stack': list(stack), 'count': count} for (span_path, stack), count in self.profiler.counts.items()]
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(data, f, default=str)
+        return data
+
+    def to_chrome_trace(self, path: str = None) -> dict:
+        """
+        The spans in the Chrome trace event format (open in chrome://tracing or https://ui.perfetto.dev).
+        Spans of worker processes appear under their own process.
+        """
+        origin = min((r['start'] for r in self.records), default=0)
+        events = []
+        for r in self.records:
+            args = {k: v for k, v in r.items() if k in ('path', 'cpu_seconds', 'max_rss_mb', 'peak_memory_mb', 'memory_delta_mb')} | r['attrs']
+            events.append({
+                'name': r['name'], 'cat': r['path'].split('/')[0], 'ph': 'X',
+                'ts': (r['start'] - origin) * 1e6, 'dur': r['seconds'] * 1e6,
+                'pid': r['pid'], 'tid': r['tid'], 'args': args,
+            })
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f, default=str)
+        return trace
+
+    def to_collapsed_stacks(self, path: str = None) -> str:
+        # The profiler samples as collapsed stacks ('span;path;frame;frame count' per line), the input of
+        # flamegraph.pl and speedscope
+        if self.profiler is None:
+            raise ValueError("The tracer has no profiler (pass sample_interval)")
+        lines = [';'.join(span_path.split('/') + list(stack)) + f' {count}' for (span_path, stack), count in sorted(self.profiler.counts.items())]
+        text = '\n'.join(lines)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text + '\n')
+        return text
@@ -1,16 +1,25 @@
-from progressbar import progressbar
-import pandas as pd
-import helpers.db as dbutils
-import helpers.cleaning as data_cleaning_utils
-import helpers.metrics as metrics
-import helpers.structured as structured
-import scipy.stats as stats
+from __future__ import annotations
+import numpy as np
+from helpers._lazy import lazy_import
 from helpers.constants import *
 from numpy import std, mean, sqrt
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-import string
-import nltk
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import functools
+
+# Heavy dependencies are only imported on first use (see helpers._lazy)
+progressbar = lazy_import('progressbar')
+pd = lazy_import('pandas')
+stats = lazy_import('scipy.stats')
+dbutils = lazy_import('helpers.db')
+data_cleaning_utils = lazy_import('helpers.cleaning')
+metrics = lazy_import('helpers.metrics')
+structured = lazy_import('helpers.structured')
+tokens = lazy_import('helpers.tokens')
+lcs = lazy_import('helpers.lcs')
+stagecache = lazy_import('helpers.stagecache')
+eventjson = lazy_import('helpers.eventjson')
+tracing = lazy_import('helpers.tracing')
 
 def compute_ssvs_scores(df_ssvs):
     # Compute conservation score
@@ -45,46 +54,259 @@ def compute_ssvs_scores(df_ssvs):
 
     return df_ssvs
 
-def construct_dfs_for_analysis(users_df, EVENTS_DIR, TREATMENT_LABEL, CONTROL_LABEL):
+def load_events_df_for_user(user_id, EVENTS_DIR, events_store=None, fields=None):
+    # A user's events_df, from the Parquet event store if given, otherwise from their JSON file in EVENTS_DIR.
+    # With fields, only those eventDetails fields are kept per eventName (see eventjson.project_events).
+    if events_store is not None:
+        import helpers.eventstore as eventstore
+        events = eventstore.load_events_df_for_user_from_store(user_id, events_store, fields=fields)
+    else:
+        events = dbutils.load_events_for_user(user_id, EVENTS_DIR, fields=fields)
+    return data_cleaning_utils.create_events_df(events)
+
+def process_user_for_analysis(user_id, EVENTS_DIR, events_store=None, compact=False, tracer=None):
+    '''
+    Build the events, tasks and suggestions frames for a single user. If events_store is given,
+    the events are read from the Parquet event store instead of the JSON files in EVENTS_DIR.
+    With compact=True, events_df and suggestions_df use the compact schema (see cleaning.compact_events_df).
+    With a tracer (see helpers.tracing), the steps are recorded as spans.
+
+    Returns a plain tuple of (user_id, show_suggestion, events_df, tasks_df, suggestions_df) so the
+    result can be pickled back from a worker process. suggestions_df is None for control users.
+    '''
+    tracer = tracing.get_tracer(tracer)
+
+    # The compact schema only keeps the fields the analysis uses, so the rest isn't loaded at all
+    fields = eventjson.ANALYSIS_EVENT_FIELDS if compact else None
+    with tracer.span('load_events'):
+        events_df = load_events_df_for_user(user_id, EVENTS_DIR, events_store, fields)
+    with tracer.span('tasks'):
+        # The double clicks of all users are validated at once in construct_dfs_for_analysis, except in compact
+        # mode, where the raw eventDetails are dropped before that
+        tasks_df = data_cleaning_utils.create_task_df_for_user(events_df, validate=compact)
+        tasks_df['user_id'] = user_id
+        tasks_df = data_cleaning_utils.drop_non_writing_tasks(tasks_df, [user_id])
+
+    show_suggestion = events_df[events_df['eventName'] == 'study_started'].iloc[0]['eventDetails']['user']['showSuggestions']
+
+    suggestions_df = None
+    if show_suggestion:
+        with tracer.span('suggestions'):
+            suggestions_df = data_cleaning_utils.create_suggestions_df_for_user(events_df, tasks_df)
+        with tracer.span('metrics'):
+            tasks_df = metrics.compute_metrics_for_tasks(tasks_df, suggestions_df)
+        suggestions_df['user_id'] = user_id
+
+    events_df['user_id'] = user_id
+    tasks_df = data_cleaning_utils.order_columns(tasks_df, data_cleaning_utils.TASK_COLUMNS, last=['user_id'])
+
+    if compact:
+        with tracer.span('compact'):
+            events_df = data_cleaning_utils.compact_events_df(events_df)
+            if suggestions_df is not None:
+                suggestions_df = data_cleaning_utils.compact_suggestions_df(suggestions_df)
+
+    return user_id, show_suggestion, events_df, tasks_df, suggestions_df
+
+def _process_user_traced(process_user, trace_memory, user_id, EVENTS_DIR, events_store):
+    # Runs process_user in a worker process with a tracer of its own; returns the result and the recorded spans
+    tracer = tracing.Tracer(trace_memory=trace_memory)
+    with tracer.span('user', user_id=user_id):
+        result = process_user(user_id, EVENTS_DIR, events_store, tracer=tracer)
+    return result, tracer.records
+
+def _add_worker_records(tracer, results):
+    # Adds the spans recorded in the workers to tracer (under its current span) and yields the results
+    for result, records in results:
+        tracer.add_records(records)
+        yield result
+
+@functools.lru_cache(maxsize=None)
+def get_user_stage_version(use_events_store: bool) -> str:
+    # Version of the per-user stage: the code that turns a user's events into their frames and metrics,
+    # i.e., the two functions below and every helpers module they use (including those imported lazily)
+    if use_events_store:
+        import helpers.eventstore as loader
+    else:
+        loader = dbutils
+    modules = stagecache.find_helper_modules(data_cleaning_utils, metrics, eventjson, loader)
+    return stagecache.hash_code(*modules, load_events_df_for_user, process_user_for_analysis)
+
+def process_user_for_analysis_cached(user_id, EVENTS_DIR, events_store=None, cache_dir=None, compact=False, tracer=None):
+    '''
+    process_user_for_analysis, memoized in cache_dir. The result is only recomputed when the user's
+    events (their JSON file or their partition of the event store) or the code of the stage change.
+    '''
+    if events_store is not None:
+        inputs = stagecache.hash_directory(f'{events_store}/user_id={user_id}')
+    else:
+        inputs = stagecache.hash_files([f'{EVENTS_DIR}/{user_id}.json'])
+    key = f'{inputs}-{get_user_stage_version(events_store is not None)}'
+    stage = 'user-compact' if compact else 'user'
+    return stagecache.memoize_stage(cache_dir, stage, user_id, key, lambda: process_user_for_analysis(user_id, EVENTS_DIR, events_store, compact, tracer))
+
+def construct_dfs_for_cohort(user_ids, EVENTS_DIR, n_workers=1, events_store=None, compact=False, tracer=None):
+    '''
+    Cohort mode of construct_dfs_for_analysis: loads the events of all users into one events_df, then builds
+    tasks_df, suggestions_df and the task metrics of everyone at once (see cleaning.create_task_df_for_cohort).
+    The frames are equal to the concatenation of the per-user results of process_user_for_analysis.
+
+    Returns a tuple of (show_suggestion, events_df, tasks_df, suggestions_df), where show_suggestion is a
+    Series indexed by user id.
+    '''
+    tracer = tracing.get_tracer(tracer)
+    fields = eventjson.ANALYSIS_EVENT_FIELDS if compact else None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        chunksize = max(1, len(user_ids) // (n_workers * 4))
+        results = executor.map(load_events_df_for_user, user_ids, repeat(EVENTS_DIR), repeat(events_store), repeat(fields), chunksize=chunksize)
+    else:
+        executor = None
+        results = map(load_events_df_for_user, user_ids, repeat(EVENTS_DIR), repeat(events_store), repeat(fields))
+
+    events_dfs = []
+    with tracer.span('load_events'):
+        try:
+            for user_id, events_df in zip(user_ids, progressbar.progressbar(results, max_value=len(user_ids))):
+                events_df['user_id'] = user_id
+                events_dfs.append(events_df)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        events_df = pd.concat(events_dfs)
+
+    with tracer.span('tasks'):
+        tasks_df = data_cleaning_utils.create_task_df_for_cohort(events_df)
+        tasks_df = data_cleaning_utils.drop_non_writing_tasks(tasks_df, user_ids)
+
+    study_started = events_df[events_df['eventName'] == 'study_started'].drop_duplicates('user_id')
+    show_suggestion = pd.Series([details['user']['showSuggestions'] for details in study_started['eventDetails']], index=study_started['user_id']).reindex(user_ids)
+    treatment_users = show_suggestion.index[show_suggestion == True]
+
+    # Suggestions and metrics for the treatment users; the tasks keep their order
+    is_treatment = tasks_df['user_id'].isin(treatment_users).to_numpy()
+    with tracer.span('suggestions'):
+        suggestions_df = data_cleaning_utils.create_suggestions_df_for_cohort(events_df[events_df['user_id'].isin(treatment_users)], tasks_df[is_treatment])
+    with tracer.span('metrics'):
+        treatment_tasks_df = metrics.compute_metrics_for_cohort(tasks_df[is_treatment].copy(), suggestions_df)
+    positions = np.concatenate([np.flatnonzero(is_treatment), np.flatnonzero(~is_treatment)])
+    tasks_df = pd.concat([treatment_tasks_df, tasks_df[~is_treatment]]).iloc[np.argsort(positions, kind='stable')]
+    tasks_df = data_cleaning_utils.order_columns(tasks_df, data_cleaning_utils.TASK_COLUMNS, last=['user_id'])
+
+    if compact:
+        with tracer.span('compact'):
+            events_df = data_cleaning_utils.compact_events_df(events_df)
+            suggestions_df = data_cleaning_utils.compact_suggestions_df(suggestions_df)
+
+    return show_suggestion, events_df, tasks_df, suggestions_df
+
+def construct_dfs_for_analysis(users_df, EVENTS_DIR, TREATMENT_LABEL, CONTROL_LABEL, n_workers=1, events_store=None, cache_dir=None, compact=False, cohort=False, tracer=None):
     '''
     Construct dataframes for analysis
+
+    If events_store is given, events are loaded from the Parquet event store (see helpers.eventstore)
+    rather than from the per-user JSON files in EVENTS_DIR.
+
+    With n_workers > 1, users are processed in a pool of worker processes. Results are collected in
+    the order of users_df, so the output is identical to the serial path.
+
+    With cache_dir, the per-user results are memoized on disk (see process_user_for_analysis_cached),
+    so only new users and users whose events changed are processed again.
+
+    With compact=True, events_df and suggestions_df use the compact schema: categorical ids and names,
+    Arrow-backed text, and flattened eventDetails fields instead of the raw dicts (see memory_report).
+
+    With cohort=True, the frames are built from the concatenated events of all users at once instead of
+    user by user (see construct_dfs_for_cohort); only loading the events is done per user. This can't be
+    combined with cache_dir, which memoizes the per-user results.
+
+    With a tracer (see helpers.tracing), each user is recorded as a 'user' span (with the user_id) containing
+    the spans of its steps, also when the users are processed in worker processes. In cohort mode, the
+    cohort-level steps are recorded instead.
     '''
+    tracer = tracing.get_tracer(tracer)
+    user_ids = users_df.index.unique()
+    if cohort:
+        if cache_dir is not None:
+            raise ValueError("cache_dir memoizes per-user results and can't be used with cohort=True")
+        show_suggestion, events_df, tasks_df, suggestions_df = construct_dfs_for_cohort(user_ids, EVENTS_DIR, n_workers, events_store, compact, tracer)
+        # Set control/treatment group in users_df
+        groups = show_suggestion.map({True: TREATMENT_LABEL, False: CONTROL_LABEL})
+        users_df['group'] = groups.reindex(users_df.index).to_numpy()
+        tasks_df = tasks_df.join(users_df[['group', 'country']], on='user_id')
+        return events_df, tasks_df, suggestions_df
 
     events_dfs = []
     tasks_dfs = []
     suggestions_dfs = []
 
-    for user_id in progressbar(users_df.index.unique()):
-        events = dbutils.load_events_for_user(user_id, EVENTS_DIR)
-        events_df = data_cleaning_utils.create_events_df(events)
-        tasks_df = data_cleaning_utils.create_task_df_for_user(events_df)
-        tasks_df = tasks_df.drop('attention_check')
-        if 'tutorial' in tasks_df.index:
-            tasks_df = tasks_df.drop('tutorial')
+    if cache_dir is not None:
+        process_user = functools.partial(process_user_for_analysis_cached, cache_dir=cache_dir, compact=compact)
+    else:
+        process_user = functools.partial(process_user_for_analysis, compact=compact)
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        chunksize = max(1, len(user_ids) // (n_workers * 4))
+        if tracer.enabled:
+            traced_process_user = functools.partial(_process_user_traced, process_user, tracer.trace_memory)
+            results = _add_worker_records(tracer, executor.map(traced_process_user, user_ids, repeat(EVENTS_DIR), repeat(events_store), chunksize=chunksize))
+        else:
+            results = executor.map(process_user, user_ids, repeat(EVENTS_DIR), repeat(events_store), chunksize=chunksize)
+    else:
+        executor = None
+        def process_user_traced(user_id):
+            with tracer.span('user', user_id=user_id):
+                return process_user(user_id, EVENTS_DIR, events_store, tracer=tracer)
+        results = map(process_user_traced, user_ids)
 
-        # Set control/treatment group in users_df
-        show_suggestion = events_df[events_df['eventName'] == 'study_started'].iloc[0]['eventDetails']['user']['showSuggestions']
-        users_df.loc[user_id, 'group'] = TREATMENT_LABEL if show_suggestion else CONTROL_LABEL
-        
-        if show_suggestion:
-            suggestions_df = data_cleaning_utils.create_suggestions_df_for_user(events_df, tasks_df)
-            tasks_df = metrics.compute_metrics_for_tasks(tasks_df, suggestions_df)
-            suggestions_df['user_id'] = user_id
-            suggestions_dfs.append(suggestions_df)
-        
-        events_df['user_id'] = user_id
-        events_dfs.append(events_df)
+    try:
+        for user_id, show_suggestion, events_df, tasks_df, suggestions_df in progressbar.progressbar(results, max_value=len(user_ids)):
+            # Set control/treatment group in users_df
+            users_df.loc[user_id, 'group'] = TREATMENT_LABEL if show_suggestion else CONTROL_LABEL
 
-        tasks_df['user_id'] = user_id
-        tasks_dfs.append(tasks_df)
+            if suggestions_df is not None:
+                suggestions_dfs.append(suggestions_df)
+            events_dfs.append(events_df)
+            tasks_dfs.append(tasks_df)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    events_df = pd.concat(events_dfs)
-    tasks_df = pd.concat(tasks_dfs)
-    tasks_df = tasks_df.join(users_df[['group', 'country']], on='user_id')
-    suggestions_df = pd.concat(suggestions_dfs)
+    with tracer.span('concat'):
+        concat = data_cleaning_utils.concat_compact if compact else pd.concat
+        events_df = concat(events_dfs)
+        # The frames of control users have no metric columns, so the order is applied again after the concatenation
+        tasks_df = data_cleaning_utils.order_columns(pd.concat(tasks_dfs), data_cleaning_utils.TASK_COLUMNS, last=['user_id'])
+        tasks_df = tasks_df.join(users_df[['group', 'country']], on='user_id')
+        suggestions_df = concat(suggestions_dfs)
+    if not compact:
+        with tracer.span('validate_double_clicks'):
+            data_cleaning_utils.check_double_clicks(events_df)
 
     return events_df, tasks_df, suggestions_df
 
+def memory_report(**frames) -> pd.DataFrame:
+    """
+    Deep memory usage of each column of the given frames, largest first. Usage:
+    `utils.memory_report(events_df=events_df, suggestions_df=suggestions_df)`
+
+    Returns:
+        pd.DataFrame: One row per (frame, column) with the dtype, the number of rows and the memory in MB,
+        followed by one 'TOTAL' row per frame.
+    """
+    rows = []
+    for name, df in frames.items():
+        usage = df.memory_usage(deep=True)
+        dtypes = {'Index': str(df.index.dtype), **{col: str(dtype) for col, dtype in df.dtypes.items()}}
+        for col, n_bytes in usage.items():
+            rows.append({'frame': name, 'column': col, 'dtype': dtypes.get(col), 'rows': len(df), 'MB': n_bytes / 1e6})
+        rows.append({'frame': name, 'column': 'TOTAL', 'dtype': None, 'rows': len(df), 'MB': usage.sum() / 1e6})
+
+    report = pd.DataFrame(rows)
+    report['is_total'] = report['column'] == 'TOTAL'
+    report = report.sort_values(['frame', 'is_total', 'MB'], ascending=[True, True, False], kind='stable').drop(columns=['is_total'])
+    return report.reset_index(drop=True)
+
 def perform_normality_test(df, cols, filter_col, filter_vals):
     # Perform Shapiro-Wilk test for normality
     rows = []
@@ -113,22 +335,25 @@ def perform_statistical_test(df, cols, filter_col, filter_vals, test_name):
 
     for col in cols:
         if test_name == 'ttest':
-            # Perform t-test
-            stat, p_value = stats.ttest_ind(data1[col], data2[col])
-            cohensd = cohens_d(data1[col], data2[col])
+            # Perform t-test (the result also carries the degrees of freedom)
+            test_result = stats.ttest_ind(data1[col], data2[col])
+            result = {
+                'col': col,
+                't_stat': test_result.statistic,
+                'p_value': test_result.pvalue,
+                'cohens_d': cohens_d(data1[col], data2[col]),
+                'df': test_result.df
+            }
         elif test_name == 'mannwhitney':
             # Perform Mann-Whitney U test since the data is not normally distributed
-            stat, p_value = stats.mannwhitneyu(data1[col], data2[col], alternative='two-sided')
-            cliffsd = cliffs_d(data1[col], data2[col])
-
-        result = {
-            'col': col,
-            't_stat' if test_name == 'ttest' else 'u_stat': stat,
-            'p_value': p_value,
-            'cohens_d' if test_name == 'ttest' else 'cliffs_d': cohensd if test_name == 'ttest' else cliffsd
-        }
-        if test_name == 'ttest':
-            result['df'] = stats.ttest_ind(data1[col], data2[col]).df
+            # Cliff's delta follows from the U statistic, so the test isn't run a second time
+            test_result = stats.mannwhitneyu(data1[col], data2[col], alternative='two-sided')
+            result = {
+                'col': col,
+                'u_stat': test_result.statistic,
+                'p_value': test_result.pvalue,
+                'cliffs_d': cliffs_d_from_u(test_result.statistic, len(data1[col]), len(data2[col]))
+            }
         results.append(result)
 
     stats_results = pd.DataFrame(results)
@@ -145,8 +370,170 @@ def cohens_d(x,y):
     return (mean(x) - mean(y)) / sqrt(((nx-1)*std(x, ddof=1) ** 2 + (ny-1)*std(y, ddof=1) ** 2) / dof)
 
 def cliffs_d(x,y):
-    test_result = stats.mannwhitneyu(x, y)
-    return (2*test_result[0] / (len(x) * len(y))) - 1
+    # Exact Cliff's delta, P(x > y) - P(x < y), from sorted ranks in O(n log n). NaN if x or y contains NaN,
+    # as with mannwhitneyu's default nan_policy='propagate'
+    x = np.asarray(x, dtype=float)
+    y = np.sort(np.asarray(y, dtype=float))
+    if np.isnan(x).any() or np.isnan(y).any():
+        return np.nan
+    greater = np.searchsorted(y, x, side='left').sum() # y values below each x
+    less = (len(y) - np.searchsorted(y, x, side='right')).sum() # y values above each x
+    return (greater - less) / (len(x) * len(y))
+
+def cliffs_d_from_u(u, nx, ny):
+    # Cliff's delta from the Mann-Whitney U statistic of x
+    return (2 * np.asarray(u) / (nx * ny)) - 1
+
+def _cohens_d_columns(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # cohens_d for every column of a and b at once
+    na, nb = len(a), len(b)
+    pooled = ((na - 1) * a.var(axis=0, ddof=1) + (nb - 1) * b.var(axis=0, ddof=1)) / (na + nb - 2)
+    return (a.mean(axis=0) - b.mean(axis=0)) / np.sqrt(pooled)
+
+def permutation_test(a: np.ndarray, b: np.ndarray, n_permutations: int = 10_000, seed=None, block_size: int = 1000) -> np.ndarray:
+    """
+    Two-sided permutation test of the difference in means, for every column of a and b at once.
+    Each block of permutations is a boolean assignment matrix, so the permuted means of all columns
+    are a single matrix product.
+
+    Args:
+        a (np.ndarray): (n_a, k) values of the first group.
+        b (np.ndarray): (n_b, k) values of the second group.
+        n_permutations (int, optional): Number of permutations. Defaults to 10,000.
+        seed (int, optional): Seed for the random number generator.
+
+    Returns:
+        np.ndarray: The k p-values, (count(|permuted diff| >= |observed diff|) + 1) / (n_permutations + 1).
+        NaN for columns with NaN values, as with the t-test and Mann-Whitney U test.
+    """
+    a = np.asarray(a, dtype=float).reshape(len(a), -1)
+    b = np.asarray(b, dtype=float).reshape(len(b), -1)
+    rng = np.random.default_rng(seed)
+    pooled = np.concatenate([a, b])
+    na, n = len(a), len(a) + len(b)
+    total = pooled.sum(axis=0)
+    observed = np.abs(a.mean(axis=0) - b.mean(axis=0))
+
+    exceed = np.zeros(pooled.shape[1])
+    for start in range(0, n_permutations, block_size):
+        size = min(block_size, n_permutations - start)
+        in_a = np.zeros((size, n))
+        np.put_along_axis(in_a, np.argsort(rng.random((size, n)), axis=1)[:, :na], 1, axis=1)
+        sum_a = in_a @ pooled
+        diff = sum_a / na - (total - sum_a) / (n - na)
+        exceed += (np.abs(diff) >= observed - 1e-12).sum(axis=0)
+
+    p_values = (exceed + 1) / (n_permutations + 1)
+    p_values[~np.isfinite(observed)] = np.nan
+    return p_values
+
+def adjust_pvalues(p_values, method: str = 'fdr_bh') -> np.ndarray:
+    """
+    Corrects p-values for multiple comparisons.
+
+    Args:
+        p_values (array-like): The p-values (NaN values are left out of the correction and stay NaN).
+        method (str, optional): 'fdr_bh' (Benjamini-Hochberg), 'holm' or 'bonferroni'. Defaults to 'fdr_bh'.
+
+    Returns:
+        np.ndarray: The adjusted p-values.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full(len(p_values), np.nan)
+    valid = ~np.isnan(p_values)
+    p = p_values[valid]
+    m = len(p)
+    if m == 0:
+        return adjusted
+
+    order = np.argsort(p)
+    if method == 'bonferroni':
+        result = p * m
+    elif method == 'holm':
+        result = np.empty(m)
+        result[order] = np.maximum.accumulate(p[order] * (m - np.arange(m)))
+    elif method == 'fdr_bh':
+        result = np.empty(m)
+        result[order] = np.minimum.accumulate((p[order] * m / np.arange(1, m + 1))[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown correction method: {method}")
+
+    adjusted[valid] = np.minimum(result, 1)
+    return adjusted
+
+def batch_statistical_tests(df, cols, filter_col, filter_vals, strata=(None,), tests=('ttest', 'mannwhitney'), n_permutations=0, correction='fdr_bh', alpha=0.05, seed=None) -> pd.DataFrame:
+    """
+    Compares two groups (filter_vals[0] vs filter_vals[1] of filter_col) on many columns, overall and within
+    subgroups, and returns one tidy table. Each cell (stratification x subgroup) is split once, and the tests
+    run on all columns at once (scipy's axis=0). Usage (AI vs No AI, overall, per country and per country and task):
+    `utils.batch_statistical_tests(dfp, ['ttr', 'ai_reliance'], 'group', [TREATMENT_LABEL, CONTROL_LABEL], strata=[None, 'country', ['country', 'id']])`
+
+    Args:
+        df (pd.DataFrame): The data (one row per unit).
+        cols (list): The columns to compare.
+        filter_col (str): The column defining the two groups.
+        filter_vals (list): The two values of filter_col to compare.
+        strata (list, optional): The stratifications: None (whole frame), a column name, or a list of column names. Defaults to (None,).
+        tests (tuple, optional): Any of 'ttest' (with cohens_d), 'mannwhitney' (with cliffs_d) and 'permutation'
+            (difference in means, with cohens_d). Defaults to ('ttest', 'mannwhitney').
+        n_permutations (int, optional): Number of permutations of the 'permutation' test. Defaults to 10,000 if that test is requested.
+        correction (str, optional): Multiple-comparison correction ('fdr_bh', 'holm', 'bonferroni' or None), applied
+            separately to each test across all columns and cells. Defaults to 'fdr_bh'.
+        alpha (float, optional): Significance level. Defaults to 0.05.
+        seed (int, optional): Seed for the permutation test.
+
+    Returns:
+        pd.DataFrame: One row per (stratification, subgroup, column, test) with the statistic, degrees of freedom
+        (t-test), p-value, effect size, group sizes, adjusted p-value and significance.
+    """
+    cols = list(cols)
+    strata = [[] if s is None else [s] if isinstance(s, str) else list(s) for s in strata]
+    strata_cols = list(dict.fromkeys(col for s in strata for col in s))
+    if 'permutation' in tests and n_permutations == 0:
+        n_permutations = 10_000
+
+    rows = []
+    for stratum in strata:
+        cells = df.groupby(stratum) if len(stratum) > 0 else [((), df)]
+        for key, cell in cells:
+            key = key if isinstance(key, tuple) else (key,)
+            subgroup = dict(zip(stratum, key))
+            base = {'strata': ', '.join(stratum) if len(stratum) > 0 else 'all', **{col: subgroup.get(col) for col in strata_cols}}
+
+            a = cell.loc[cell[filter_col] == filter_vals[0], cols].to_numpy(dtype=float)
+            b = cell.loc[cell[filter_col] == filter_vals[1], cols].to_numpy(dtype=float)
+            if len(a) < 2 or len(b) < 2:
+                continue
+
+            results = {}
+            if 'ttest' in tests or 'permutation' in tests:
+                effect = _cohens_d_columns(a, b)
+            if 'ttest' in tests:
+                t = stats.ttest_ind(a, b, axis=0)
+                results['ttest'] = (t.statistic, t.df, t.pvalue, 'cohens_d', effect)
+            if 'mannwhitney' in tests:
+                u = stats.mannwhitneyu(a, b, alternative='two-sided', axis=0)
+                results['mannwhitney'] = (u.statistic, np.full(len(cols), np.nan), u.pvalue, 'cliffs_d', cliffs_d_from_u(u.statistic, len(a), len(b)))
+            if 'permutation' in tests:
+                p = permutation_test(a, b, n_permutations, seed)
+                results['permutation'] = (a.mean(axis=0) - b.mean(axis=0), np.full(len(cols), np.nan), p, 'cohens_d', effect)
+
+            for test in tests:
+                stat, dof, p_value, effect_name, effect_size = results[test]
+                for i, col in enumerate(cols):
+                    rows.append({**base, 'col': col, 'test': test, 'stat': stat[i], 'df': dof[i], 'p_value': p_value[i],
+                                 'effect_size_name': effect_name, 'effect_size': effect_size[i], 'n1': len(a), 'n2': len(b)})
+
+    results = pd.DataFrame(rows, columns=['strata', *strata_cols, 'col', 'test', 'stat', 'df', 'p_value', 'effect_size_name', 'effect_size', 'n1', 'n2'])
+    if correction is not None:
+        results['p_adjusted'] = np.nan
+        for test, idx in results.groupby('test').groups.items():
+            results.loc[idx, 'p_adjusted'] = adjust_pvalues(results.loc[idx, 'p_value'], correction)
+    else:
+        results['p_adjusted'] = results['p_value']
+    results['significant'] = results['p_adjusted'] < alpha
+
+    return results
 
 def lookup_size(delta: float, metric: str) -> str:
     """
@@ -169,41 +556,179 @@ def lookup_size(delta: float, metric: str) -> str:
     if delta >= dull['large']:
         return 'large'
 
-def find_ngrams(mystring, n, remove_stopwords=False):
-    # Function to find all ngrams in a string
-    # Download the punkt tokenizer model
-    nltk.download('punkt', quiet=True)
+def bootstrap_weights(n: int, n_boot: int, frac: float = 1.0, rng=None) -> np.ndarray:
+    """
+    Draws n_boot bootstrap resamples of n units at once. Row b holds how often each unit is drawn in
+    replicate b, which is the same as df.sample(frac=frac, replace=True) without materializing the rows.
+
+    Returns:
+        np.ndarray: An (n_boot, n) matrix of draw counts.
+    """
+    if n < 1:
+        raise ValueError("Can't bootstrap an empty sample")
+    rng = rng if rng is not None else np.random.default_rng()
+    size = int(round(frac * n))
+    return rng.multinomial(size, np.full(n, 1 / n), size=n_boot)
+
+def _bootstrap_blocks(n: int, n_boot: int, frac: float, rng, max_cells: int = 10_000_000):
+    # Yields weight matrices of at most max_cells entries, so memory stays bounded for many replicates
+    block_size = max(1, max_cells // max(n, 1))
+    for start in range(0, n_boot, block_size):
+        yield bootstrap_weights(n, min(block_size, n_boot - start), frac, rng)
+
+def percentile_ci(replicates: np.ndarray, ci: float = 0.95) -> tuple:
+    # Percentile confidence interval of each column of the replicates (replicates with NaN are ignored)
+    alpha = (1 - ci) / 2 * 100
+    return np.nanpercentile(replicates, alpha, axis=0), np.nanpercentile(replicates, 100 - alpha, axis=0)
+
+def bootstrap_grouped_means(df: pd.DataFrame, value_col: str, group_cols, n_boot: int = 10_000, frac: float = 1.0, ci: float = 0.95, seed=None, return_replicates: bool = False):
+    """
+    Bootstraps the mean of value_col per group (a proportion if value_col is boolean). Rows are resampled
+    from the whole frame as in `df.sample(frac=frac, replace=True)`, then grouped, for all replicates at once.
+    Usage (share of essays with Indian artifacts per country and group, with 95% CIs):
+    `utils.bootstrap_grouped_means(df.assign(is_india=df['artifact_country_binned'] == 'India'), 'is_india', ['country', 'group'])`
+
+    Args:
+        df (pd.DataFrame): One row per unit (e.g., essay).
+        value_col (str): The outcome column (numeric or boolean).
+        group_cols (str or list): The column(s) to group by.
+        n_boot (int, optional): Number of bootstrap replicates. Defaults to 10,000.
+        frac (float, optional): Size of each resample as a fraction of len(df). Defaults to 1.0.
+        ci (float, optional): Confidence level of the percentile intervals. Defaults to 0.95.
+        seed (int, optional): Seed for the random number generator.
+        return_replicates (bool, optional): Whether to also return the replicates. Defaults to False.
+
+    Returns:
+        pd.DataFrame: One row per group with the observed mean, the mean of the replicates and the CI bounds.
+        With return_replicates=True, also a DataFrame with one row per replicate and one column per group
+        (NaN if a replicate has no unit of that group).
+    """
+    group_cols = [group_cols] if isinstance(group_cols, str) else list(group_cols)
+    rng = np.random.default_rng(seed)
+
+    df = df.dropna(subset=group_cols)
+    if len(df) == 0:
+        raise ValueError(f"No rows with values for all of {group_cols} to bootstrap")
+    grouped = df.groupby(group_cols)
+    codes = grouped.ngroup().to_numpy()
+    labels = grouped.size().index
+    onehot = np.zeros((len(df), len(labels)))
+    onehot[np.arange(len(df)), codes] = 1
+    values = df[value_col].to_numpy(dtype=float)
+    weighted_onehot = onehot * values[:, None]
+
+    replicates = []
+    for weights in _bootstrap_blocks(len(df), n_boot, frac, rng):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            replicates.append((weights @ weighted_onehot) / (weights @ onehot))
+    replicates = np.concatenate(replicates)
+
+    low, high = percentile_ci(replicates, ci)
+    summary = labels.to_frame(index=False)
+    summary['estimate'] = weighted_onehot.sum(axis=0) / onehot.sum(axis=0)
+    summary['boot_mean'] = np.nanmean(replicates, axis=0)
+    summary['ci_low'] = low
+    summary['ci_high'] = high
 
-    # find the words in the string
-    words = word_tokenize(mystring)
+    if return_replicates:
+        return summary, pd.DataFrame(replicates, columns=labels)
+    return summary
 
-    if remove_stopwords:
-        stop_words = set(stopwords.words('english'))
-        punctuation = set(string.punctuation)
-        words = [word for word in words if word.lower() not in stop_words and word.lower() not in punctuation]
+def bootstrap_effect_sizes(x, y, n_boot: int = 10_000, ci: float = 0.95, seed=None, return_replicates: bool = False):
+    """
+    Bootstraps cohens_d and cliffs_d between two samples, resampling each sample with replacement at its
+    own size. Cohen's d is computed from weighted moments; Cliff's delta from the (len(x), len(y)) matrix
+    of sign(x_i - y_j), which is built once and weighted by the draw counts of each replicate.
+
+    Returns:
+        pd.DataFrame: One row per effect size with the observed value, the mean of the replicates and the CI bounds.
+        With return_replicates=True, also a DataFrame with the replicates of both effect sizes.
+
+    Raises:
+        ValueError: If a sample has fewer than 2 values (Cohen's d needs the variance of both).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nx, ny = len(x), len(y)
+    if nx < 2 or ny < 2:
+        raise ValueError(f"Need at least 2 values in each sample to bootstrap effect sizes, got {nx} and {ny}")
+    rng = np.random.default_rng(seed)
+    signs = np.sign(x[:, None] - y[None, :])
+
+    # Keep each block of replicates (and its (block, len(y)) product with the sign matrix) below ~10M cells
+    block_size = max(1, 10_000_000 // max(nx * ny, nx + ny, 1))
+    cohens, cliffs = [], []
+    for start in range(0, n_boot, block_size):
+        size = min(block_size, n_boot - start)
+        wx = bootstrap_weights(nx, size, rng=rng)
+        wy = bootstrap_weights(ny, size, rng=rng)
+
+        mean_x, mean_y = wx @ x / nx, wy @ y / ny
+        var_x = (wx @ x ** 2 - nx * mean_x ** 2) / (nx - 1)
+        var_y = (wy @ y ** 2 - ny * mean_y ** 2) / (ny - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cohens.append((mean_x - mean_y) / np.sqrt(((nx - 1) * var_x + (ny - 1) * var_y) / (nx + ny - 2)))
+        cliffs.append(((wx @ signs) * wy).sum(axis=1) / (nx * ny))
+
+    replicates = pd.DataFrame({'cohens_d': np.concatenate(cohens), 'cliffs_d': np.concatenate(cliffs)})
+    low, high = percentile_ci(replicates.to_numpy(), ci)
+    summary = pd.DataFrame({
+        'effect_size': replicates.columns,
+        'estimate': [cohens_d(x, y), signs.mean()],
+        'boot_mean': replicates.mean().to_numpy(),
+        'ci_low': low,
+        'ci_high': high
+    })
 
-    ngrams = list(zip(*[words[i:] for i in range(n)]))
-    ngrams = [' '.join(ngram) for ngram in ngrams]
-    return ngrams
+    if return_replicates:
+        return summary, replicates
+    return summary
 
-def final_data_prep():
+def find_ngrams(mystring, n, remove_stopwords=False):
+    # Function to find all ngrams in a string
+    # Tokenization, the punkt download and the stopword set are shared and cached in helpers.tokens
+    return tokens.find_ngrams(mystring, n, remove_stopwords)
+
+def ttr_for_users_cached(dfp, cache_dir) -> pd.Series:
+    # TTR of each essay, memoized per user (keyed by the user's essays and the tokenization code)
+    version = stagecache.hash_code(tokens)
+    ttr = pd.Series(np.nan, index=dfp.index)
+    for user_id, texts in dfp.groupby('user_id', sort=False)['finalHtml_stripped']:
+        key = f'{stagecache.hash_texts(texts)}-{version}'
+        ttr.loc[texts.index] = stagecache.memoize_stage(cache_dir, 'ttr', user_id, key, lambda: tokens.ttr_batch(texts))
+    return ttr
+
+def final_data_prep(n_workers=1, events_store=None, cache_dir=None, compact=False, cohort=False, tracer=None, update_embeddings=False):
     # Calls all the relevant functions to prepare the data for analysis
-    users_df = data_cleaning_utils.load_qualtrics_csv('data/qualtrics.csv')
-    users_df = data_cleaning_utils.clean_users_df(users_df, keep_only_prolific_for_india=True, keep_only_prolific_for_us=True, remove_born_outside=True, remove_pilot=True)
-    users_df['group'] = None
+    # With cache_dir (e.g., 'data/cache/stages'), the per-user stages (events, tasks, suggestions, metrics, TTR)
+    # are memoized, so only affected users are recomputed; the user filters are cheap and always re-applied.
+    # With cohort=True, the frames are built for all users at once (see construct_dfs_for_cohort).
+    # With a tracer (helpers.tracing.Tracer), every stage, user and step is recorded; see tracer.summary().
+    # The essay embeddings are read from data/embeddings/study-120.pkl; with update_embeddings=True, essays
+    # missing from it are embedded with the API and added (see structured.get_essay_embeddings_for_all_essays).
+    tracer = tracing.get_tracer(tracer)
+
+    with tracer.span('load_users'):
+        users_df = data_cleaning_utils.load_qualtrics_csv('data/qualtrics.csv')
+    with tracer.span('clean_users'):
+        users_df = data_cleaning_utils.clean_users_df(users_df, keep_only_prolific_for_india=True, keep_only_prolific_for_us=True, remove_born_outside=True, remove_pilot=True)
+        users_df['group'] = None
 
-    events_df, tasks_df, suggestions_df = construct_dfs_for_analysis(users_df, 'data/events', TREATMENT_LABEL, CONTROL_LABEL)
+    with tracer.span('construct_dfs'):
+        events_df, tasks_df, suggestions_df = construct_dfs_for_analysis(users_df, 'data/events', TREATMENT_LABEL, CONTROL_LABEL, n_workers=n_workers, events_store=events_store, cache_dir=cache_dir, compact=compact, cohort=cohort, tracer=tracer)
     
     # Clean up tasks_df to make it easier to work with for analysis
-    dfp = tasks_df.drop(columns=['prompt', 'minWords', 'finalHtml']).reset_index()
+    with tracer.span('prepare_tasks'):
+        dfp = tasks_df.drop(columns=['prompt', 'minWords', 'finalHtml']).reset_index()
     
     # Compute some simple metrics for each essay
-    dfp['ttr'] = dfp['finalHtml_stripped'].apply(metrics.calculate_ttr)
-    dfp['acceptance_rate'] = dfp['accepted'] / dfp['shown']
+    with tracer.span('ttr'):
+        dfp['ttr'] = ttr_for_users_cached(dfp, cache_dir) if cache_dir is not None else tokens.ttr_batch(dfp['finalHtml_stripped'])
+    with tracer.span('acceptance_rate'):
+        dfp['acceptance_rate'] = dfp['accepted'] / dfp['shown']
 
     # Compute the essay embedding for each essay
-    dfp = structured.get_essay_embeddings_for_all_essays(dfp, 'data/embeddings/study-120.pkl')
+    with tracer.span('embeddings'):
+        dfp = structured.get_essay_embeddings_for_all_essays(dfp, 'data/embeddings/study-120.pkl', update=update_embeddings)
 
     return users_df, events_df, dfp, suggestions_df
-    
-    
\ No newline at end of file
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+# The helpers are imported as `helpers.x` from the analysis directory (as in the notebooks)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers.synthetic as synthetic
+import helpers.cleaning as cleaning
+import helpers.tokens as tokens
+
+@pytest.fixture(scope='session')
+def synthetic_study(tmp_path_factory):
+    # A small synthetic study with the layout of data/ (see helpers.synthetic)
+    data_dir = str(tmp_path_factory.mktemp('study'))
+    synthetic.generate_study(data_dir, n_users=20, seed=0)
+    return data_dir
+
+@pytest.fixture
+def study_users(synthetic_study):
+    # The cleaned users of the synthetic study, as in final_data_prep (a new frame per test, the builders modify it)
+    users_df = cleaning.load_qualtrics_csv(f'{synthetic_study}/qualtrics.csv')
+    users_df = cleaning.clean_users_df(users_df, keep_only_prolific_for_india=True, keep_only_prolific_for_us=True, remove_born_outside=True, remove_pilot=True)
+    users_df['group'] = None
+    return users_df
+
+@pytest.fixture
+def whitespace_tokenizer(monkeypatch):
+    # Tokenizes on whitespace instead of nltk's word_tokenize, whose punkt data may not be installed
+    monkeypatch.setattr(tokens.nltk.tokenize, 'word_tokenize', str.split)
+    monkeypatch.setattr(tokens, '_resources_ready', True)
+    monkeypatch.setattr(tokens, '_token_cache', {})
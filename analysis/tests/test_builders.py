@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+import helpers.utils as utils
+from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+
+def _construct(users_df, data_dir, **options):
+    events_df, tasks_df, suggestions_df = utils.construct_dfs_for_analysis(users_df, f'{data_dir}/events', TREATMENT_LABEL, CONTROL_LABEL, **options)
+    return users_df, events_df, tasks_df, suggestions_df
+
+def _assert_same(expected, result):
+    for a, b in zip(expected, result):
+        if 'eventDetails' in a.columns:
+            assert list(a['eventDetails']) == list(b['eventDetails'])
+            a, b = a.drop(columns=['eventDetails']), b.drop(columns=['eventDetails'])
+        pd.testing.assert_frame_equal(a, b, check_exact=True)
+
+@pytest.mark.parametrize('options', [{'cohort': True}, {'n_workers': 2}, {'cohort': True, 'n_workers': 2}])
+def test_builders_agree(study_users, synthetic_study, options):
+    expected = _construct(study_users.copy(), synthetic_study)
+    _assert_same(expected, _construct(study_users.copy(), synthetic_study, **options))
+
+def test_builders_agree_for_any_user_order(study_users, synthetic_study):
+    # The column order doesn't depend on whether the first user is a control or a treatment user
+    results = [_construct(study_users.sample(frac=1, random_state=seed), synthetic_study) for seed in range(3)]
+    for result in results:
+        assert list(result[2].columns) == list(results[0][2].columns)
+        assert list(result[3].columns) == list(results[0][3].columns)
+    assert list(results[0][2].columns[-3:]) == ['user_id', 'group', 'country']
+    assert list(results[0][3].columns[-2:]) == ['task_id', 'user_id']
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('use_events_store', [False, True])
+def test_process_pool_matches_serial(study_users, synthetic_study, tmp_path, compact, use_events_store):
+    # process_user_for_analysis in worker processes (results collected in users_df order) vs in this process
+    options = {'compact': compact}
+    if use_events_store:
+        import helpers.eventstore as eventstore
+        options['events_store'] = str(tmp_path / 'store')
+        eventstore.write_events_to_store(f'{synthetic_study}/events', options['events_store'])
+    expected = _construct(study_users.copy(), synthetic_study, n_workers=1, **options)
+    _assert_same(expected, _construct(study_users.copy(), synthetic_study, n_workers=3, **options))
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import pytest
+import helpers.cleaning as cleaning
+
+def _events(sequence, user_id='p-1'):
+    # sequence: (timestamp, eventName, taskId) tuples; task_completed events of a task have identical details
+    return pd.DataFrame({
+        'eventName': [name for _, name, _ in sequence],
+        'timestamp': [timestamp for timestamp, _, _ in sequence],
+        'eventDetails': [{'taskId': task, 'finalHtml': f'<p>{task}</p>'} if name == 'task_completed' else {} for _, name, task in sequence],
+        'user_id': user_id,
+    })
+
+def _original_violations(events_df):
+    # The check of the original create_task_df_for_user: consecutive duplicated task_completed events of the same task
+    dftt = events_df[events_df['eventName'] == 'task_completed'].sort_values('timestamp').reset_index(drop=True)
+    dftt = pd.concat([dftt[['timestamp']], pd.json_normalize(list(dftt['eventDetails']))], axis=1)
+    duplicated_rows = dftt[dftt.duplicated(subset=dftt.drop(columns=['timestamp']).columns)].reset_index(drop=True)
+    violations = []
+    for i in range(len(duplicated_rows) - 1):
+        if duplicated_rows.loc[i, 'taskId'] != duplicated_rows.loc[i + 1, 'taskId']:
+            continue
+        t1, t2 = duplicated_rows.loc[i, 'timestamp'], duplicated_rows.loc[i + 1, 'timestamp']
+        n = ((events_df['timestamp'] > t1) & (events_df['timestamp'] < t2)).sum()
+        if n > 0:
+            violations.append((t1, t2, n))
+    return violations
+
+CLEAN = [(0, 'task_started', None), (10, 'task_completed', 'food'), (11, 'task_completed', 'food'), (12, 'task_completed', 'food'),
+         (20, 'task_started', None), (30, 'task_completed', 'movie'), (31, 'task_completed', 'movie')]
+VIOLATING = [(0, 'task_started', None), (10, 'task_completed', 'food'), (11, 'task_completed', 'food'), (12, 'suggestion_shown', None),
+             (13, 'task_completed', 'food'), (20, 'task_started', None), (30, 'task_completed', 'movie')]
+
+@pytest.mark.parametrize('sequence, expected', [(CLEAN, []), (VIOLATING, [(11, 13, 1)])])
+def test_find_double_click_violations(sequence, expected):
+    events_df = _events(sequence)
+    assert _original_violations(events_df) == expected
+    report = cleaning.find_double_click_violations(events_df)
+    assert list(zip(report['time_first'], report['time_duplicate'], report['n_events_between'])) == expected
+    assert (report['user_id'] == 'p-1').all()
+
+def test_find_double_click_violations_across_users():
+    events_df = pd.concat([_events(CLEAN, 'p-1'), _events(VIOLATING, 'p-2'), _events(CLEAN, 'p-3')], ignore_index=True)
+    report = cleaning.find_double_click_violations(events_df)
+    assert report[['user_id', 'taskId', 'n_events_between']].values.tolist() == [['p-2', 'food', 1]]
+
+def test_check_double_clicks_warns_by_default(capsys):
+    events_df = _events(VIOLATING)
+    assert len(cleaning.check_double_clicks(events_df)) == 1
+    assert 'Warning' in capsys.readouterr().out
+    assert len(cleaning.check_double_clicks(_events(CLEAN))) == 0
+    with pytest.raises(ValueError):
+        cleaning.check_double_clicks(events_df, raise_error=True)
+
+def _tasks(intervals, user_id='p-1'):
+    return pd.DataFrame({'time_started': [s for _, s, _ in intervals], 'time_completed': [e for _, _, e in intervals], 'user_id': user_id},
+                        index=pd.Index([task for task, _, _ in intervals], name='id'))
+
+def _rowwise_task_ids(suggestions_df, tasks_df):
+    return [cleaning.find_task_id_for_suggestion(t, tasks_df) for t in suggestions_df['time_shown']]
+
+# Overlapping intervals (the first task in order wins), an unfinished task and boundaries
+INTERVALS = [('food', 0, 100), ('movie', 50, 60), ('travel', 55, 200), ('holiday', 250, np.nan), ('music', 300, 310)]
+TIMES = [-5, 0, 10, 55, 58, 100, 101, 150, 200, 240, 260, 300, 310, 400]
+
+@pytest.mark.parametrize('order', [[0, 1, 2, 3, 4], [2, 0, 4, 1, 3]], ids=['sorted', 'unsorted'])
+def test_find_task_ids_for_suggestions_matches_rowwise(order):
+    tasks_df = _tasks([INTERVALS[i] for i in order])
+    suggestions_df = pd.DataFrame({'time_shown': TIMES}, index=np.arange(len(TIMES)) * 2)
+    task_ids = cleaning.find_task_ids_for_suggestions(suggestions_df, tasks_df)
+    assert task_ids.tolist() == _rowwise_task_ids(suggestions_df, tasks_df)
+    assert task_ids.index.equals(suggestions_df.index)
+    if order == sorted(order):
+        assert task_ids.tolist() == [None, 'food', 'food', 'food', 'food', 'food', 'travel', 'travel', 'travel', None, None, 'music', 'music', None]
+
+def test_find_task_ids_for_suggestions_by_user():
+    rng = np.random.default_rng(0)
+    tasks, suggestions = [], []
+    for u in range(6):
+        starts = np.sort(rng.integers(0, 1000, size=5))
+        intervals = [(f't{i}', s, s + rng.integers(0, 300)) for i, s in enumerate(starts)]
+        if u % 3 == 0:
+            intervals = intervals[::-1]  # falls back to the row-wise lookup for this user
+        tasks.append(_tasks(intervals, f'p-{u}'))
+        suggestions.append(pd.DataFrame({'time_shown': rng.integers(-50, 1400, size=40), 'user_id': f'p-{u}'}))
+    suggestions.append(pd.DataFrame({'time_shown': [10], 'user_id': 'p-no-tasks'}))
+    tasks_df, suggestions_df = pd.concat(tasks), pd.concat(suggestions, ignore_index=True)
+
+    task_ids = cleaning.find_task_ids_for_suggestions(suggestions_df, tasks_df, by='user_id')
+    expected = [cleaning.find_task_id_for_suggestion(t, tasks_df[tasks_df['user_id'] == u]) for t, u in zip(suggestions_df['time_shown'], suggestions_df['user_id'])]
+    assert task_ids.tolist() == expected
+    assert task_ids.iloc[-1] is None
+
+def test_compact_events_df_keeps_the_event_fields(study_users, synthetic_study):
+    import helpers.utils as utils
+    from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+    events_df, _, _ = utils.construct_dfs_for_analysis(study_users, f'{synthetic_study}/events', TREATMENT_LABEL, CONTROL_LABEL)
+    compact = cleaning.compact_events_df(events_df)
+
+    for (_, event), (_, row) in zip(events_df.iterrows(), compact.iterrows()):
+        details = event['eventDetails']
+        expected = {
+            'task_id': details.get('taskId', (details.get('task') or {}).get('id')),
+            'suggestionId': details.get('suggestionId'),
+            'rejection_reason': details.get('reason'),
+            'showSuggestions': (details.get('user') or {}).get('showSuggestions'),
+        }
+        assert {col: None if pd.isna(row[col]) else row[col] for col in expected} == expected
+    assert compact.index.equals(events_df.index)
+    assert compact['eventName'].astype(object).tolist() == events_df['eventName'].tolist()
+    assert compact['timestamp'].tolist() == events_df['timestamp'].tolist()
+    assert compact['user_id'].astype(object).tolist() == events_df['user_id'].tolist()
+    assert compact['rejection_reason'].notna().any() and compact['showSuggestions'].notna().any()
+
+def test_concat_compact_keeps_all_categories():
+    # The second user has no rejections (empty float categories) and other task ids than the first
+    first = cleaning.compact_events_df(_events(VIOLATING, 'p-1').assign(eventDetails=[{'taskId': 'food', 'reason': 'implicit'}] * 7))
+    second = cleaning.compact_events_df(_events(CLEAN, 'p-2').assign(eventDetails=[{'taskId': 'movie'}] * 7))
+    third = cleaning.compact_events_df(_events(CLEAN, 'p-3').assign(eventDetails=[{'taskId': 'travel', 'reason': 'pressed_escape'}] * 7))
+    df = cleaning.concat_compact([first, second, third])
+
+    assert list(df.columns) == list(first.columns)
+    for col in ('eventName', 'task_id', 'rejection_reason', 'user_id'):
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+        assert set(df[col].cat.categories) == set(df[col].dropna())
+    assert df['task_id'].astype(object).tolist() == ['food'] * 7 + ['movie'] * 7 + ['travel'] * 7
+    assert [None if pd.isna(r) else r for r in df['rejection_reason']] == ['implicit'] * 7 + [None] * 7 + ['pressed_escape'] * 7
+    pd.testing.assert_frame_equal(df.astype({col: object for col in ('eventName', 'task_id', 'rejection_reason', 'user_id')}),
+                                  pd.concat([first, second, third]).astype({col: object for col in ('eventName', 'task_id', 'rejection_reason', 'user_id')}))
@@ -0,0 +1,77 @@
+import os
+import json
+import uuid
+import pytest
+import helpers.db as dbutils
+
+# The download tests run against the Firestore emulator, e.g.
+#   firebase emulators:start --only firestore
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python -m pytest tests/test_db.py
+requires_emulator = pytest.mark.skipif(not os.environ.get('FIRESTORE_EMULATOR_HOST'), reason='FIRESTORE_EMULATOR_HOST is not set')
+
+def _event(timestamp, name='suggestion_shown'):
+    return {'eventName': name, 'timestamp': timestamp, 'eventDetails': {'suggestionId': f's-{timestamp}'}}
+
+@pytest.fixture
+def db():
+    from google.cloud import firestore
+    client = firestore.Client(project=os.environ.get('GCLOUD_PROJECT', 'caai-portal'))
+    user_ids = []
+    yield client, user_ids
+    for user_id in user_ids:
+        for doc in client.collection(f'users/{user_id}/events').list_documents():
+            doc.delete()
+
+def _add_events(client, user_id, events, start=0):
+    # Document IDs in event order, as the query streams the documents ordered by ID
+    for i, event in enumerate(events, start):
+        client.collection(f'users/{user_id}/events').document(f'{i:06d}').set(event)
+
+@requires_emulator
+def test_download_events_data_for_users(db, tmp_path):
+    client, user_ids = db
+    user_ids += [f'test-{uuid.uuid4().hex}' for _ in range(3)]
+    events = {user_id: [_event(1000 * i + j) for j in range(5 + i)] for i, user_id in enumerate(user_ids)}
+    for user_id in user_ids:
+        _add_events(client, user_id, events[user_id])
+
+    assert dbutils.download_events_data_for_users(user_ids, client, str(tmp_path), max_workers=2) is None
+    for user_id in user_ids:
+        assert dbutils.load_events_for_user(user_id, str(tmp_path)) == events[user_id]
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+    # Existing files are skipped
+    _add_events(client, user_ids[0], [_event(50)], start=100)
+    dbutils.download_events_data_for_users(user_ids, client, str(tmp_path), max_workers=2)
+    assert dbutils.load_events_for_user(user_ids[0], str(tmp_path)) == events[user_ids[0]]
+
+@requires_emulator
+def test_incremental_download(db, tmp_path):
+    client, user_ids = db
+    user_ids += [f'test-{uuid.uuid4().hex}' for _ in range(2)]
+    first, second = user_ids
+    _add_events(client, first, [_event(t) for t in (10, 20, 30)])
+    _add_events(client, second, [_event(t) for t in (15, 25)])
+
+    assert sorted(dbutils.download_events_data_for_users(user_ids, client, str(tmp_path), incremental=True)) == sorted(user_ids)
+    assert dbutils.load_sync_state(str(tmp_path)) == {first: 30, second: 25}
+
+    # Only the events since the watermark are queried; one logged in the same millisecond as the watermark is kept
+    assert dbutils.get_events_for_userid(client, first, since=20) == [_event(20), _event(30)]
+    _add_events(client, first, [_event(30, 'suggestion_accepted'), _event(40)], start=3)
+    assert dbutils.download_events_data_for_users(user_ids, client, str(tmp_path), incremental=True) == [first]
+    assert dbutils.load_events_for_user(first, str(tmp_path)) == [_event(t) for t in (10, 20, 30)] + [_event(30, 'suggestion_accepted'), _event(40)]
+    assert dbutils.load_sync_state(str(tmp_path)) == {first: 40, second: 25}
+
+    # Nothing new: no user is updated and the files stay as they are
+    assert dbutils.download_events_data_for_users(user_ids, client, str(tmp_path), incremental=True) == []
+    assert len(dbutils.load_events_for_user(first, str(tmp_path))) == 5
+
+def test_write_json_atomic_keeps_the_old_file_on_failure(tmp_path):
+    path = str(tmp_path / 'p-1.json')
+    dbutils.write_json_atomic(path, [_event(1)])
+    with pytest.raises(TypeError):
+        dbutils.write_json_atomic(path, [_event(2), {'timestamp': object()}])
+    with open(path) as f:
+        assert json.load(f) == [_event(1)]
+    assert os.listdir(tmp_path) == ['p-1.json']
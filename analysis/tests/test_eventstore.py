@@ -0,0 +1,55 @@
+import os
+import json
+import pandas as pd
+import pytest
+import helpers.db as dbutils
+import helpers.cleaning as cleaning
+import helpers.eventjson as eventjson
+import helpers.eventstore as eventstore
+
+def _user_ids(synthetic_study):
+    return sorted(f[:-len('.json')] for f in os.listdir(f'{synthetic_study}/events'))
+
+@pytest.fixture(scope='module')
+def store(synthetic_study, tmp_path_factory):
+    store_dir = str(tmp_path_factory.mktemp('store'))
+    eventstore.write_events_to_store(f'{synthetic_study}/events', store_dir, batch_size=7)
+    return store_dir
+
+def test_store_round_trip(synthetic_study, store):
+    for user_id in _user_ids(synthetic_study):
+        events = dbutils.load_events_for_user(user_id, f'{synthetic_study}/events')
+        loaded = eventstore.load_events_for_user_from_store(user_id, store)
+        assert loaded == events
+        # Same key order as the JSON file
+        assert json.dumps(loaded) == json.dumps(events)
+
+@pytest.mark.parametrize('fields', [None, eventjson.ANALYSIS_EVENT_FIELDS, {'suggestion_rejected': ('reason',)}])
+def test_store_events_df_matches_create_events_df(synthetic_study, store, fields):
+    for user_id in _user_ids(synthetic_study)[:5]:
+        expected = cleaning.create_events_df(dbutils.load_events_for_user(user_id, f'{synthetic_study}/events', fields=fields))
+        events_df = cleaning.create_events_df(eventstore.load_events_df_for_user_from_store(user_id, store, fields=fields))
+        pd.testing.assert_frame_equal(events_df, expected)
+
+def test_rewrite_removes_stale_partitions(synthetic_study, tmp_path):
+    events_dir, store_dir = str(tmp_path / 'events'), str(tmp_path / 'store')
+    os.makedirs(events_dir)
+    user_ids = _user_ids(synthetic_study)
+    rewritten = next(u for u in user_ids if 'suggestion_rejected' in {e['eventName'] for e in dbutils.load_events_for_user(u, f'{synthetic_study}/events')})
+    other = next(u for u in user_ids if u != rewritten)
+    for user_id in (rewritten, other):
+        with open(f'{synthetic_study}/events/{user_id}.json') as f_in, open(f'{events_dir}/{user_id}.json', 'w') as f_out:
+            f_out.write(f_in.read())
+    eventstore.write_events_to_store(events_dir, store_dir)
+    assert 'suggestion_rejected' in eventstore.get_event_names_in_store(store_dir, rewritten)
+
+    # The user's new JSON no longer has suggestion_rejected events: their old partition must not survive the rewrite
+    events = [e for e in dbutils.load_events_for_user(rewritten, events_dir) if e['eventName'] != 'suggestion_rejected']
+    with open(f'{events_dir}/{rewritten}.json', 'w') as f:
+        json.dump(events, f)
+    eventstore.write_events_to_store(events_dir, store_dir, user_ids=[rewritten])
+
+    assert 'suggestion_rejected' not in eventstore.get_event_names_in_store(store_dir, rewritten)
+    assert eventstore.load_events_for_user_from_store(rewritten, store_dir) == events
+    # The other user's partitions are untouched
+    assert eventstore.load_events_for_user_from_store(other, store_dir) == dbutils.load_events_for_user(other, events_dir)
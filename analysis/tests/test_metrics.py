@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+import helpers.metrics as metrics
+
+# task_id -> (final essay, [(suggestion, is_accepted, rejection_reason)])
+TASKS = {
+    'food': ('We ate rice and dal every day. Then we ate rice and dal again.',
+             [('rice and dal', True, None), ('rice and dal', True, None), ('every single day', True, None), ('spicy', False, 'implicit')]),
+    'movie': ('The film was long but the songs were great.',
+              [('the songs were great', True, None), ('The film was short', True, None), ('boring', False, 'pressed_escape')]),
+    'travel': ('We went to the hills.', [('by train', False, 'implicit')]),
+    'holiday': ('Lights everywhere.', []),
+    'music': ('A song that everyone knows, a song that everyone sings.', [('a song that everyone', True, None), ('everyone', True, None)]),
+}
+
+def _frames():
+    tasks_df = pd.DataFrame({'finalHtml_stripped': [essay for essay, _ in TASKS.values()]}, index=pd.Index(list(TASKS), name='id'))
+    rows = [{'task_id': task_id, 'suggestionText': text, 'is_accepted': accepted, 'rejection_reason': reason, 'time_shown': i}
+            for task_id, (_, suggestions) in TASKS.items() for i, (text, accepted, reason) in enumerate(suggestions)]
+    return tasks_df, pd.DataFrame(rows)
+
+@pytest.mark.parametrize('task_id', list(TASKS))
+def test_compute_suggestion_metrics_for_essay_matches_the_three_metrics(task_id):
+    _, suggestions_df = _frames()
+    essay, dfs = TASKS[task_id][0], suggestions_df[suggestions_df['task_id'] == task_id]
+    accepted = dfs.loc[dfs['is_accepted'] == True, 'suggestionText'].tolist()
+    expected = (metrics.compute_ai_reliance_for_essay(essay, dfs), metrics.compute_suggestion_edit_rate(essay, dfs), metrics.compute_percentage_edited_suggestions(essay, dfs))
+    np.testing.assert_array_equal(metrics.compute_suggestion_metrics_for_essay(essay, accepted), expected)
+
+def test_compute_metrics_for_tasks_matches_rowwise():
+    tasks_df, suggestions_df = _frames()
+    # The row-wise version compute_metrics_for_tasks replaced
+    expected = tasks_df.copy()
+    for column, metric in [('ai_reliance', metrics.compute_ai_reliance_for_essay), ('suggestion_edit_rate', metrics.compute_suggestion_edit_rate),
+                           ('percentage_edited_suggestions', metrics.compute_percentage_edited_suggestions)]:
+        expected[column] = expected.apply(lambda x: metric(x['finalHtml_stripped'], suggestions_df[suggestions_df['task_id'] == x.name]), axis=1)
+    expected = expected.join(suggestions_df.groupby('task_id').agg(
+        shown=('time_shown', 'count'),
+        accepted=('is_accepted', 'sum'),
+        ignored=('rejection_reason', lambda x: x.tolist().count('implicit')),
+        rejected=('rejection_reason', lambda x: x.tolist().count('pressed_escape'))))
+
+    result = metrics.compute_metrics_for_tasks(tasks_df.copy(), suggestions_df)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    cohort = metrics.compute_metrics_for_cohort(tasks_df.assign(user_id='p-1'), suggestions_df.assign(user_id='p-1'))
+    pd.testing.assert_frame_equal(cohort.drop(columns='user_id'), expected, check_dtype=False)
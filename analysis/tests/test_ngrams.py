@@ -0,0 +1,59 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pytest
+import helpers.tokens as tokens
+import helpers.ngrams as ngrams
+
+TEXTS = [
+    'We ate rice and dal , then rice and dal again .',
+    'The festival of lights is the festival of the year .',
+    'Rice and dal and the festival of lights .',
+    'a',
+    '',
+    'We ate the rice , we ate the dal .',
+]
+GROUPS = ['food', 'festival', 'food', 'food', 'festival', 'food']
+
+def _reference(texts, n, k, remove_stopwords=False):
+    # A plain Counter over the n-gram strings (ties: first occurrence, as Counter.most_common)
+    counter = Counter(ngram for text in texts for ngram in tokens.find_ngrams(text.lower(), n, remove_stopwords))
+    return counter.most_common(k)
+
+def _top(df, n):
+    return list(zip(df.loc[df['n'] == n, 'ngram'], df.loc[df['n'] == n, 'count']))
+
+@pytest.mark.parametrize('remove_stopwords', [False, True])
+def test_count_top_ngrams_matches_counter(whitespace_tokenizer, monkeypatch, remove_stopwords):
+    monkeypatch.setattr(tokens, '_stop_words', frozenset(['the', 'of', 'and', 'a', ',', '.']))
+    df = ngrams.count_top_ngrams(TEXTS, orders=(1, 2, 3), k=100, remove_stopwords=remove_stopwords)
+    for n in (1, 2, 3):
+        assert _top(df, n) == _reference(TEXTS, n, 100, remove_stopwords)
+        assert df.loc[df['n'] == n, 'rank'].tolist() == list(range(1, len(_top(df, n)) + 1))
+
+def test_count_top_ngrams_per_group(whitespace_tokenizer):
+    df = ngrams.count_top_ngrams(TEXTS, pd.Series(GROUPS, name='task_id'), k=3, exclude=['rice and dal', '.'])
+    assert df['task_id'].unique().tolist() == ['festival', 'food']
+    for group in ('festival', 'food'):
+        texts = [text for text, g in zip(TEXTS, GROUPS) if g == group]
+        for n in (1, 2, 3):
+            expected = [(ngram, count) for ngram, count in _reference(texts, n, 100) if ngram not in ('rice and dal', '.')][:3]
+            assert _top(df[df['task_id'] == group], n) == expected
+
+def test_count_top_ngrams_vocabulary_at_the_packing_width(whitespace_tokenizer, monkeypatch):
+    # With 4 bits per token, ids 0..15 fit: 16 distinct tokens are packed exactly, 17 are rejected
+    monkeypatch.setattr(ngrams, 'BITS_PER_TOKEN', 4)
+    words = [f'w{i}' for i in range(16)]
+    texts = [' '.join(words), ' '.join(words[::-1]), ' '.join(words[10:])]
+    df = ngrams.count_top_ngrams(texts, orders=(1, 2, 3), k=100)
+    for n in (1, 2, 3):
+        assert _top(df, n) == _reference(texts, n, 100)
+    with pytest.raises(ValueError, match='Vocabulary too large'):
+        ngrams.count_top_ngrams(texts + ['w16'], k=100)
+
+def test_pack_ngrams_round_trip():
+    vocab = [f'w{i}' for i in range(1 << ngrams.BITS_PER_TOKEN)]
+    ids = np.array([0, len(vocab) - 1, 5, len(vocab) - 2], dtype=np.int64)
+    for n in range(1, ngrams.MAX_PACKED_ORDER + 1):
+        keys = ngrams._pack_ngrams(ids, n)
+        assert [ngrams._unpack_ngram(int(key), n, vocab) for key in keys] == [' '.join(vocab[i] for i in ids[j:j + n]) for j in range(len(ids) - n + 1)]
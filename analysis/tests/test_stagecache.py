@@ -0,0 +1,70 @@
+import json
+import pandas as pd
+import pytest
+import helpers.utils as utils
+import helpers.stagecache as stagecache
+import helpers.metrics as metrics
+from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+
+@pytest.fixture
+def events_dir(synthetic_study, tmp_path):
+    # A copy of the study's events that the tests can edit
+    import shutil
+    shutil.copytree(f'{synthetic_study}/events', tmp_path / 'events')
+    return str(tmp_path / 'events')
+
+@pytest.fixture
+def processed_users(monkeypatch):
+    # The users process_user_for_analysis actually runs for (i.e., the cache misses)
+    processed = []
+    process_user = utils.process_user_for_analysis
+    def counting_process_user(user_id, *args, **kwargs):
+        processed.append(user_id)
+        return process_user(user_id, *args, **kwargs)
+    monkeypatch.setattr(utils, 'process_user_for_analysis', counting_process_user)
+    return processed
+
+def _construct(users_df, events_dir, cache_dir):
+    return utils.construct_dfs_for_analysis(users_df.copy(), events_dir, TREATMENT_LABEL, CONTROL_LABEL, cache_dir=cache_dir)
+
+def test_find_helper_modules_follows_lazy_and_nested_imports():
+    names = [module.__name__ for module in stagecache.find_helper_modules(metrics)]
+    # metrics imports lcs and lazily tokens
+    assert names == ['helpers._lazy', 'helpers.lcs', 'helpers.metrics', 'helpers.tokens']
+    utils.get_user_stage_version.cache_clear()
+    version = utils.get_user_stage_version(False)
+    assert version != utils.get_user_stage_version(True)
+
+def test_input_change_recomputes_only_that_user(study_users, events_dir, tmp_path, processed_users):
+    cache_dir = str(tmp_path / 'stages')
+    expected = _construct(study_users, events_dir, cache_dir)
+    assert sorted(processed_users) == sorted(study_users.index)
+
+    processed_users.clear()
+    for a, b in zip(expected, _construct(study_users, events_dir, cache_dir)):
+        pd.testing.assert_frame_equal(a.drop(columns='eventDetails', errors='ignore'), b.drop(columns='eventDetails', errors='ignore'))
+    assert processed_users == []
+
+    # An edit of one user's events only invalidates that user
+    user_id = study_users.index[3]
+    with open(f'{events_dir}/{user_id}.json') as f:
+        events = json.load(f)
+    with open(f'{events_dir}/{user_id}.json', 'w') as f:
+        json.dump(events[:-1], f)
+    _construct(study_users, events_dir, cache_dir)
+    assert processed_users == [user_id]
+
+def test_code_change_in_a_lazily_imported_module_recomputes(study_users, events_dir, tmp_path, processed_users, monkeypatch):
+    cache_dir = str(tmp_path / 'stages')
+    _construct(study_users, events_dir, cache_dir)
+    processed_users.clear()
+
+    # helpers.tokens is only imported lazily by metrics; a change of its source changes the stage version
+    getsource = stagecache.inspect.getsource
+    monkeypatch.setattr(stagecache.inspect, 'getsource', lambda obj: getsource(obj) + ('\n# edited' if getattr(obj, '__name__', None) == 'helpers.tokens' else ''))
+    utils.get_user_stage_version.cache_clear()
+    try:
+        _construct(study_users, events_dir, cache_dir)
+    finally:
+        utils.get_user_stage_version.cache_clear()
+    assert sorted(processed_users) == sorted(study_users.index)
@@ -0,0 +1,108 @@
+import os
+import json
+import pickle
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import pandas as pd
+import helpers.structured as structured
+from helpers.cache import ResponseCache, make_cache_key
+
+def _fake_embeddings(calls):
+    # Stands in for get_openai_embeddings_for_strings: the embedding of a text is [len(text)]
+    def embed(texts, cache=None, **kwargs):
+        calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+    return embed
+
+def _tasks(texts):
+    return pd.DataFrame({'user_id': list(texts), 'id': 'food', 'finalHtml_stripped': list(texts.values())})
+
+def test_essay_embeddings_pickle_is_read_only_by_default(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(structured, 'get_openai_embeddings_for_strings', _fake_embeddings(calls))
+    outfile = str(tmp_path / 'embeddings.pkl')
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+
+    structured.get_essay_embeddings_for_all_essays(_tasks({'a': 'xx', 'b': 'yyy'}), outfile, cache=cache)
+    assert calls == [['xx', 'yyy']]
+    before = os.path.getmtime(outfile)
+
+    df = structured.get_essay_embeddings_for_all_essays(_tasks({'a': 'xx', 'b': 'yyy', 'c': 'z'}), outfile)
+    assert len(calls) == 1
+    assert os.path.getmtime(outfile) == before
+    assert df['embedding'].isna().tolist() == [False, False, True]
+
+def test_essay_embeddings_update_reembeds_changed_texts(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(structured, 'get_openai_embeddings_for_strings', _fake_embeddings(calls))
+    outfile = str(tmp_path / 'embeddings.pkl')
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    structured.get_essay_embeddings_for_all_essays(_tasks({'a': 'xx', 'b': 'yyy'}), outfile, cache=cache)
+
+    # a's text changed (e.g., a new HTML extractor) and c is new
+    df = structured.get_essay_embeddings_for_all_essays(_tasks({'a': 'xxxx', 'b': 'yyy', 'c': 'z'}), outfile, update=True, cache=cache)
+    assert calls[1] == ['xxxx', 'z']
+    assert df['embedding'].tolist() == [[4.0], [3.0], [1.0]]
+    assert sorted(pickle.load(open(outfile, 'rb'))) == [('a', 'food', [4.0]), ('b', 'food', [3.0]), ('c', 'food', [1.0])]
+    # The old vector of a is put in the cache under the text it was computed for, not under the new text
+    assert cache.get(make_cache_key(structured.EMBEDDING_MODEL, '', 'xx')) == [2.0]
+    assert cache.get(make_cache_key(structured.EMBEDDING_MODEL, '', 'xxxx')) is None
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+class _FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    # A local embeddings endpoint: the embedding of 'text {i} ...' is [i]. The first attempt of each
+    # request fails (alternately 429 and 500), and the items are returned in reverse order.
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['input']
+        with self.server.lock:
+            self.server.requests.append(texts)
+            attempt = self.server.attempts.get(tuple(texts), 0)
+            self.server.attempts[tuple(texts)] = attempt + 1
+        if attempt == 0:
+            status, body = (429, 500)[len(self.server.attempts) % 2], {'error': {'message': 'try again'}}
+        else:
+            data = [{'object': 'embedding', 'index': i, 'embedding': [float(text.split()[1])]} for i, text in enumerate(texts)]
+            status, body = 200, {'object': 'list', 'data': data[::-1], 'model': 'fake', 'usage': {'prompt_tokens': 1, 'total_tokens': 1}}
+        out = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def embeddings_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeEmbeddingsHandler)
+    server.lock, server.requests, server.attempts = threading.Lock(), [], {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+def test_embeddings_batching_retries_and_order(embeddings_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(structured.time, 'sleep', lambda seconds: None)
+    client = structured.openai.AzureOpenAI(api_key='fake', api_version='2024-02-01', azure_endpoint=f'http://127.0.0.1:{embeddings_server.server_port}', max_retries=0)
+    texts = [f'text {i} ' + 'x' * (i % 7) * 5 for i in range(40)]
+    texts[5] = 'text 5 ' + 'y' * 200  # longer than max_tokens on its own
+    texts += [texts[3], texts[10]]  # duplicates are embedded once
+
+    embeddings = structured.get_openai_embeddings_for_strings(texts, client=client, max_items=4, max_tokens=30, max_workers=4, quiet=True, cache=ResponseCache(str(tmp_path / 'cache.sqlite')))
+    assert embeddings == [[float(text.split()[1])] for text in texts]
+
+    # Each distinct request failed once (429 or 500) and was retried
+    successful = list(embeddings_server.attempts)
+    assert all(attempts == 2 for attempts in embeddings_server.attempts.values())
+    assert sorted(text for batch in successful for text in batch) == sorted(set(texts))
+    for batch in successful:
+        assert len(batch) <= 4
+        assert len(batch) == 1 or sum(structured.estimate_num_tokens(text) for text in batch) <= 30
+    assert len(embeddings_server.requests) == 2 * len(successful)
+    assert any(len(batch) == 4 for batch in successful)
+
+def test_batch_texts_for_embedding_limits():
+    texts = ['a' * 29, 'b' * 29, 'c' * 100, 'd', 'e', 'f', 'g']
+    # estimate_num_tokens: 10, 10, 34, 1, 1, 1, 1
+    assert structured.batch_texts_for_embedding(texts, max_items=3, max_tokens=20) == [[0, 1], [2], [3, 4, 5], [6]]
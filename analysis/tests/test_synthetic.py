@@ -0,0 +1,40 @@
+import json
+import pytest
+import helpers.utils as utils
+import helpers.tokens as tokens
+import helpers.benchmark as benchmark
+from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+
+def test_synthetic_study_loads_through_the_builders(study_users, synthetic_study):
+    with open(f'{synthetic_study}/synthetic.json') as f:
+        summary = json.load(f)
+    events_df, tasks_df, suggestions_df = utils.construct_dfs_for_analysis(study_users, f'{synthetic_study}/events', TREATMENT_LABEL, CONTROL_LABEL)
+
+    # All 20 users but the one born outside their country of residence, in both groups and both countries
+    assert len(study_users) == summary['n_users'] - 1
+    assert set(study_users['group']) == {TREATMENT_LABEL, CONTROL_LABEL}
+    assert set(study_users['country']) == {'IND', 'US'}
+    assert events_df['user_id'].nunique() == len(study_users)
+    assert events_df['eventName'].value_counts()['suggestion_shown'] <= summary['suggestions_shown']
+
+    # Every user has their writing tasks with an essay; the treatment users' suggestions belong to their tasks
+    assert (tasks_df.groupby('user_id').size() == summary['n_tasks']).all()
+    assert tasks_df[['time_started', 'time_completed', 'finalHtml_stripped', 'group', 'country']].notna().all().all()
+    treatment_tasks = tasks_df[tasks_df['group'] == TREATMENT_LABEL]
+    assert set(suggestions_df['user_id']) == set(treatment_tasks['user_id'])
+    assert set(zip(suggestions_df['user_id'], suggestions_df['task_id'])) <= set(zip(treatment_tasks['user_id'], treatment_tasks.index))
+    assert treatment_tasks[['ai_reliance', 'shown', 'accepted']].notna().all().all()
+
+def test_time_pipeline_stages(synthetic_study, whitespace_tokenizer):
+    results = benchmark.time_pipeline_stages(synthetic_study)
+    assert [r['stage'] for r in results] == list(benchmark.PIPELINE_STAGES[:-1])
+    assert all('error' not in r and r['seconds'] >= 0 for r in results)
+
+def test_time_pipeline_stages_checks_the_tokenizer_first(synthetic_study, monkeypatch):
+    def missing(text):
+        raise LookupError("Resource 'punkt_tab' not found.")
+    monkeypatch.setattr(tokens.nltk.tokenize, 'word_tokenize', missing)
+    monkeypatch.setattr(tokens, '_resources_ready', True)
+    monkeypatch.setattr(utils, 'construct_dfs_for_analysis', lambda *args, **kwargs: pytest.fail('ran the stages without the tokenizer'))
+    with pytest.raises(LookupError, match='punkt_tab'):
+        benchmark.time_pipeline_stages(synthetic_study)
@@ -0,0 +1,47 @@
+import os
+import json
+import pandas as pd
+import helpers.utils as utils
+import helpers.tracing as tracing
+from helpers.constants import TREATMENT_LABEL, CONTROL_LABEL
+
+def test_tracing_users_in_worker_processes(study_users, synthetic_study, tmp_path):
+    tracer = tracing.Tracer(trace_memory=True)
+    with tracer.span('construct'):
+        events_df, tasks_df, suggestions_df = utils.construct_dfs_for_analysis(study_users.copy(), f'{synthetic_study}/events', TREATMENT_LABEL, CONTROL_LABEL, n_workers=2, tracer=tracer)
+
+    # Tracing doesn't change the results
+    expected = utils.construct_dfs_for_analysis(study_users.copy(), f'{synthetic_study}/events', TREATMENT_LABEL, CONTROL_LABEL)
+    pd.testing.assert_frame_equal(tasks_df, expected[1])
+    pd.testing.assert_frame_equal(suggestions_df, expected[2])
+
+    spans = tracer.frame()
+    users = spans[spans['name'] == 'user']
+    assert sorted(users['user_id']) == sorted(study_users.index)
+    assert (users['path'] == 'construct/user').all()
+    assert (users['pid'] != os.getpid()).all()
+    assert users['peak_memory_mb'].notna().all()
+    n_treatment = tasks_df.loc[tasks_df['group'] == TREATMENT_LABEL, 'user_id'].nunique()
+    counts = spans['path'].value_counts()
+    assert counts['construct/user/load_events'] == counts['construct/user/tasks'] == len(study_users)
+    assert counts['construct/user/metrics'] == n_treatment
+    assert counts['construct/concat'] == counts['construct/validate_double_clicks'] == counts['construct'] == 1
+    assert (spans.loc[spans['path'].isin(['construct', 'construct/concat']), 'pid'] == os.getpid()).all()
+
+    trace = tracer.to_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as f:
+        assert json.load(f) == json.loads(json.dumps(trace, default=str))
+    events = trace['traceEvents']
+    assert len(events) == len(tracer.records)
+    for event in events:
+        assert event['ph'] == 'X' and event['cat'] == 'construct'
+        assert isinstance(event['name'], str) and isinstance(event['pid'], int) and isinstance(event['tid'], int)
+        assert event['ts'] >= 0 and event['dur'] >= 0
+    # Each step of a user lies within its user span (on the same process and thread)
+    user_events = {(e['pid'], e['tid'], e['args']['user_id']): e for e in events if e['name'] == 'user'}
+    for user_event in user_events.values():
+        children = [e for e in events if e['args']['path'].startswith('construct/user/') and (e['pid'], e['tid']) == (user_event['pid'], user_event['tid'])
+                    and user_event['ts'] <= e['ts'] <= user_event['ts'] + user_event['dur']]
+        assert {e['name'] for e in children} >= {'load_events', 'tasks'}
+        for child in children:
+            assert child['ts'] + child['dur'] <= user_event['ts'] + user_event['dur'] + 1e3  # 1 ms of clock slack
@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import pytest
+import helpers.utils as utils
+
+def _two_groups(seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'g': ['A'] * 20 + ['B'] * 20, 'x': rng.normal(size=40), 'y': rng.normal(size=40)})
+    df.loc[3, 'y'] = np.nan
+    return df
+
+def test_permutation_test_is_nan_for_columns_with_nan():
+    df = _two_groups()
+    results = utils.batch_statistical_tests(df, ['x', 'y'], 'g', ['A', 'B'], tests=('ttest', 'mannwhitney', 'permutation'), n_permutations=2000, seed=0)
+    y = results[results['col'] == 'y'].set_index('test')
+    assert y['p_value'].isna().all()
+    assert not y['significant'].any()
+    x = results[(results['col'] == 'x') & (results['test'] == 'permutation')]
+    assert x['p_value'].notna().all()
+
+def test_cliffs_d_propagates_nan():
+    x = np.array([1.0, 2.0, np.nan, 4.0])
+    y = np.array([1.5, 2.5, 3.5])
+    assert np.isnan(utils.cliffs_d(x, y))
+    assert np.isnan(utils.cliffs_d(y, x))
+    x = x[~np.isnan(x)]
+    assert np.isclose(utils.cliffs_d(x, y), utils.cliffs_d_from_u(utils.stats.mannwhitneyu(x, y).statistic, len(x), len(y)))
+
+def test_bootstrap_effect_sizes():
+    rng = np.random.default_rng(1)
+    x, y = rng.normal(0.5, 1, size=30), np.round(rng.normal(0, 1, size=25), 1)
+    summary, replicates = utils.bootstrap_effect_sizes(x, y, n_boot=200, seed=7, return_replicates=True)
+    estimates = summary.set_index('effect_size')['estimate']
+    assert np.isclose(estimates['cohens_d'], utils.cohens_d(x, y))
+    assert np.isclose(estimates['cliffs_d'], utils.cliffs_d(x, y))
+
+    # Each replicate is the effect size of the resampled data (same draws as bootstrap_effect_sizes with this seed)
+    seeded = np.random.default_rng(7)
+    wx, wy = utils.bootstrap_weights(len(x), 200, rng=seeded), utils.bootstrap_weights(len(y), 200, rng=seeded)
+    for b in (0, 99, 199):
+        xb, yb = np.repeat(x, wx[b]), np.repeat(y, wy[b])
+        assert np.isclose(replicates.loc[b, 'cohens_d'], utils.cohens_d(xb, yb))
+        assert np.isclose(replicates.loc[b, 'cliffs_d'], utils.cliffs_d(xb, yb))
+
+    pd.testing.assert_frame_equal(utils.bootstrap_effect_sizes(x, y, n_boot=200, seed=7), summary)
+    assert not utils.bootstrap_effect_sizes(x, y, n_boot=200, seed=8)['ci_low'].equals(summary['ci_low'])
+
+def test_bootstrap_grouped_means():
+    df = pd.DataFrame({'g': ['a', 'b', 'a', 'c', 'b', None] * 5, 'v': np.arange(30) % 4 == 0})
+    summary = utils.bootstrap_grouped_means(df, 'v', 'g', n_boot=300, seed=3)
+    assert summary['g'].tolist() == ['a', 'b', 'c']
+    assert np.allclose(summary['estimate'], df.dropna().groupby('g')['v'].mean())
+    assert (summary['ci_low'] <= summary['ci_high']).all()
+    pd.testing.assert_frame_equal(utils.bootstrap_grouped_means(df, 'v', 'g', n_boot=300, seed=3), summary)
+
+def test_bootstrap_rejects_empty_samples():
+    with pytest.raises(ValueError):
+        utils.bootstrap_effect_sizes([], [1.0, 2.0])
+    with pytest.raises(ValueError):
+        utils.bootstrap_effect_sizes([1.0, 2.0], [3.0])
+    with pytest.raises(ValueError):
+        utils.bootstrap_grouped_means(pd.DataFrame({'g': [None], 'v': [1.0]}), 'v', 'g')
+    with pytest.raises(ValueError):
+        utils.bootstrap_weights(0, 10)
+
+def _reference_adjust(p, method):
+    # Textbook step-down Holm and step-up Benjamini-Hochberg
+    m, order = len(p), np.argsort(p)
+    adjusted = np.empty(m)
+    for rank, i in enumerate(order):
+        if method == 'holm':
+            adjusted[i] = min(1, max((m - k) * p[order[k]] for k in range(rank + 1)))
+        else:
+            adjusted[i] = min(1, min(m * p[order[k]] / (k + 1) for k in range(rank, m)))
+    return adjusted
+
+def test_adjust_pvalues():
+    p = np.array([0.01, 0.04, 0.03, 0.005, np.nan])
+    assert np.allclose(utils.adjust_pvalues(p, 'holm'), [0.03, 0.06, 0.06, 0.02, np.nan], equal_nan=True)
+    assert np.allclose(utils.adjust_pvalues(p, 'fdr_bh'), [0.02, 0.04, 0.04, 0.02, np.nan], equal_nan=True)
+    assert np.allclose(utils.adjust_pvalues(p, 'bonferroni'), [0.04, 0.16, 0.12, 0.02, np.nan], equal_nan=True)
+
+    p = np.random.default_rng(0).uniform(0, 0.2, size=50)
+    p[[3, 17]] = p[5]  # ties
+    for method in ('holm', 'fdr_bh'):
+        assert np.allclose(utils.adjust_pvalues(p, method), _reference_adjust(p, method))
+    with pytest.raises(ValueError):
+        utils.adjust_pvalues(p, 'sidak')
+
+def test_cliffs_d_from_u_with_ties():
+    rng = np.random.default_rng(2)
+    x, y = rng.integers(0, 5, size=40).astype(float), rng.integers(1, 6, size=33).astype(float)
+    u = utils.stats.mannwhitneyu(x, y).statistic
+    assert np.isclose(utils.cliffs_d_from_u(u, len(x), len(y)), utils.cliffs_d(x, y))
+    assert np.isclose(utils.cliffs_d(x, y), np.sign(x[:, None] - y[None, :]).mean())
+
+def test_permutation_test_matches_exact_test():
+    import itertools
+    a, b = np.array([2.1, 3.4, 1.9, 4.2, 3.3]), np.array([1.2, 2.0, 0.8, 2.5, 1.7, 1.1])
+    pooled = np.concatenate([a, b])
+    observed = abs(a.mean() - b.mean())
+    diffs = [abs(pooled[list(c)].mean() - np.delete(pooled, c).mean()) for c in itertools.combinations(range(len(pooled)), len(a))]
+    exact = np.mean(np.array(diffs) >= observed - 1e-12)
+
+    p = utils.permutation_test(a, b, n_permutations=20_000, seed=0)
+    assert abs(p[0] - exact) < 0.01
+    # All columns share the permutations, so each column gets the p-value of testing it alone
+    c = np.column_stack([a, a * 2 + 1]), np.column_stack([b, -b])
+    both = utils.permutation_test(*c, n_permutations=2000, seed=1)
+    assert both[0] == utils.permutation_test(a, b, n_permutations=2000, seed=1)[0]
+    assert both[1] == utils.permutation_test(c[0][:, 1], c[1][:, 1], n_permutations=2000, seed=1)[0]
+
+def test_batch_statistical_tests_matches_scipy():
+    rng = np.random.default_rng(4)
+    df = pd.DataFrame({'group': ['AI', 'No AI'] * 30, 'country': ['India'] * 20 + ['US'] * 40, 'x': rng.normal(size=60), 'y': rng.exponential(size=60)})
+    results = utils.batch_statistical_tests(df, ['x', 'y'], 'group', ['AI', 'No AI'], strata=[None, 'country'], correction='holm')
+    assert len(results) == 3 * 2 * 2
+    for _, row in results.iterrows():
+        cell = df if row['strata'] == 'all' else df[df['country'] == row['country']]
+        a, b = cell.loc[cell['group'] == 'AI', row['col']], cell.loc[cell['group'] == 'No AI', row['col']]
+        if row['test'] == 'ttest':
+            assert np.isclose(row['p_value'], utils.stats.ttest_ind(a, b).pvalue)
+            assert np.isclose(row['effect_size'], utils.cohens_d(a, b))
+        else:
+            assert np.isclose(row['p_value'], utils.stats.mannwhitneyu(a, b, alternative='two-sided').pvalue)
+            assert np.isclose(row['effect_size'], utils.cliffs_d(a, b))
+        assert (row['n1'], row['n2']) == (len(a), len(b))
+    for _, rows in results.groupby('test'):
+        assert np.allclose(rows['p_adjusted'], utils.adjust_pvalues(rows['p_value'], 'holm'))
+    assert (results['significant'] == (results['p_adjusted'] < 0.05)).all()